@@ -0,0 +1 @@
+"""Helper code accompanying the Tempo, Beat and Downbeat Estimation tutorial."""
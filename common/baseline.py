@@ -0,0 +1,327 @@
+"""Dynamic programming beat tracking as used in the baseline section (ch2).
+
+The functions here follow the notebook code of the book (which in turn borrows
+heavily from `librosa`), but avoid iterating over every single frame in Python.
+"""
+
+import time
+
+import numpy as np
+import librosa
+
+
+def _dp_window(period, tightness):
+    # search range for previous beat and the corresponding (log-gaussian) weighting
+    window = np.arange(-2 * period, -np.round(period / 2) + 1, dtype=int)
+    txwt = -tightness * (np.log(-window / period) ** 2)
+    return window, txwt
+
+
+def _cumulative_score(localscore, window, txwt, alpha):
+    """Compute the cumulative score and the backlinks of the DP recursion.
+
+    The closest possible predecessor of frame `i` is `-window[-1]` frames in the
+    past, thus all frames of a block of that length only depend on frames
+    preceding the block and can be computed at once. Reaching back before time
+    0 is handled by zero-padding the cumulative score, the candidates of all
+    frames of a block are a sliding window view of it (i.e. no copies).
+
+    `txwt` and `alpha` can have a leading dimension, in which case the
+    recursions for all these settings are computed jointly.
+    """
+    single = np.ndim(txwt) == 1
+    txwt = np.atleast_2d(txwt)
+    alpha = np.broadcast_to(alpha, txwt.shape[:1])[:, np.newaxis]
+    num_settings = len(txwt)
+    num_frames = len(localscore)
+    num_lags = len(window)
+    offset = -window[0]
+    block = max(1, -window[-1])
+    # zero-padded cumulative score; frame i is stored at position i + offset
+    padded = np.zeros((num_settings, num_frames + offset), dtype=localscore.dtype)
+    cumulative_score = padded[:, offset:]
+    candidates = np.lib.stride_tricks.sliding_window_view(padded, num_lags, axis=-1)
+    # pre-allocated buffers, re-used for every block
+    scores = np.empty((num_settings, block, num_lags), dtype=np.result_type(txwt, localscore))
+    beat_location = np.empty((num_settings, num_frames), dtype=int)
+    settings = np.arange(num_settings)[:, np.newaxis]
+    for start in range(0, num_frames, block):
+        stop = min(start + block, num_frames)
+        n = stop - start
+        # search over all possible predecessors
+        np.add(txwt[:, np.newaxis], candidates[:, start:stop], out=scores[:, :n])
+        # find the best preceding beat
+        np.argmax(scores[:, :n], axis=-1, out=beat_location[:, start:stop])
+        best = scores[settings, np.arange(n), beat_location[:, start:stop]]
+        # add the local score
+        cumulative_score[:, start:stop] = (1 - alpha) * localscore[start:stop] + alpha * best
+    # backlinks are the (absolute) positions of the best preceding beats
+    backlink = np.arange(num_frames) + window[beat_location]
+    # special case the first onset, stop if the localscore is small
+    first_beat = np.flatnonzero(localscore >= 0.01 * localscore.max())
+    backlink[:, : first_beat[0] if len(first_beat) else num_frames] = -1
+    if single:
+        return cumulative_score[0], backlink[0]
+    return cumulative_score, backlink
+
+
+def _backtrack(oenv, cumulative_score, backlink, sr, hop_length):
+    beats = [librosa.beat.__last_beat(cumulative_score)]
+    # reconstruct the beat path from backlinks
+    while backlink[beats[-1]] >= 0:
+        beats.append(backlink[beats[-1]])
+    # put the beats in ascending order and convert into an array of frame numbers
+    beats = np.array(beats[::-1], dtype=int)
+    # discard spurious trailing beats
+    beats = librosa.beat.__trim_beats(oenv, beats, trim=True)
+    # convert beat times seconds
+    return librosa.frames_to_time(beats, hop_length=hop_length, sr=sr)
+
+
+def beat_track_dp(oenv, tempo, fps, sr, hop_length, tightness=100, alpha=0.5, ref_beats=None):
+    """Dynamic programming beat tracker.
+
+    Drop-in replacement for `beat_track_dp` of the baseline section, returning
+    the very same beats and cumulative score, but processing blocks of frames
+    at once instead of iterating over all frames individually.
+
+    Args:
+        oenv: onset envelope (e.g. spectral flux)
+        tempo: tempo in BPM
+        fps: frame rate of the onset envelope
+        sr: sample rate
+        hop_length: hop length used to compute the onset envelope
+        tightness: how strictly to adhere to the tempo
+        alpha: weight of the cumulative score (vs. the local score)
+        ref_beats: unused, kept for compatibility with the notebook version
+
+    Returns:
+        tuple: beat times (in seconds) and the cumulative score
+    """
+    period = fps * 60.0 / tempo
+    localscore = librosa.beat.__beat_local_score(oenv, period)
+    window, txwt = _dp_window(period, tightness)
+    cumulative_score, backlink = _cumulative_score(localscore, window, txwt, alpha)
+    beats = _backtrack(oenv, cumulative_score, backlink, sr, hop_length)
+    return beats, cumulative_score
+
+
+def beat_track_dp_sweep(oenv, tempi, fps, sr, hop_length, tightness=(100,), alpha=(0.5,)):
+    """Run the dynamic programming beat tracker for a grid of parameters.
+
+    For each tempo, the local score and the search window are computed only
+    once and the cumulative scores of all `tightness` x `alpha` combinations
+    are computed jointly in a single pass over the onset envelope.
+
+    Args:
+        oenv: onset envelope (e.g. spectral flux)
+        tempi: tempo values (in BPM) to evaluate
+        fps: frame rate of the onset envelope
+        sr: sample rate
+        hop_length: hop length used to compute the onset envelope
+        tightness: tightness values to evaluate
+        alpha: alpha values to evaluate
+
+    Returns:
+        list: one dictionary per setting with keys 'tempo', 'tightness',
+            'alpha', 'beats' and 'cumulative_score'; beats and cumulative
+            score are identical to those returned by `beat_track_dp`
+    """
+    tightness = np.atleast_1d(np.asarray(tightness, dtype=float))
+    alpha = np.atleast_1d(np.asarray(alpha, dtype=float))
+    # all combinations of tightness and alpha values
+    grid_tightness, grid_alpha = [g.ravel() for g in np.meshgrid(tightness, alpha, indexing='ij')]
+    results = []
+    for tempo in np.atleast_1d(tempi):
+        period = fps * 60.0 / tempo
+        localscore = librosa.beat.__beat_local_score(oenv, period)
+        window, txwt = _dp_window(period, grid_tightness[:, np.newaxis])
+        cumulative_scores, backlinks = _cumulative_score(localscore, window, txwt, grid_alpha)
+        for t, a, cumulative_score, backlink in zip(grid_tightness, grid_alpha, cumulative_scores, backlinks):
+            beats = _backtrack(oenv, cumulative_score, backlink, sr, hop_length)
+            results.append(
+                {'tempo': tempo, 'tightness': t, 'alpha': a, 'beats': beats, 'cumulative_score': cumulative_score}
+            )
+    return results
+
+
+class OnlineBeatTracker:
+    """Online (causal) variant of the dynamic programming beat tracker.
+
+    The onset envelope is processed frame by frame; the local score and the
+    cumulative score are updated for each new frame and beats are reported
+    with a fixed latency: a beat is emitted as soon as it lies `latency`
+    seconds in the past of the current best beat path (obtained by following
+    the backlinks from the most recent peak of the cumulative score).
+
+    Of the latency, `lookahead` seconds are used by the local score to look
+    into the future. The remainder is the time the DP has to revise a beat:
+    beats of the best path which are more recent than `latency` seconds are
+    not reported yet, but backtracked to their (already final) predecessors,
+    i.e. a later, stronger peak can still change which beat is reported.
+
+    In contrast to the offline version, the onset envelope is normalised by
+    its running standard deviation (unless `std` is given), the local score
+    only uses as many future frames as the latency allows and the first beat
+    is determined relative to the running maximum of the local score. The
+    cumulative score is the same as the offline one otherwise, but beats are
+    taken from the best path ending at the current frame instead of the end
+    of the track. Call `flush` at the end of the input to report the beats
+    of the last `latency` seconds. All state is kept in ring buffers, i.e.
+    memory does not grow with the length of the input.
+
+    Args:
+        tempo: tempo in BPM
+        fps: frame rate of the onset envelope
+        tightness: how strictly to adhere to the tempo
+        alpha: weight of the cumulative score (vs. the local score)
+        latency: latency (in seconds) with which beats are reported
+        lookahead: look-ahead (in seconds) of the local score, at most
+            `latency` (None: half the latency)
+        std: standard deviation used to normalise the onset envelope, e.g.
+            known from similar material (None: running estimate)
+    """
+
+    def __init__(self, tempo, fps=100, tightness=100, alpha=0.5, latency=0.1, lookahead=None, std=None):
+        self.fps = fps
+        self.std = std
+        self.alpha = alpha
+        self.period = fps * 60.0 / tempo
+        self.window, self.txwt = _dp_window(self.period, tightness)
+        # gaussian kernel of the local score and the frame offsets it is applied to (same as convolution)
+        kernel = np.exp(-0.5 * (np.arange(-self.period, self.period + 1) * 32.0 / self.period) ** 2)
+        offsets = (len(kernel) - 1) // 2 - np.arange(len(kernel))
+        # latency in frames; the local score can look ahead at most this many frames, the remaining
+        # frames are used to revise the most recent beats by backtracking
+        self.delay = int(round(latency * fps))
+        lookahead = latency / 2 if lookahead is None else lookahead
+        self.lookahead = min(int(round(lookahead * fps)), self.delay, offsets[0])
+        keep = offsets <= self.lookahead
+        self.kernel, self.offsets = kernel[keep], offsets[keep]
+        # frames to consider when searching the most recent beat
+        self.head_frames = max(1, int(round(self.period)))
+        # minimum distance between two beats
+        self.min_distance = -self.window[-1]
+        # ring buffer size; must cover the local score kernel and the backtracking range
+        self.buffer_size = len(kernel) + self.delay + 3 * len(self.window) + 1
+        self.reset()
+
+    def reset(self):
+        """Reset the tracker to its initial state."""
+        self.onsets = np.zeros(self.buffer_size)
+        self.cumulative_score = np.zeros(self.buffer_size)
+        self.backlink = np.full(self.buffer_size, -1, dtype=int)
+        # number of onset frames received
+        self.num_frames = 0
+        # running mean & variance of the onset envelope (Welford's algorithm)
+        self.mean = self.m2 = 0.0
+        self.max_localscore = 0.0
+        self.first_beat = True
+        self.last_beat = -self.buffer_size
+        # processing time statistics
+        self.total_time = self.max_time = 0.0
+
+    def process_frame(self, onset):
+        """Process a single frame of the onset envelope.
+
+        Args:
+            onset: onset envelope value of the new frame
+
+        Returns:
+            list: frames of newly detected beats (usually none or one)
+        """
+        size = self.buffer_size
+        # store onset and update running statistics
+        t_in = self.num_frames
+        self.onsets[t_in % size] = onset
+        self.num_frames += 1
+        delta = onset - self.mean
+        self.mean += delta / self.num_frames
+        self.m2 += delta * (onset - self.mean)
+        # frame whose local score can be computed now
+        t = t_in - self.lookahead
+        if t < 0:
+            return []
+        if self.std is not None:
+            std = self.std
+        else:
+            std = np.sqrt(self.m2 / (self.num_frames - 1)) if self.num_frames > 1 else 0.0
+        frames = t + self.offsets
+        valid = frames >= 0
+        localscore = np.dot(self.kernel[valid], self.onsets[frames[valid] % size])
+        if std > 0:
+            localscore /= std
+        self.max_localscore = max(self.max_localscore, localscore)
+        # search over all possible predecessors, reaching back before time 0 adds nothing
+        predecessors = t + self.window
+        candidates = self.txwt + np.where(predecessors >= 0, self.cumulative_score[predecessors % size], 0)
+        beat_location = np.argmax(candidates)
+        self.cumulative_score[t % size] = (1 - self.alpha) * localscore + self.alpha * candidates[beat_location]
+        # special case the first onset, stop if the localscore is small
+        if self.first_beat and localscore < 0.01 * self.max_localscore:
+            self.backlink[t % size] = -1
+        else:
+            self.backlink[t % size] = predecessors[beat_location]
+            self.first_beat = False
+        # beats of the current best path which lie far enough in the past cannot be revised anymore
+        return self._report(t, t_in - self.delay)
+
+    def _report(self, t, commit):
+        """Report the beats of the best path ending at frame `t` up to frame `commit`."""
+        if self.first_beat or t < 0:
+            return []
+        size = self.buffer_size
+        # most recent beat of the current best path
+        recent = np.arange(max(0, t - self.head_frames + 1), t + 1)
+        beat = recent[np.argmax(self.cumulative_score[recent % size])]
+        # follow the backlinks back to the last reported beat (as far as the buffer reaches)
+        path = []
+        while beat > self.last_beat and beat > t - size:
+            if beat <= commit:
+                path.append(beat)
+            if self.backlink[beat % size] < 0:
+                break
+            beat = self.backlink[beat % size]
+        beats = []
+        for beat in reversed(path):
+            if beat >= self.last_beat + self.min_distance:
+                self.last_beat = beat
+                beats.append(beat)
+        return beats
+
+    def process(self, oenv):
+        """Process (a block of) the onset envelope.
+
+        Args:
+            oenv: onset envelope frames
+
+        Returns:
+            numpy array: times (in seconds) of newly detected beats
+        """
+        beats = []
+        for onset in np.atleast_1d(oenv):
+            start = time.perf_counter()
+            beats.extend(self.process_frame(onset))
+            duration = time.perf_counter() - start
+            self.total_time += duration
+            self.max_time = max(self.max_time, duration)
+        return np.array(beats) / self.fps
+
+    def flush(self):
+        """Report the remaining beats at the end of the input (i.e. without latency).
+
+        Returns:
+            numpy array: times (in seconds) of the remaining beats
+        """
+        t = self.num_frames - 1 - self.lookahead
+        return np.array(self._report(t, t)) / self.fps
+
+    @property
+    def mean_time(self):
+        """Mean processing time per frame (in seconds)."""
+        return self.total_time / max(1, self.num_frames)
+
+    @property
+    def real_time_factor(self):
+        """Ratio of processing time to duration of the processed onset envelope."""
+        return self.mean_time * self.fps
@@ -0,0 +1,126 @@
+"""Chunked inference of long tracks with constant memory.
+
+Predicting a track at once holds the activations of all layers for all
+frames in memory, i.e. memory grows with the length of the track. Instead,
+the (padded) features are split into chunks which overlap by the receptive
+field of the TCN (see `receptive_field`), each chunk is predicted on its own
+and only its centre (i.e. the frames seeing their full context) is kept.
+Since the convolutions of the TCN zero-pad only at the borders of the track,
+the stitched beat and downbeat activations are the same as when predicting
+the whole track (up to floating point precision). The skip connections are
+summed over all chunks, thus the tempo activations are computed from the
+same global average as `GlobalAveragePooling1D` does.
+"""
+
+import numpy as np
+from keras.models import Model
+
+from .runtime import softmax
+
+CHUNK_SIZE = 2 ** 15
+
+
+def _context(model):
+    """Frames lost by the conv layers and the context (frames to each side) of the TCN of a model."""
+    frames_lost, context = 0, 0
+    for layer in model.layers:
+        config = layer.get_config()
+        if layer.name.startswith('conv_') and layer.name.endswith('_conv'):
+            # 'valid' conv layers of the front end
+            frames_lost += config['kernel_size'][0] - 1
+        elif layer.name.endswith('_dilated_conv_2'):
+            # the second dilated conv. of each residual block sees the most context
+            kernel_size, dilation_rate = config['kernel_size'][0], config['dilation_rate'][0]
+            if config['padding'] == 'causal':
+                context += (kernel_size - 1) * dilation_rate
+            else:
+                context += (kernel_size - 1) // 2 * dilation_rate
+    return frames_lost, context
+
+
+class ChunkedModel:
+    """Predict (long) tracks in overlapping chunks.
+
+    Can be used instead of the Keras model for `predict` (or `InferenceEngine`),
+    e.g. `predict(ChunkedModel(model), dataset, batch_size=1)`. Memory is
+    bounded by the size of the chunks (`chunk_size` + 2 * context frames,
+    times `batch_size`), not by the length of the tracks; only the features
+    and the resulting activations (a few values per frame) scale with it.
+
+    Chunks of the same length (i.e. all but the first and the last of a
+    track) are predicted `batch_size` at a time, which processes them in
+    parallel at the cost of more memory.
+
+    Args:
+        model: Keras model created by `create_model`
+        chunk_size: number of (output) frames per chunk
+        batch_size: number of chunks per forward pass
+    """
+
+    def __init__(self, model, chunk_size=CHUNK_SIZE, batch_size=1):
+        self.model = model
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.frames_lost, self.context = _context(model)
+        # beats & downbeats, and the skip connections instead of the tempo activations
+        self.outputs = Model(model.input, [model.get_layer('beats').output, model.get_layer('downbeats').output,
+                                           model.get_layer('tcn_merge_skip_connections').output])
+        self.tempo_weights = model.get_layer('tempo_dense').get_weights()
+
+    def chunks(self, num_frames):
+        """Split a track into chunks.
+
+        Args:
+            num_frames: number of (output) frames of the track
+
+        Returns:
+            list: (start, stop) of the output frames and of the (padded) input
+                frames of each chunk
+        """
+        chunks = []
+        for start in range(0, num_frames, self.chunk_size):
+            stop = min(start + self.chunk_size, num_frames)
+            chunks.append(((start, stop), (max(0, start - self.context),
+                                           min(num_frames, stop + self.context) + self.frames_lost)))
+        return chunks
+
+    def forward(self, x):
+        """Compute the activations of a single track.
+
+        Args:
+            x: (padded) features with shape (frames x bins), a trailing
+                channel axis is allowed
+
+        Returns:
+            tuple: beat, downbeat (frames) and tempo (bins) activations
+        """
+        num_frames = len(x) - self.frames_lost
+        beats = np.empty(num_frames, dtype=np.float32)
+        downbeats = np.empty(num_frames, dtype=np.float32)
+        skip = 0
+        # batch chunks of the same length
+        groups = {}
+        for chunk in self.chunks(num_frames):
+            (_, _), (start, stop) = chunk
+            groups.setdefault(stop - start, []).append(chunk)
+        for chunks in groups.values():
+            for i in range(0, len(chunks), self.batch_size):
+                batch = chunks[i:i + self.batch_size]
+                x_batch = np.stack([x[start:stop] for _, (start, stop) in batch])
+                x_batch = x_batch.reshape(x_batch.shape[:3] + (-1,))
+                beats_act, downbeats_act, skip_act = self.outputs.predict(x_batch, batch_size=len(batch), verbose=0)
+                # keep only the frames seeing their full context
+                for j, ((start, stop), (offset, _)) in enumerate(batch):
+                    frames = slice(start - offset, stop - offset)
+                    beats[start:stop] = beats_act[j, frames, 0]
+                    downbeats[start:stop] = downbeats_act[j, frames, 0]
+                    skip = skip + np.sum(skip_act[j, frames], axis=0, dtype=np.float64)
+        # same as GlobalAveragePooling1D and tempo_dense (noise and dropout are only active during training)
+        kernel, bias = self.tempo_weights
+        tempo = softmax(np.dot(skip / num_frames, kernel) + bias).astype(np.float32)
+        return beats, downbeats, tempo
+
+    def predict(self, x, batch_size=None, verbose=0):
+        """Same as Keras' `model.predict`, i.e. return beat, downbeat and tempo activations of a batch."""
+        beats, downbeats, tempo = zip(*(self.forward(item) for item in x))
+        return np.stack(beats)[..., np.newaxis], np.stack(downbeats)[..., np.newaxis], np.stack(tempo)
@@ -0,0 +1,958 @@
+"""Dataset handling (features and targets) for training the multi-task TCN of the notebook."""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+
+import numpy as np
+import keras
+import madmom
+from keras.utils import Sequence
+from scipy.ndimage import maximum_filter1d
+
+from .tempo import MASK_VALUE, infer_tempo
+
+NUM_TEMPO_BINS = 300
+
+
+def cnn_pad(data, pad_frames):
+    """Pad the data by repeating the first and last frame N times."""
+    pad_start = np.repeat(data[:1], pad_frames, axis=0)
+    pad_stop = np.repeat(data[-1:], pad_frames, axis=0)
+    return np.concatenate((pad_start, data, pad_stop))
+
+
+class BatchBuffer:
+    """Re-usable memory for batches.
+
+    Arrays are views into pre-allocated storage, which is only re-allocated
+    if a larger array is requested, i.e. batches of (at most) the same size
+    do not allocate any memory.
+    """
+
+    def __init__(self):
+        self.storage = {}
+
+    def array(self, name, shape, fill=None, dtype=np.float32):
+        """Return an array of the given shape (filled with `fill` if given)."""
+        size = int(np.prod(shape))
+        storage = self.storage.get(name)
+        if storage is None or storage.size < size or storage.dtype != dtype:
+            storage = self.storage[name] = np.empty(size, dtype=dtype)
+        array = storage[:size].reshape(shape)
+        if fill is not None:
+            array.fill(fill)
+        return array
+
+
+def fill_batch(x_batch, y_batch, i, track, pad_frames=0):
+    """Copy the features (padded as `cnn_pad` does) and targets of a track into row `i` of a batch.
+
+    Args:
+        x_batch: features of the batch (items x frames x bins x 1)
+        y_batch: dictionary with the targets of the batch
+        i: row of the batch
+        track: tuple with the features, beat, downbeat and tempo targets of the track
+        pad_frames: number of frames to pad the features with
+
+    Returns:
+        int: number of frames of the targets
+    """
+    x, beats, downbeats, tempo = track
+    num_frames = len(x)
+    x_batch[i, :pad_frames, :, 0] = x[0]
+    x_batch[i, pad_frames:pad_frames + num_frames, :, 0] = x
+    x_batch[i, pad_frames + num_frames:pad_frames * 2 + num_frames, :, 0] = x[-1]
+    y_batch['beats'][i, :num_frames, 0] = beats
+    y_batch['downbeats'][i, :num_frames, 0] = downbeats
+    y_batch['tempo'][i] = tempo
+    return num_frames
+
+
+def allocate_batch(buffer, num_items, num_frames, num_bins, num_tempo_bins, pad_frames=0):
+    """Allocate a batch (features and targets) in the given `BatchBuffer`; targets are masked."""
+    x_batch = buffer.array('x', (num_items, num_frames + 2 * pad_frames, num_bins, 1))
+    y_batch = {'beats': buffer.array('beats', (num_items, num_frames, 1), MASK_VALUE),
+               'downbeats': buffer.array('downbeats', (num_items, num_frames, 1), MASK_VALUE),
+               'tempo': buffer.array('tempo', (num_items, num_tempo_bins))}
+    return x_batch, y_batch
+
+
+def receptive_field(num_dilations=11, kernel_size=5):
+    """Receptive field (in frames, to each side) of a frame of the model created by `create_model`.
+
+    The convolutional front end sees 2 neighbouring frames to each side (that
+    is what `pad_frames=2` accounts for), each TCN residual block two dilated
+    convolutions with dilation rates `d` and `2d`.
+    """
+    dilations = 2 ** np.arange(num_dilations)
+    return 2 + int(np.sum((kernel_size - 1) // 2 * 2 * dilations))
+
+
+def track_data(key, track, pre_processor, num_tempo_bins=NUM_TEMPO_BINS):
+    """Compute the features and (quantized) targets of a single track.
+
+    Same as the body of the loop in `DataSequence.__init__` of the notebook,
+    i.e. tracks without beats are skipped, missing downbeats and invalid tempi
+    are masked.
+
+    Args:
+        key: name of the track (used for messages only)
+        track: mirdata track
+        pre_processor: pre-processor computing the features
+        num_tempo_bins: number of tempo bins (i.e. max. tempo)
+
+    Returns:
+        dict: features ('x'), targets ('beats', 'downbeats', 'tempo') and
+            annotated beat and downbeat times ('beat_times', 'downbeat_times'),
+            None if the track has no beat information
+    """
+    try:
+        # use track only if it contains beats
+        beats = beat_times = track.beats.times
+        # wrap librosa wav data & sample rate as Signal
+        s = madmom.audio.Signal(*track.audio)
+        # compute features first to be able to quantize beats
+        x = pre_processor(s)
+        # quantize beats
+        beats = madmom.utils.quantize_events(beats, fps=pre_processor.fps, length=len(x))
+    except AttributeError:
+        # no beats found, skip this file
+        print(f'\r{key} has no beat information, skipping\n')
+        return None
+    # downbeats
+    try:
+        downbeat_times = track.beats.positions.astype(int) == 1
+        downbeat_times = track.beats.times[downbeat_times]
+        downbeats = madmom.utils.quantize_events(downbeat_times, fps=pre_processor.fps, length=len(x))
+    except AttributeError:
+        print(f'\r{key} has no downbeat information, masking\n')
+        downbeat_times = None
+        downbeats = np.ones(len(x), dtype='float32') * MASK_VALUE
+    # tempo
+    tempo = tempo_target(key, beat_times, pre_processor.fps, num_tempo_bins)
+    return {'x': x, 'beats': beats, 'downbeats': downbeats, 'tempo': tempo, 'beat_times': beat_times,
+            'downbeat_times': downbeat_times}
+
+
+def tempo_target(key, beat_times, fps, num_tempo_bins=NUM_TEMPO_BINS):
+    """One-hot encoded tempo target (inferred from the beats) of a track with features at `fps`."""
+    tempo = None
+    try:
+        # Note: to be able to augment a dataset, we need to scale the beat times
+        tempo = infer_tempo(beat_times * fps / 100, fps=fps)
+        return keras.utils.to_categorical(int(np.round(tempo)), num_classes=num_tempo_bins, dtype='float32')
+    except IndexError:
+        # tempo out of bounds (too high)
+        print(f'\r{key} has no valid tempo ({tempo}), masking\n')
+        return np.ones(num_tempo_bins, dtype='float32') * MASK_VALUE
+
+
+def resample_frames(x, factor):
+    """Resample features along the time axis by linear interpolation.
+
+    Frame `i` of the result corresponds to (fractional) frame `i / factor` of
+    `x`, i.e. features computed with a frame rate `factor` times higher.
+    """
+    num_frames = max(1, int(round(len(x) * factor)))
+    positions = np.minimum(np.arange(num_frames) / factor, len(x) - 1)
+    left = np.minimum(positions.astype(int), len(x) - 2) if len(x) > 1 else np.zeros(num_frames, dtype=int)
+    weights = (positions - left)[:, np.newaxis].astype(np.float32)
+    right = np.minimum(left + 1, len(x) - 1)
+    return (1 - weights) * x[left] + weights * x[right]
+
+
+def augment_tempo(key, data, fps, source_fps, num_tempo_bins=NUM_TEMPO_BINS):
+    """Derive tempo-scaled features and targets from those of another frame rate.
+
+    Instead of computing the features again with `PreProcessor(fps=fps)`,
+    the features computed at `source_fps` are resampled along the time axis;
+    the targets are computed from the annotated beat and downbeat times the
+    same way as for the original features. The higher `source_fps`, the closer
+    the resampled features resemble those computed directly.
+
+    Args:
+        key: name of the track (used for messages only)
+        data: features and targets of the track (see `track_data`)
+        fps: frame rate of the tempo-scaled features
+        source_fps: frame rate of the features in `data`
+        num_tempo_bins: number of tempo bins (i.e. max. tempo)
+
+    Returns:
+        dict: tempo-scaled features and targets
+    """
+    x = resample_frames(data['x'], fps / source_fps)
+    beats = madmom.utils.quantize_events(data['beat_times'], fps=fps, length=len(x))
+    if data['downbeat_times'] is None:
+        downbeats = np.ones(len(x), dtype='float32') * MASK_VALUE
+    else:
+        downbeats = madmom.utils.quantize_events(data['downbeat_times'], fps=fps, length=len(x))
+    tempo = tempo_target(key, data['beat_times'], fps, num_tempo_bins)
+    return {'x': x, 'beats': beats, 'downbeats': downbeats, 'tempo': tempo, 'beat_times': data['beat_times'],
+            'downbeat_times': data['downbeat_times']}
+
+
+def widen_targets(y, size=3, value=0.5):
+    """Widen the (non-masked) targets in place, i.e. give neighbouring frames / bins the given value."""
+    # skip masked targets
+    if np.allclose(y, MASK_VALUE):
+        return y
+    np.maximum(y, maximum_filter1d(y, size=size) * value, out=y)
+    return y
+
+
+def process_tracks(tracks, pre_processor, num_tempo_bins=NUM_TEMPO_BINS, num_workers=1):
+    """Compute features and targets of all tracks.
+
+    With `num_workers` > 1, the tracks are split into chunks which are
+    processed by a pool of worker processes. Results are yielded in the order
+    of `tracks` nevertheless, i.e. independently of the number of workers.
+
+    Args:
+        tracks: dictionary with mirdata tracks
+        pre_processor: pre-processor computing the features
+        num_tempo_bins: number of tempo bins (i.e. max. tempo)
+        num_workers: number of worker processes (None: number of CPU cores)
+
+    Yields:
+        tuple: name and data (see `track_data`) of all tracks with beat information
+    """
+    keys = list(tracks)
+    num_workers = os.cpu_count() if num_workers is None else num_workers
+    if num_workers > 1 and len(keys) > 1:
+        executor = ProcessPoolExecutor(num_workers)
+        # a few chunks per worker to balance the load, but keep inter-process communication low
+        chunksize = max(1, len(keys) // (4 * num_workers))
+        results = executor.map(track_data, keys, [tracks[key] for key in keys], repeat(pre_processor),
+                               repeat(num_tempo_bins), chunksize=chunksize)
+    else:
+        executor = None
+        results = (track_data(key, tracks[key], pre_processor, num_tempo_bins) for key in keys)
+    try:
+        for i, (key, data) in enumerate(zip(keys, results)):
+            # print progress
+            sys.stderr.write(f'\rprocessing track {i + 1}/{len(keys)}: {key + " " * 20}')
+            sys.stderr.flush()
+            if data is not None:
+                yield key, data
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+class FeatureStore:
+    """Persistent, memory-mapped store of the features and targets of a dataset.
+
+    Features and targets of all tracks are stored (as float32) one after the
+    other in a single data file, an index holds the offsets and shapes of
+    each track. The annotated beat and downbeat times (needed to derive
+    targets for other frame rates) are kept in a second file. Opening a
+    store only reads the index; the arrays returned are views into the
+    memory-mapped file, i.e. data is read from disk (and kept in the OS page
+    cache) only when accessed.
+
+    The file is mapped copy-on-write by default, thus targets can be modified
+    in place (e.g. by widening them) without altering the store.
+
+    Args:
+        path: directory of the store
+        mode: mode used to memory-map the data file
+    """
+
+    DATA_FILE = 'data.f32'
+    ANNOTATION_FILE = 'annotations.f64'
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, path, mode='c'):
+        self.path = os.path.expanduser(path)
+        with open(os.path.join(self.path, self.INDEX_FILE)) as f:
+            index = json.load(f)
+        self.num_tempo_bins = index['num_tempo_bins']
+        self.fps = index['fps']
+        self.index = index['tracks']
+        self.mode = mode
+        self._data = None
+        self._annotations = None
+
+    @classmethod
+    def create(cls, path, tracks, pre_processor, num_tempo_bins=NUM_TEMPO_BINS, num_workers=1):
+        """Compute the features and targets of all tracks and write them to a new store.
+
+        Args:
+            path: directory of the store (must not exist)
+            tracks: dictionary with mirdata tracks
+            pre_processor: pre-processor computing the features
+            num_tempo_bins: number of tempo bins (i.e. max. tempo)
+            num_workers: number of worker processes (None: number of CPU cores)
+
+        Returns:
+            FeatureStore: the newly created store
+        """
+        return cls.write(path, process_tracks(tracks, pre_processor, num_tempo_bins, num_workers),
+                         pre_processor.fps, num_tempo_bins)
+
+    @classmethod
+    def write(cls, path, items, fps, num_tempo_bins=NUM_TEMPO_BINS):
+        """Write (name, data) pairs as returned by `process_tracks` to a new store."""
+        path = os.path.expanduser(path)
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        # write to a temporary directory first so that no partial stores are left behind
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp')
+        try:
+            index = {}
+            offset = annotation_offset = 0
+            with open(os.path.join(tmp, cls.DATA_FILE), 'wb') as f, \
+                    open(os.path.join(tmp, cls.ANNOTATION_FILE), 'wb') as g:
+                for key, data in items:
+                    downbeat_times = data['downbeat_times']
+                    index[key] = {'offset': offset, 'shape': list(np.shape(data['x'])),
+                                  'annotation_offset': annotation_offset, 'num_beats': len(data['beat_times']),
+                                  'num_downbeats': None if downbeat_times is None else len(downbeat_times)}
+                    for name in ('x', 'beats', 'downbeats', 'tempo'):
+                        array = np.ascontiguousarray(data[name], dtype=np.float32)
+                        f.write(array.tobytes())
+                        offset += array.size
+                    for times in (data['beat_times'], downbeat_times):
+                        if times is not None:
+                            g.write(np.ascontiguousarray(times, dtype=np.float64).tobytes())
+                            annotation_offset += len(times)
+            with open(os.path.join(tmp, cls.INDEX_FILE), 'w') as f:
+                json.dump({'fps': fps, 'num_tempo_bins': num_tempo_bins, 'tracks': index}, f)
+            os.rename(tmp, path)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        return cls(path)
+
+    def _memmap(self, filename, dtype):
+        filename = os.path.join(self.path, filename)
+        if os.path.getsize(filename) == 0:
+            # empty files cannot be memory-mapped
+            return np.empty(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode=self.mode)
+
+    @property
+    def data(self):
+        """Memory-mapped data file (mapped on first access)."""
+        if self._data is None:
+            self._data = self._memmap(self.DATA_FILE, np.float32)
+        return self._data
+
+    @property
+    def annotations(self):
+        """Memory-mapped annotation file (mapped on first access)."""
+        if self._annotations is None:
+            self._annotations = self._memmap(self.ANNOTATION_FILE, np.float64)
+        return self._annotations
+
+    @property
+    def ids(self):
+        return list(self.index)
+
+    @property
+    def num_bins(self):
+        """Number of frequency bins of the features (the same for all tracks)."""
+        return next(iter(self.index.values()))['shape'][1] if self.index else None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, key):
+        """Return the features, targets and annotations of a track as a dictionary of memory-mapped arrays."""
+        entry = self.index[key]
+        offset = entry['offset']
+        num_frames, num_bins = entry['shape']
+        sizes = {'x': num_frames * num_bins, 'beats': num_frames, 'downbeats': num_frames,
+                 'tempo': self.num_tempo_bins}
+        arrays = {}
+        for name, size in sizes.items():
+            arrays[name] = self.data[offset:offset + size]
+            offset += size
+        arrays['x'] = arrays['x'].reshape(num_frames, num_bins)
+        offset, num_beats, num_downbeats = entry['annotation_offset'], entry['num_beats'], entry['num_downbeats']
+        arrays['beat_times'] = self.annotations[offset:offset + num_beats]
+        offset += num_beats
+        arrays['downbeat_times'] = None if num_downbeats is None else self.annotations[offset:offset + num_downbeats]
+        return arrays
+
+
+class DataSequence(Sequence):
+    """Training/test data wrapped as a Keras sequence.
+
+    Same as `DataSequence` of the notebook, i.e. a batch size of 1 is used,
+    but the dataset can also be loaded from a `FeatureStore` (see
+    `from_store`) instead of computing the features of all tracks.
+
+    Args:
+        tracks: dictionary with mirdata tracks
+        pre_processor: pre-processor computing the features
+        num_tempo_bins: number of tempo bins (i.e. max. tempo)
+        pad_frames: number of frames to pad the features with
+        num_workers: number of worker processes used to compute the features
+            and targets (None: number of CPU cores)
+    """
+
+    def __init__(self, tracks, pre_processor, num_tempo_bins=NUM_TEMPO_BINS, pad_frames=None, num_workers=1):
+        # store features and targets in dictionaries with name of the song as key
+        self.x = {}
+        self.beats = {}
+        self.downbeats = {}
+        self.tempo = {}
+        self.pad_frames = pad_frames
+        self.ids = []
+        for key, data in process_tracks(tracks, pre_processor, num_tempo_bins, num_workers):
+            self.add(key, data)
+        assert len(self.x) == len(self.beats) == len(self.downbeats) == len(self.tempo) == len(self.ids)
+
+    @classmethod
+    def from_store(cls, store, pad_frames=None, ids=None, fps=None):
+        """Create a sequence from a `FeatureStore`.
+
+        No data is read from disk until it is accessed, i.e. a sequence is
+        created almost instantly and memory usage is bounded by the OS page
+        cache instead of the size of the dataset.
+
+        If `fps` differs from the frame rate of the store, tempo-scaled
+        features and targets are derived with `augment_tempo` (and kept in
+        memory) and the frame rate is appended to the names of the tracks,
+        i.e. the same as computing a `DataSequence` with `PreProcessor(fps=fps)`
+        for data augmentation. See `TempoAugmentedSequence` for deriving them
+        on the fly instead.
+
+        Args:
+            store: `FeatureStore` or its path
+            pad_frames: number of frames to pad the features with
+            ids: names of the tracks to use (None: all tracks of the store)
+            fps: frame rate of the features (None: frame rate of the store)
+
+        Returns:
+            DataSequence: sequence with (memory-mapped) features and targets
+        """
+        if not isinstance(store, FeatureStore):
+            store = FeatureStore(store)
+        sequence = cls({}, None, pad_frames=pad_frames)
+        for key in store.ids if ids is None else ids:
+            if fps is None or fps == store.fps:
+                sequence.add(key, store[key])
+            else:
+                sequence.add(f'{key}_{fps}', augment_tempo(key, store[key], fps, store.fps, store.num_tempo_bins))
+        return sequence
+
+    def add(self, key, data):
+        """Add the features and targets of a track."""
+        self.x[key] = data['x']
+        self.beats[key] = data['beats']
+        self.downbeats[key] = data['downbeats']
+        self.tempo[key] = data['tempo']
+        # keep track of IDs
+        self.ids.append(key)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def lengths(self):
+        """Lengths (in frames, including padding) of the features of all tracks."""
+        return [len(self.x[key]) + 2 * (self.pad_frames or 0) for key in self.ids]
+
+    def __getitem__(self, idx):
+        # convert int idx to key
+        if isinstance(idx, int):
+            idx = self.ids[idx]
+        # Note: we always use a batch size of 1 since the tracks have variable length
+        #       keras expects the batch to be the first dimension, the prepend an axis;
+        #       append an axis to beats and downbeats as well
+        # define targets
+        y = {}
+        y['beats'] = self.beats[idx][np.newaxis, ..., np.newaxis]
+        y['downbeats'] = self.downbeats[idx][np.newaxis, ..., np.newaxis]
+        y['tempo'] = self.tempo[idx][np.newaxis, ...]
+        # add context to frames
+        x = self.x[idx]
+        if self.pad_frames:
+            x = cnn_pad(x, self.pad_frames)
+        return x[np.newaxis, ..., np.newaxis], y
+
+    def track(self, idx):
+        """Return the (unpadded) features, beat, downbeat and tempo targets of a track."""
+        key = self.ids[idx] if isinstance(idx, int) else idx
+        return self.x[key], self.beats[key], self.downbeats[key], self.tempo[key]
+
+    def load(self, idx, buffer):
+        """Same as `__getitem__`, but the batch is put into the given `BatchBuffer`."""
+        x, beats, downbeats, tempo = track = self.track(idx)
+        x_batch, y_batch = allocate_batch(buffer, 1, len(x), x.shape[1], len(tempo), self.pad_frames or 0)
+        fill_batch(x_batch, y_batch, 0, track, self.pad_frames or 0)
+        return x_batch, y_batch
+
+    def widen_beat_targets(self, size=3, value=0.5):
+        for y in self.beats.values():
+            widen_targets(y, size, value)
+
+    def widen_downbeat_targets(self, size=3, value=0.5):
+        for y in self.downbeats.values():
+            widen_targets(y, size, value)
+
+    def widen_tempo_targets(self, size=3, value=0.5):
+        for y in self.tempo.values():
+            widen_targets(y, size, value)
+
+    def append(self, other):
+        assert not any(key in self.ids for key in other.ids), 'IDs must be unique'
+        self.x.update(other.x)
+        self.beats.update(other.beats)
+        self.downbeats.update(other.downbeats)
+        self.tempo.update(other.tempo)
+        self.ids.extend(other.ids)
+
+
+class TempoAugmentedSequence(Sequence):
+    """Tempo-augmented training data, derived on the fly from a `FeatureStore`.
+
+    Instead of keeping a copy of the features for each augmentation factor,
+    the tempo-scaled features and targets are derived from the stored ones
+    (see `augment_tempo`) whenever an item is requested, i.e. memory does not
+    grow with the number of frame rates.
+
+    By default, all tracks are included at the original frame rate of the
+    store and at all given frame rates (the same as appending a
+    `DataSequence` for each of them). If `sample` is set, each track is
+    included only once per epoch with a randomly chosen frame rate instead.
+
+    The targets are widened the same way as in the notebook (if `widen` is
+    set).
+
+    Args:
+        store: `FeatureStore` or its path
+        fps: frame rates to derive
+        pad_frames: number of frames to pad the features with
+        ids: names of the tracks to use (None: all tracks of the store)
+        include_original: include the features at the frame rate of the store
+        sample: choose a random frame rate per track and epoch
+        widen: widen the targets
+        seed: random seed used for sampling the frame rates
+    """
+
+    def __init__(self, store, fps=(95, 97.5, 102.5, 105), pad_frames=None, ids=None, include_original=True,
+                 sample=False, widen=True, seed=None):
+        if not isinstance(store, FeatureStore):
+            store = FeatureStore(store)
+        self.store = store
+        self.keys = store.ids if ids is None else list(ids)
+        self.fps = ([store.fps] if include_original else []) + [f for f in fps if f != store.fps]
+        self.pad_frames = pad_frames
+        self.sample = sample
+        self.widen = widen
+        self.rng = np.random.RandomState(seed)
+        self.on_epoch_end()
+
+    def on_epoch_end(self):
+        """Choose the tracks (and frame rates) of the next epoch."""
+        if self.sample:
+            self.items = [(key, self.fps[self.rng.randint(len(self.fps))]) for key in self.keys]
+        else:
+            self.items = [(key, fps) for fps in self.fps for key in self.keys]
+
+    @property
+    def ids(self):
+        return [key if fps == self.store.fps else f'{key}_{fps}' for key, fps in self.items]
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def lengths(self):
+        """Lengths (in frames, including padding) of the features of all items of the current epoch."""
+        lengths = []
+        for key, fps in self.items:
+            num_frames = self.store.index[key]['shape'][0]
+            if fps != self.store.fps:
+                # same as `resample_frames`
+                num_frames = max(1, int(round(num_frames * fps / self.store.fps)))
+            lengths.append(num_frames + 2 * (self.pad_frames or 0))
+        return lengths
+
+    def track(self, idx):
+        """Return the (unpadded) features, beat, downbeat and tempo targets of an item."""
+        key, fps = self.items[idx]
+        data = self.store[key]
+        if fps != self.store.fps:
+            data = augment_tempo(key, data, fps, self.store.fps, self.store.num_tempo_bins)
+        # copy targets, they are modified in place when being widened
+        beats = np.array(data['beats'], dtype=np.float32)
+        downbeats = np.array(data['downbeats'], dtype=np.float32)
+        tempo = np.array(data['tempo'], dtype=np.float32)
+        if self.widen:
+            widen_targets(beats)
+            widen_targets(downbeats)
+            widen_targets(widen_targets(tempo))
+        return data['x'], beats, downbeats, tempo
+
+    def load(self, idx, buffer):
+        """Same as `__getitem__`, but the batch is put into the given `BatchBuffer`."""
+        x, beats, downbeats, tempo = track = self.track(idx)
+        x_batch, y_batch = allocate_batch(buffer, 1, len(x), x.shape[1], len(tempo), self.pad_frames or 0)
+        fill_batch(x_batch, y_batch, 0, track, self.pad_frames or 0)
+        return x_batch, y_batch
+
+    def __getitem__(self, idx):
+        return self.load(idx, BatchBuffer())
+
+
+class CropSequence(Sequence):
+    """Mini-batches of fixed-length excerpts of the tracks of a `DataSequence`.
+
+    Every epoch, `crops_per_track` excerpts of `crop_length` frames are
+    sampled at random positions of each track. Each excerpt is extended by
+    `context` frames to each side; the features of the context are given to
+    the network, but the beat and downbeat targets are masked (`MASK_VALUE`),
+    hence every frame contributing to the loss is seen with at least this
+    much context. Frames outside the track are padded (features by repeating
+    the first/last frame, targets masked). The tempo target stays the one of
+    the whole track.
+
+    All batches have the same shape, i.e. the time per training step does
+    not depend on the length of the tracks. There is no default context,
+    since it depends on the model: `receptive_field(num_dilations,
+    kernel_size)` gives every frame with a target its full context (as when
+    training on whole tracks), but with the dilations of the notebook it
+    exceeds the length of most tracks; a smaller context trades accuracy at
+    the borders of the excerpts for shorter batches.
+
+    Args:
+        sequence: `DataSequence` (features and targets possibly memory-mapped)
+        context: number of context frames to each side of an excerpt (e.g.
+            `receptive_field(...)` of the model)
+        crop_length: number of frames (with targets) per excerpt
+        batch_size: number of excerpts per batch
+        crops_per_track: number of excerpts per track and epoch
+        seed: random seed used for sampling the excerpts
+    """
+
+    def __init__(self, sequence, context, crop_length=1000, batch_size=8, crops_per_track=1, seed=None):
+        self.sequence = sequence
+        self.crop_length = crop_length
+        self.context = context
+        self.batch_size = batch_size
+        self.crops_per_track = crops_per_track
+        self.pad_frames = sequence.pad_frames or 0
+        self.rng = np.random.RandomState(seed)
+        self.on_epoch_end()
+
+    def on_epoch_end(self):
+        """Sample the excerpts of the next epoch."""
+        crops = []
+        for key in self.sequence.ids:
+            num_frames = len(self.sequence.beats[key])
+            starts = self.rng.randint(max(1, num_frames - self.crop_length + 1), size=self.crops_per_track)
+            crops.extend((key, start) for start in starts)
+        self.crops = [crops[i] for i in self.rng.permutation(len(crops))]
+
+    def __len__(self):
+        return int(np.ceil(len(self.crops) / self.batch_size))
+
+    def __getitem__(self, idx):
+        return self.load(idx, BatchBuffer())
+
+    def load(self, idx, buffer):
+        """Same as `__getitem__`, but the batch is put into the given `BatchBuffer`."""
+        crops = self.crops[idx * self.batch_size:(idx + 1) * self.batch_size]
+        window = self.crop_length + 2 * self.context
+        key = crops[0][0]
+        x_batch, y_batch = allocate_batch(buffer, len(crops), window, self.sequence.x[key].shape[1],
+                                          len(self.sequence.tempo[key]), self.pad_frames)
+        for i, (key, start) in enumerate(crops):
+            x = self.sequence.x[key]
+            num_frames = len(x)
+            # features of the excerpt, its context and the frames needed by the convolutional front end
+            first = start - self.context - self.pad_frames
+            frames = np.clip(np.arange(first, first + len(x_batch[i])), 0, num_frames - 1)
+            x_batch[i, ..., 0] = x[frames]
+            # targets of the excerpt only
+            stop = min(start + self.crop_length, num_frames)
+            y_batch['beats'][i, self.context:self.context + stop - start, 0] = self.sequence.beats[key][start:stop]
+            y_batch['downbeats'][i, self.context:self.context + stop - start, 0] = \
+                self.sequence.downbeats[key][start:stop]
+            y_batch['tempo'][i] = self.sequence.tempo[key]
+        return x_batch, y_batch
+
+
+def bucket_batches(lengths, batch_size, boundaries=None, max_padding=0.25, rng=None):
+    """Group items of similar length into batches.
+
+    Items are sorted by length and consecutive items are put into the same
+    batch as long as the batch is not full, all items fall into the same
+    bucket (if `boundaries` are given) and the fraction of padded frames of
+    the batch does not exceed `max_padding`.
+
+    Args:
+        lengths: lengths of the items
+        batch_size: maximum number of items per batch
+        boundaries: bucket boundaries (lengths); batches never span buckets
+        max_padding: maximum fraction of padded frames per batch
+        rng: random state used to break ties between items of the same length
+            (None: keep the original order)
+
+    Returns:
+        list: indices of the items of each batch
+    """
+    lengths = np.asarray(lengths)
+    ties = np.arange(len(lengths)) if rng is None else rng.permutation(len(lengths))
+    order = np.lexsort((ties, lengths))
+    buckets = np.zeros(len(lengths), dtype=int) if boundaries is None else np.digitize(lengths, boundaries)
+    batches, batch = [], []
+    for idx in order:
+        if batch:
+            # the current item is the longest of the batch, since items are sorted
+            total = lengths[idx] * (len(batch) + 1)
+            padding = 1 - (np.sum(lengths[batch]) + lengths[idx]) / total
+            if len(batch) == batch_size or buckets[idx] != buckets[batch[0]] or padding > max_padding:
+                batches.append(np.array(batch))
+                batch = []
+        batch.append(idx)
+    if batch:
+        batches.append(np.array(batch))
+    return batches
+
+
+class BucketedSequence(Sequence):
+    """Mini-batches of tracks of similar length.
+
+    Wraps a `DataSequence` (or `TempoAugmentedSequence`), groups its tracks
+    into length buckets (see `bucket_batches`) and yields real mini-batches
+    instead of a single track per batch. Shorter tracks are padded: targets
+    with `MASK_VALUE`, i.e. they are ignored by the masked losses, features
+    by repeating the last frame (or with `pad_value`).
+
+    Note: the tempo output of the network averages over all frames, thus
+    includes the padded ones; `max_padding` bounds this effect.
+
+    Args:
+        sequence: sequence yielding single tracks
+        batch_size: maximum number of tracks per batch
+        boundaries: bucket boundaries (in frames)
+        max_padding: maximum fraction of padded frames per batch
+        shuffle: shuffle the tracks of equal length and the order of the batches every epoch
+        pad_value: value used to pad the features (None: repeat the last frame)
+        seed: random seed used for shuffling
+    """
+
+    def __init__(self, sequence, batch_size=8, boundaries=None, max_padding=0.25, shuffle=True, pad_value=None,
+                 seed=None):
+        self.sequence = sequence
+        self.batch_size = batch_size
+        self.boundaries = boundaries
+        self.max_padding = max_padding
+        self.shuffle = shuffle
+        self.pad_value = pad_value
+        self.rng = np.random.RandomState(seed)
+        self.batches = self._bucket()
+
+    def _bucket(self):
+        self.lengths = np.asarray(self.sequence.lengths)
+        batches = bucket_batches(self.lengths, self.batch_size, self.boundaries, self.max_padding,
+                                 self.rng if self.shuffle else None)
+        if self.shuffle:
+            self.rng.shuffle(batches)
+        return batches
+
+    def on_epoch_end(self):
+        """Re-bucket the tracks (of the next epoch of the wrapped sequence)."""
+        if hasattr(self.sequence, 'on_epoch_end'):
+            self.sequence.on_epoch_end()
+        self.batches = self._bucket()
+
+    def __len__(self):
+        return len(self.batches)
+
+    @property
+    def padding(self):
+        """Fraction of padded frames over all batches."""
+        total = sum(len(batch) * np.max(self.lengths[batch]) for batch in self.batches)
+        return 1 - np.sum(self.lengths) / total
+
+    def batch_ids(self, idx):
+        """Names of the tracks of the given batch."""
+        ids = self.sequence.ids
+        return [ids[i] for i in self.batches[idx]]
+
+    def __getitem__(self, idx):
+        return self.load(idx, BatchBuffer())
+
+    def load(self, idx, buffer):
+        """Same as `__getitem__`, but the batch is put into the given `BatchBuffer`."""
+        tracks = [self.sequence.track(int(i)) for i in self.batches[idx]]
+        pad_frames = self.sequence.pad_frames or 0
+        # allocate the padded batch
+        num_frames = max(len(x) for x, _, _, _ in tracks)
+        x_batch, y_batch = allocate_batch(buffer, len(tracks), num_frames, tracks[0][0].shape[1],
+                                          len(tracks[0][3]), pad_frames)
+        for i, track in enumerate(tracks):
+            length = fill_batch(x_batch, y_batch, i, track, pad_frames)
+            x_batch[i, length + 2 * pad_frames:] = x_batch[i, length + 2 * pad_frames - 1] \
+                if self.pad_value is None else self.pad_value
+        return x_batch, y_batch
+
+
+def batching_throughput(model, sequence, batch_sizes=(1, 4, 8, 16), mode='train', max_padding=0.25,
+                        boundaries=None, num_epochs=1):
+    """Measure the throughput of training (or prediction) with length-bucketed mini-batches.
+
+    Args:
+        model: compiled Keras model
+        sequence: sequence yielding single tracks (e.g. `DataSequence`)
+        batch_sizes: batch sizes to compare
+        mode: 'train' (`train_on_batch`) or 'predict' (`predict_on_batch`)
+        max_padding: maximum fraction of padded frames per batch
+        boundaries: bucket boundaries (in frames)
+        num_epochs: number of passes over the sequence per batch size
+
+    Returns:
+        dict: for each batch size the number of batches, the fraction of
+            padded frames, tracks/sec and the speedup relative to a batch
+            size of 1
+    """
+    results = {}
+    for batch_size in batch_sizes:
+        batches = BucketedSequence(sequence, batch_size, boundaries, max_padding, shuffle=False)
+        # warm up (graph building etc.)
+        x, y = batches[0]
+        model.train_on_batch(x, y) if mode == 'train' else model.predict_on_batch(x)
+        start = time.perf_counter()
+        for _ in range(num_epochs):
+            for i in range(len(batches)):
+                x, y = batches[i]
+                model.train_on_batch(x, y) if mode == 'train' else model.predict_on_batch(x)
+        duration = time.perf_counter() - start
+        results[batch_size] = {'num_batches': len(batches), 'padding': batches.padding,
+                               'tracks_per_sec': num_epochs * len(sequence) / duration}
+    # speedup relative to a batch size of 1 (or the first batch size given)
+    reference = results[1 if 1 in results else batch_sizes[0]]['tracks_per_sec']
+    for result in results.values():
+        result['speedup'] = result['tracks_per_sec'] / reference
+    return results
+
+
+class PrefetchLoader:
+    """Prefetch the batches of a sequence in background threads.
+
+    Batches are loaded by `num_workers` threads (copying and padding arrays
+    with NumPy releases the GIL) into pre-allocated `BatchBuffer`s if the
+    sequence supports it (i.e. has a `load` method); at most `queue_size`
+    batches are loaded ahead. The batches are yielded in order, the order of
+    each epoch is shuffled if `shuffle` is set and the sequence's
+    `on_epoch_end` is called after each epoch.
+
+    The loader keeps statistics about how long the consumer had to wait for
+    batches (stall time) and how many batches were ready when it asked for
+    one (queue depth), see `stats`. A large fraction of time stalled means
+    that training is input-bound.
+
+    Buffers are recycled as soon as the next batch is requested, hence the
+    loader must be consumed in the main thread, i.e. use it with
+    `model.fit_generator(loader, steps_per_epoch=len(loader), workers=0)`.
+
+    Args:
+        sequence: sequence to load the batches from
+        num_workers: number of loader threads
+        queue_size: maximum number of batches loaded ahead
+        shuffle: shuffle the order of the batches every epoch
+        seed: random seed used for shuffling
+    """
+
+    def __init__(self, sequence, num_workers=2, queue_size=8, shuffle=True, seed=None):
+        self.sequence = sequence
+        self.num_workers = num_workers
+        self.queue_size = max(1, queue_size)
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        # one buffer per queued batch, plus the one handed out last
+        self.buffers = [BatchBuffer() for _ in range(self.queue_size + 1)]
+        self.lock = threading.Lock()
+        self._batches = None
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def reset_stats(self):
+        """Reset the statistics."""
+        self.num_batches = 0
+        self.stall_time = 0.0
+        self.load_time = 0.0
+        self.queue_depths = []
+        self.start_time = None
+
+    @property
+    def stats(self):
+        """Dictionary with statistics of the batches consumed so far."""
+        elapsed = time.perf_counter() - self.start_time if self.start_time is not None else 0.0
+        return {'batches': self.num_batches, 'elapsed_time': elapsed, 'stall_time': self.stall_time,
+                'stall_fraction': self.stall_time / elapsed if elapsed else 0.0,
+                'load_time': self.load_time,
+                'mean_queue_depth': float(np.mean(self.queue_depths)) if self.queue_depths else 0.0,
+                'min_queue_depth': int(np.min(self.queue_depths)) if self.queue_depths else 0}
+
+    def _load(self, idx, buffer):
+        start = time.perf_counter()
+        if hasattr(self.sequence, 'load'):
+            batch = self.sequence.load(idx, buffer)
+        else:
+            batch = self.sequence[idx]
+        with self.lock:
+            self.load_time += time.perf_counter() - start
+        return batch
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._batches is None:
+            self._batches = self._generate()
+        return next(self._batches)
+
+    def _generate(self):
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+        with ThreadPoolExecutor(self.num_workers) as executor:
+            while True:
+                order = self.rng.permutation(len(self.sequence)) if self.shuffle else np.arange(len(self.sequence))
+                order = iter(order)
+                free = deque(self.buffers)
+                pending = deque()
+                # fill the queue
+                for idx in order:
+                    buffer = free.popleft()
+                    pending.append((executor.submit(self._load, int(idx), buffer), buffer))
+                    if len(pending) == self.queue_size:
+                        break
+                while pending:
+                    # statistics: number of batches ready and time waited for the next one
+                    self.queue_depths.append(sum(future.done() for future, _ in pending))
+                    start = time.perf_counter()
+                    future, used = pending.popleft()
+                    batch = future.result()
+                    self.stall_time += time.perf_counter() - start
+                    self.num_batches += 1
+                    # keep the queue filled while the batch is being consumed
+                    idx = next(order, None)
+                    if idx is not None:
+                        buffer = free.popleft()
+                        pending.append((executor.submit(self._load, int(idx), buffer), buffer))
+                    yield batch
+                    # the next batch is requested, i.e. the buffer of this one can be re-used
+                    free.append(used)
+                # all batches of the epoch were consumed, prepare the next one
+                if hasattr(self.sequence, 'on_epoch_end'):
+                    self.sequence.on_epoch_end()
@@ -0,0 +1,167 @@
+"""Knowledge distillation of the multi-task TCN into a smaller student network.
+
+The student is trained on the (soft) beat, downbeat and tempo activations of
+the teacher, optionally blended with the annotations. The teacher's
+activations are taken from the output of `predict` (as returned or as saved
+to `detdir`), i.e. they are computed once and not in every epoch.
+
+The student is a regular `create_model` network (e.g. with fewer dilations
+or filters), thus it can be used with `predict` without any changes. It may
+also use features with fewer frequency bands (e.g. `PreProcessor(num_bands=11)`),
+as long as the conv layers reduce the frequency axis to a single bin (74 to
+100 bins); the frame rate must be the same as the teacher's.
+"""
+
+import os
+
+import numpy as np
+from keras.utils import Sequence
+
+from .data import BatchBuffer, allocate_batch, fill_batch
+from .pruning import compile_model, frames_per_second, score_model
+from .tempo import MASK_VALUE
+
+EPSILON = 1e-7
+
+
+def soften(activations, temperature=1.0, axis=None):
+    """Soften (or sharpen) activations with a temperature.
+
+    Sigmoid activations (`axis=None`) are scaled in the logit domain, softmax
+    activations in the log domain along `axis`.
+    """
+    if temperature == 1:
+        return activations
+    p = np.clip(activations, EPSILON, 1 - EPSILON)
+    if axis is None:
+        return 1 / (1 + np.exp(-np.log(p / (1 - p)) / temperature))
+    logits = np.log(p) / temperature
+    e = np.exp(logits - np.max(logits, axis=axis, keepdims=True))
+    return e / np.sum(e, axis=axis, keepdims=True)
+
+
+def load_teacher_activations(detdir, ids):
+    """Load the activations saved by `predict(..., detdir=detdir)` (memory-mapped).
+
+    Returns:
+        dict: track name -> dictionary with beat, downbeat and tempo activations
+    """
+    activations = {}
+    for key in ids:
+        activations[key] = {name: np.load(os.path.join(detdir, '%s.%s.npy' % (key, name)), mmap_mode='r')
+                            for name in ('beats', 'downbeats', 'tempo')}
+    return activations
+
+
+class DistillationSequence(Sequence):
+    """Student features with the teacher's activations as targets.
+
+    The targets are the teacher's (softened) activations, blended with the
+    annotations where they are available: `alpha` * teacher + (1 - `alpha`) *
+    annotation. Tracks (or targets) without annotations are learned from
+    the teacher alone.
+
+    Args:
+        sequence: `DataSequence` with the features (and targets) for the student
+        teacher: dictionary with the teacher's activations per track (as
+            returned by `predict` or `load_teacher_activations`)
+        alpha: weight of the teacher's activations
+        temperature: temperature used to soften the teacher's activations
+    """
+
+    def __init__(self, sequence, teacher, alpha=1.0, temperature=1.0):
+        self.sequence = sequence
+        self.teacher = teacher
+        self.alpha = alpha
+        self.temperature = temperature
+        self.pad_frames = sequence.pad_frames
+        for key in self.ids:
+            if len(teacher[key]['beats']) != len(sequence.track(key)[0]):
+                raise ValueError('frames of the teacher and the student differ for track %s' % key)
+
+    @property
+    def ids(self):
+        return self.sequence.ids
+
+    def __len__(self):
+        return len(self.sequence)
+
+    @property
+    def lengths(self):
+        return self.sequence.lengths
+
+    def _blend(self, teacher, target):
+        if self.alpha == 1:
+            return teacher
+        return np.where(target != MASK_VALUE, self.alpha * teacher + (1 - self.alpha) * target, teacher)
+
+    def track(self, idx):
+        """Return the (unpadded) features and the distillation targets of a track."""
+        key = self.ids[idx] if isinstance(idx, int) else idx
+        x, beats, downbeats, tempo = self.sequence.track(key)
+        teacher = self.teacher[key]
+        beats = self._blend(soften(np.asarray(teacher['beats']), self.temperature), beats)
+        downbeats = self._blend(soften(np.asarray(teacher['downbeats']), self.temperature), downbeats)
+        # no tempo annotation (i.e. all bins masked) means the teacher is used alone
+        tempo = self._blend(soften(np.asarray(teacher['tempo']), self.temperature, axis=-1), tempo)
+        return x, beats, downbeats, tempo
+
+    def load(self, idx, buffer):
+        """Same as `__getitem__`, but the batch is put into the given `BatchBuffer`."""
+        x, beats, downbeats, tempo = track = self.track(idx)
+        x_batch, y_batch = allocate_batch(buffer, 1, len(x), x.shape[1], len(tempo), self.pad_frames or 0)
+        fill_batch(x_batch, y_batch, 0, track, self.pad_frames or 0)
+        return x_batch, y_batch
+
+    def __getitem__(self, idx):
+        return self.load(idx, BatchBuffer())
+
+
+def distill(student, sequence, teacher, epochs=50, alpha=1.0, temperature=1.0, compile_fn=compile_model,
+            callbacks=None, verbose=0):
+    """Train a student network on the teacher's activations.
+
+    Args:
+        student: (not compiled) Keras model, e.g. `create_model(input_shape, num_dilations=8)`
+        sequence: `DataSequence` with the student's features
+        teacher: teacher activations, see `DistillationSequence`
+        epochs: number of epochs to train
+        alpha: weight of the teacher's activations (vs. the annotations)
+        temperature: temperature used to soften the teacher's activations
+        compile_fn: function compiling the student (with the masked losses)
+        callbacks: Keras callbacks (e.g. checkpointing, learn rate schedule)
+        verbose: verbosity of the training
+
+    Returns:
+        keras.callbacks.History: training history
+    """
+    train = DistillationSequence(sequence, teacher, alpha, temperature)
+    compile_fn(student)
+    return student.fit_generator(train, steps_per_epoch=len(train), epochs=epochs, shuffle=True,
+                                 callbacks=callbacks, verbose=verbose)
+
+
+def distillation_report(teacher, student, teacher_test, student_test, tracks, num_frames=6000,
+                        infer_missing_tempo=False):
+    """Compare size, throughput and performance of the teacher and the student.
+
+    Args:
+        teacher: teacher (Keras) model
+        student: student (Keras) model
+        teacher_test: test sequence with the teacher's features
+        student_test: test sequence with the student's features (may be the
+            same as `teacher_test`)
+        tracks: dictionary with mirdata tracks (i.e. the annotations)
+        num_frames: number of frames used to measure the throughput
+        infer_missing_tempo: see `evaluate`
+
+    Returns:
+        dict: number of parameters, frames/sec (NumPy runtime) and scores
+            (see `score_model`) of the teacher and the student
+    """
+    report = {}
+    for name, model, test in (('teacher', teacher, teacher_test), ('student', student, student_test)):
+        report[name] = {'params': model.count_params(), 'frames_per_sec': frames_per_second(model, num_frames)}
+        report[name].update(score_model(model, test, tracks, infer_missing_tempo=infer_missing_tempo))
+    report['speedup'] = report['student']['frames_per_sec'] / report['teacher']['frames_per_sec']
+    return report
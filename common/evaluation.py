@@ -0,0 +1,113 @@
+"""Evaluation of beat, downbeat and tempo detections (same as the notebook)."""
+
+import madmom
+
+from .tempo import infer_tempo
+
+
+def evaluate_beats(detections, annotations):
+    evals = []
+    for key, det in detections.items():
+        ann = annotations[key]
+        e = madmom.evaluation.beats.BeatEvaluation(det, ann)
+        evals.append(e)
+    return madmom.evaluation.beats.BeatMeanEvaluation(evals)
+
+
+def evaluate_downbeats(detections, annotations):
+    evals = []
+    for key, det in detections.items():
+        ann = annotations[key]
+        e = madmom.evaluation.beats.BeatEvaluation(det, ann, downbeats=True)
+        evals.append(e)
+    return madmom.evaluation.beats.BeatMeanEvaluation(evals)
+
+
+def evaluate_tempo(detections, annotations):
+    evals = []
+    for key, det in detections.items():
+        ann = annotations[key]
+        e = madmom.evaluation.tempo.TempoEvaluation(det, ann)
+        evals.append(e)
+    return madmom.evaluation.tempo.TempoMeanEvaluation(evals)
+
+
+def annotated_tempo(track, infer_missing_tempo=False):
+    """Tempo annotation of a track (None if it has none).
+
+    Args:
+        track: mirdata track
+        infer_missing_tempo: infer the tempo of tracks without a tempo
+            annotation from their beats (the same as the tempo targets used
+            for training)
+
+    Returns:
+        tuple: tempo (None if not available) and whether it was inferred
+    """
+    tempo = getattr(track, 'tempo', None)
+    if tempo is not None or not infer_missing_tempo:
+        return tempo, False
+    beats = getattr(track, 'beats', None)
+    if beats is None:
+        return None, False
+    tempo = infer_tempo(beats.times, no_tempo=None)
+    return tempo, tempo is not None
+
+
+def evaluate(detections, tracks, infer_missing_tempo=False):
+    """Evaluate the detections of `predict` against the annotations of the tracks.
+
+    Only tracks with annotations are evaluated, the same way as the notebook
+    does, i.e. beats are evaluated for the beat and downbeat tracker,
+    downbeats for the bar and downbeat tracker, tempo only if annotated.
+
+    Args:
+        detections: detections as returned by `predict`
+        tracks: dictionary with mirdata tracks
+        infer_missing_tempo: evaluate the tempo of tracks without a tempo
+            annotation against the tempo inferred from their beats; these are
+            reported separately as 'tempo_inferred'
+
+    Returns:
+        dict: `BeatMeanEvaluation` / `TempoMeanEvaluation` objects
+    """
+    beats = {k: getattr(v, 'beats', None) for k, v in tracks.items()}
+    beat_annotations = {k: v.times for k, v in beats.items() if v is not None}
+    downbeat_annotations = {k: v.times[v.positions == 1] for k, v in beats.items() if v is not None}
+    tempo_annotations, inferred_annotations = {}, {}
+    for k, v in tracks.items():
+        tempo, inferred = annotated_tempo(v, infer_missing_tempo)
+        if tempo is not None:
+            (inferred_annotations if inferred else tempo_annotations)[k] = tempo
+
+    beat_detections = {k: v['beats'] for k, v in detections.items() if k in beat_annotations}
+    downbeat_detections = {k: v['downbeats'] for k, v in detections.items() if k in beat_annotations}
+    bar_detections = {k: v['bars'] for k, v in detections.items() if k in beat_annotations}
+    tempo_detections = {k: v['tempo'][0, 0] for k, v in detections.items() if k in tempo_annotations}
+    inferred_detections = {k: v['tempo'][0, 0] for k, v in detections.items() if k in inferred_annotations}
+
+    results = {
+        'beats': evaluate_beats(beat_detections, beat_annotations),
+        'beats_downbeat_tracker': evaluate_beats(downbeat_detections, beat_annotations),
+        'downbeats_bar_tracker': evaluate_downbeats(bar_detections, downbeat_annotations),
+        'downbeats': evaluate_downbeats(downbeat_detections, downbeat_annotations),
+    }
+    if tempo_detections:
+        results['tempo'] = evaluate_tempo(tempo_detections, tempo_annotations)
+    if inferred_detections:
+        results['tempo_inferred'] = evaluate_tempo(inferred_detections, inferred_annotations)
+    return results
+
+
+def scores(evaluation):
+    """Beat/downbeat F-measures and tempo accuracies (if evaluated) of the results of `evaluate`."""
+    result = {
+        'beats_fmeasure': evaluation['beats'].fmeasure,
+        'downbeats_fmeasure': evaluation['downbeats'].fmeasure,
+        'bars_fmeasure': evaluation['downbeats_bar_tracker'].fmeasure,
+    }
+    for name in ('tempo', 'tempo_inferred'):
+        if name in evaluation:
+            result[name + '_acc1'] = evaluation[name].acc1
+            result[name + '_acc2'] = evaluation[name].acc2
+    return result
@@ -0,0 +1,376 @@
+"""Time-frequency and mid-level features as used in the baseline section (ch2)."""
+
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import librosa
+import scipy.ndimage
+import soundfile as sf
+
+FPS = 100
+SR = 44100
+N_FFT = 2048
+HOP_LENGTH = int(librosa.time_to_samples(1.0 / FPS, sr=SR))
+N_MELS = 80
+FMIN = 27.5
+FMAX = 17000.0
+LAG = 2
+MAX_SIZE = 3
+# padding of centered frames; librosa's default changed from 'reflect' to 'constant' in version 0.10
+PAD_MODE = 'reflect'
+# band-limited (low frequency) mel spectrogram
+BL_N_FFT = 4096
+BL_N_MELS = 40
+BL_FMAX = 400.0
+# version of the cached features, increase if `compute_features` changes its output
+FEATURE_VERSION = 1
+
+
+def mel_spectrogram(y, sr=SR, n_fft=N_FFT, hop_length=HOP_LENGTH, n_mels=N_MELS, fmin=FMIN, fmax=FMAX, center=True,
+                    pad_mode=PAD_MODE):
+    """Compute the (power) mel spectrogram of the audio signal `y`."""
+    return librosa.feature.melspectrogram(
+        y=y, sr=sr, n_fft=n_fft, hop_length=hop_length, fmin=fmin, fmax=fmax, n_mels=n_mels, center=center,
+        pad_mode=pad_mode,
+    )
+
+
+def spectral_flux(S, sr=SR, hop_length=HOP_LENGTH, lag=LAG, max_size=MAX_SIZE):
+    """Compute the spectral flux of the (power) mel spectrogram `S`."""
+    return librosa.onset.onset_strength(
+        S=librosa.power_to_db(S, ref=np.max), sr=sr, hop_length=hop_length, lag=lag, max_size=max_size
+    )
+
+
+def multiband_spectral_flux(y, bands, sr=SR, n_fft=BL_N_FFT, hop_length=HOP_LENGTH, lag=LAG, max_size=MAX_SIZE):
+    """Compute the spectral flux of multiple (mel) frequency bands at once.
+
+    A single STFT is computed and all mel spectrograms are obtained with one
+    matrix multiplication from a stacked filterbank. The spectral flux of all
+    bands is then computed jointly; the result for each band is the same (up to
+    floating point precision) as computing its mel spectrogram with the given
+    `n_fft` and calling `spectral_flux` on it.
+
+    Args:
+        y: audio signal
+        bands: list of (fmin, fmax, n_mels) tuples
+        sr: sample rate
+        n_fft: FFT size, must be large enough to resolve the narrowest band
+        hop_length: hop length
+        lag: time lag for computing differences
+        max_size: size of the local max. filter (in frequency bins)
+
+    Returns:
+        numpy array: spectral flux with shape (bands x frames)
+    """
+    # stack the filterbanks of all bands, separated by `max_size // 2` empty rows, so the
+    # max. filter along frequency does not cross band boundaries
+    sep = max_size // 2
+    filterbanks, starts = [], []
+    num_rows = 0
+    for fmin, fmax, n_mels in bands:
+        starts.append(num_rows + sep)
+        filterbanks.append(np.zeros((sep, n_fft // 2 + 1)))
+        filterbanks.append(librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels, fmin=fmin, fmax=fmax))
+        num_rows += sep + n_mels
+    filterbanks.append(np.zeros((sep, n_fft // 2 + 1)))
+    filterbank = np.vstack(filterbanks)
+    starts = np.array(starts)
+    n_mels = np.array([b[2] for b in bands])
+    rows = np.concatenate([np.arange(start, start + n) for start, n in zip(starts, n_mels)])
+    # one STFT, one matrix multiplication for all mel spectrograms
+    S = np.abs(librosa.stft(y, n_fft=n_fft, hop_length=hop_length, pad_mode=PAD_MODE)) ** 2
+    S = filterbank.dot(S)
+    # convert to dB w.r.t. the maximum of each band (i.e. `power_to_db(S, ref=np.max)` per band)
+    amin, top_db = 1e-10, 80.0
+    band_max = np.maximum.reduceat(S[rows].max(axis=1), np.cumsum(n_mels) - n_mels)
+    S = 10.0 * np.log10(np.maximum(amin, S))
+    ref = np.repeat(10.0 * np.log10(np.maximum(amin, band_max)), n_mels)
+    S[rows] -= ref[:, np.newaxis]
+    band_max = np.maximum.reduceat(S[rows].max(axis=1), np.cumsum(n_mels) - n_mels)
+    S[rows] = np.maximum(S[rows], np.repeat(band_max - top_db, n_mels)[:, np.newaxis])
+    # separators must not contribute to the max. filter
+    S[np.setdiff1d(np.arange(len(S)), rows)] = -np.inf
+    ref = scipy.ndimage.maximum_filter1d(S, max_size, axis=0) if max_size > 1 else S
+    # positive differences to the reference, spaced by lag
+    flux = np.maximum(0.0, S[rows, lag:] - ref[rows, :-lag])
+    # average within bands
+    flux = np.add.reduceat(flux, np.cumsum(n_mels) - n_mels, axis=0) / n_mels[:, np.newaxis]
+    # compensate for lag and framing (aligned the same way as `spectral_flux`)
+    pad_width = lag + N_FFT // (2 * hop_length)
+    flux = np.pad(flux, ([0, 0], [pad_width, 0]), mode='constant')
+    return flux[:, : S.shape[1]]
+
+
+def stream_audio(filename, block_size=2 ** 16, sr=SR):
+    """Read a (mono) audio file block-wise.
+
+    Multi-channel audio is down-mixed the same way as `librosa.load` does it.
+    Since resampling is not supported, the file must have the sample rate `sr`.
+    """
+    with sf.SoundFile(filename) as f:
+        if f.samplerate != sr:
+            raise ValueError(f'sample rate of {filename} is {f.samplerate} Hz, streaming requires {sr} Hz')
+        for block in f.blocks(blocksize=block_size, dtype='float32', always_2d=True):
+            # down-mix like `librosa.to_mono`
+            yield np.mean(block.T, axis=0)
+
+
+def stream_mel_spectrogram(filename, block_size=1024, sr=SR, n_fft=N_FFT, hop_length=HOP_LENGTH, n_mels=N_MELS,
+                           fmin=FMIN, fmax=FMAX):
+    """Compute the (power) mel spectrogram of an audio file block-wise.
+
+    Yields blocks of (up to) `block_size` frames which, concatenated, equal
+    the mel spectrogram of the whole file (i.e. with centered frames, the
+    signal is padded by reflection, see `PAD_MODE`).
+    """
+    half = n_fft // 2
+    # buffer with the (reflection padded) signal not consumed yet and the last samples seen
+    buffer, tail = None, np.empty(0, dtype=np.float32)
+    head = []
+    for block in stream_audio(filename, block_size * hop_length, sr=sr):
+        tail = np.concatenate((tail, block))[-(half + 1):]
+        if buffer is None:
+            # wait until enough samples are available to reflect the start of the signal
+            head.append(block)
+            if sum(len(h) for h in head) <= half:
+                continue
+            block = np.concatenate(head)
+            buffer = block[half:0:-1]
+        buffer = np.concatenate((buffer, block))
+        num_frames = (len(buffer) - n_fft) // hop_length + 1
+        if num_frames > 0:
+            yield mel_spectrogram(
+                buffer[: (num_frames - 1) * hop_length + n_fft], sr=sr, n_fft=n_fft, hop_length=hop_length,
+                n_mels=n_mels, fmin=fmin, fmax=fmax, center=False,
+            )
+            buffer = buffer[num_frames * hop_length:]
+    if buffer is None:
+        # signal too short for streaming, process it at once
+        if head:
+            yield mel_spectrogram(np.concatenate(head), sr=sr, n_fft=n_fft, hop_length=hop_length, n_mels=n_mels,
+                                  fmin=fmin, fmax=fmax)
+        return
+    # reflect the end of the signal and process the remaining frames
+    buffer = np.concatenate((buffer, tail[-2::-1]))
+    num_frames = (len(buffer) - n_fft) // hop_length + 1
+    for start in range(0, num_frames, block_size):
+        stop = min(start + block_size, num_frames)
+        yield mel_spectrogram(
+            buffer[start * hop_length: (stop - 1) * hop_length + n_fft], sr=sr, n_fft=n_fft,
+            hop_length=hop_length, n_mels=n_mels, fmin=fmin, fmax=fmax, center=False,
+        )
+
+
+def stream_spectral_flux(filename, block_size=1024, sr=SR, n_fft=N_FFT, hop_length=HOP_LENGTH, n_mels=N_MELS,
+                         fmin=FMIN, fmax=FMAX, lag=LAG, max_size=MAX_SIZE, top_db=80.0):
+    """Compute the spectral flux of an audio file block-wise.
+
+    Only a block of audio (and a couple of frames of state across block
+    boundaries) is held in memory at a time, i.e. memory consumption is
+    independent of the length of the file. The concatenated output is
+    identical to the spectral flux returned by `compute_features`, except for
+    rounding differences of the mel filterbank's matrix multiplication which
+    can occur for very small blocks.
+
+    The spectral flux is computed from the mel spectrogram in dB relative to
+    its maximum, clipped at `top_db` below it. Since this maximum depends on
+    the whole file, it is determined in a first pass over the file. If
+    `top_db` is None, no clipping is performed and a single pass suffices,
+    the result then equals the offline computation (with `top_db=None`) up to
+    floating point precision.
+
+    Args:
+        filename: audio file
+        block_size: number of frames processed at once
+        sr: sample rate
+        n_fft: FFT size
+        hop_length: hop length
+        n_mels: number of mel bands
+        fmin: lowest frequency
+        fmax: highest frequency
+        lag: time lag for computing differences
+        max_size: size of the local max. filter (in frequency bins)
+        top_db: threshold the mel spectrogram this many dB below its maximum
+
+    Yields:
+        numpy array: spectral flux frames
+    """
+    params = dict(block_size=block_size, sr=sr, n_fft=n_fft, hop_length=hop_length, n_mels=n_mels, fmin=fmin,
+                  fmax=fmax)
+    if top_db is None:
+        ref, floor = 1.0, -np.inf
+    else:
+        # first pass: determine the maximum and the dB floor the same way `power_to_db` does
+        ref = max(S.max() for S in stream_mel_spectrogram(filename, **params))
+        floor = librosa.power_to_db(np.array([[ref]]), ref=ref, top_db=None).max() - top_db
+    # the flux of frame t is the difference of frame t - c and the (max. filtered) frame t - c - lag,
+    # with c compensating framing effects as `onset_strength` does
+    c = N_FFT // (2 * hop_length)
+    yield np.zeros(lag + c, dtype=np.float32)
+    # max. filtered frames of the previous block and flux frames held back
+    prev, pending = None, np.empty(0, dtype=np.float32)
+    for S in stream_mel_spectrogram(filename, **params):
+        S = np.maximum(librosa.power_to_db(S, ref=ref, top_db=None), floor)
+        ref_S = scipy.ndimage.maximum_filter1d(S, max_size, axis=0) if max_size > 1 else S
+        if prev is not None:
+            S = np.hstack((prev[0], S))
+            ref_S = np.hstack((prev[1], ref_S))
+        prev = S[:, -lag:], ref_S[:, -lag:]
+        if S.shape[1] <= lag:
+            continue
+        flux = np.mean(np.maximum(0.0, S[:, lag:] - ref_S[:, :-lag]), axis=0)
+        # the last c frames are discarded at the end of the file
+        pending = np.concatenate((pending, flux))
+        if len(pending) > c:
+            yield pending[: len(pending) - c]
+            pending = pending[len(pending) - c:]
+
+
+def compute_features(filename, sr=SR, n_fft=N_FFT, hop_length=HOP_LENGTH, n_mels=N_MELS, fmin=FMIN, fmax=FMAX,
+                     lag=LAG, max_size=MAX_SIZE):
+    """Load an audio file and compute its mel spectrogram and spectral flux."""
+    y, sr = librosa.load(filename, sr=sr)
+    S = mel_spectrogram(y, sr=sr, n_fft=n_fft, hop_length=hop_length, n_mels=n_mels, fmin=fmin, fmax=fmax)
+    flux = spectral_flux(S, sr=sr, hop_length=hop_length, lag=lag, max_size=max_size)
+    return S, flux
+
+
+def file_hash(filename, chunk_size=2 ** 20):
+    """Compute the SHA-1 hash of the content of a file."""
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class FeatureCache:
+    """Content-addressed on-disk cache for mel spectrograms and spectral flux.
+
+    Features are stored as `.npy` files in a directory named after the hash of
+    the audio file's content and the parameters used to compute them. Cached
+    features are returned memory-mapped, i.e. neither the audio needs to be
+    decoded nor the STFT computed again.
+
+    The parameters are completed with the defaults of `compute_features`,
+    i.e. passing a default value explicitly results in the same key. The key
+    also includes the padding mode of the STFT and `FEATURE_VERSION`. The
+    hash of an audio file is computed once per process and file (as long as
+    its size and modification time do not change).
+
+    If the cache exceeds `max_bytes`, the least recently used entries are
+    evicted.
+
+    Args:
+        cache_dir: directory to store the features in
+        max_bytes: maximum size of the cache in bytes (None: unlimited)
+        **params: parameters passed to `compute_features`
+    """
+
+    # hashes of the audio files, shared by all caches of the process
+    _hashes = {}
+
+    def __init__(self, cache_dir, max_bytes=None, **params):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        self.params = self.parameters(**params)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def parameters(**params):
+        """Return the parameters of `compute_features`, completed with its defaults."""
+        bound = inspect.signature(compute_features).bind(None, **params)
+        bound.apply_defaults()
+        params = dict(bound.arguments)
+        del params['filename']
+        return params
+
+    def file_hash(self, filename):
+        """Return the hash of the content of a file (memoized by path, size and modification time)."""
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+        if key not in self._hashes:
+            self._hashes[key] = file_hash(filename)
+        return self._hashes[key]
+
+    def key(self, filename, **params):
+        """Return the cache key of the given file and parameters."""
+        params = self.parameters(**dict(self.params, **params)) if params else self.params
+        sha = hashlib.sha1(self.file_hash(filename).encode())
+        sha.update(json.dumps({'params': params, 'pad_mode': PAD_MODE, 'version': FEATURE_VERSION},
+                              sort_keys=True).encode())
+        return sha.hexdigest()
+
+    def _load(self, path):
+        # mark entry as recently used
+        os.utime(path)
+        S = np.load(os.path.join(path, 'mel.npy'), mmap_mode='r')
+        flux = np.load(os.path.join(path, 'flux.npy'), mmap_mode='r')
+        return S, flux
+
+    def __call__(self, filename, **params):
+        """Return the (memory-mapped) mel spectrogram and spectral flux of a file."""
+        path = os.path.join(self.cache_dir, self.key(filename, **params))
+        try:
+            return self._load(path)
+        except FileNotFoundError:
+            # not cached yet (or evicted by another process)
+            pass
+        S, flux = compute_features(filename, **dict(self.params, **params))
+        # write to a temporary directory first so that no partial entries are left behind
+        tmp = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp')
+        np.save(os.path.join(tmp, 'mel.npy'), S)
+        np.save(os.path.join(tmp, 'flux.npy'), flux)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # another process cached the same features in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+        try:
+            # touch the new entry first, so that it is not evicted
+            features = self._load(path)
+        except FileNotFoundError:
+            # evicted by another process in the meantime
+            features = S, flux
+        self.evict()
+        return features
+
+    def entries(self):
+        """Return all cache entries as (last access, size, path) tuples, oldest first."""
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        return sorted(entries)
+
+    def size(self):
+        """Return the total size of the cache in bytes."""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes=None):
+        """Remove least recently used entries until the cache fits into `max_bytes`."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if max_bytes is None:
+            return
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        # always keep the most recently used entry
+        for _, size, path in entries[:-1]:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        for _, _, path in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
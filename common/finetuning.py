@@ -0,0 +1,246 @@
+"""Fine-tuning of the output layers from cached activations of the (frozen) network.
+
+When only the output layers (`beats_dense`, `downbeats_dense`, `tempo_dense`)
+are adapted, e.g. to a new genre, the conv layers and the TCN stack (the
+trunk) compute the same output in every epoch. Thus, the trunk is run only
+once per track, its `tcn` and `skip` outputs are written to a memory-mapped
+`TrunkCache` and the output layers are trained from the cache instead.
+
+The output layers are cheap to compute, thus the time per step is dominated
+by overhead; `TrunkSequence` therefore batches several tracks of similar
+length. Shorter tracks are padded: the targets with `MASK_VALUE` (ignored by
+the masked losses) and the skip activations with `MASK_VALUE` as well, which
+the head model masks, i.e. the tempo head averages over the frames of each
+track only.
+
+Note: the cached activations are computed in inference mode, i.e. without
+the dropout of the trunk. The output layers still use their dropout (and
+the tempo noise) during training.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from keras.layers import Input, Masking
+from keras.models import Model
+from keras.utils import Sequence
+
+from .data import BatchBuffer, TempoAugmentedSequence, bucket_batches
+from .pruning import compile_model
+from .tempo import MASK_VALUE
+
+HEADS = ('beats_dense', 'downbeats_dense', 'tempo_dense')
+
+
+def trunk_model(model):
+    """Return a model computing the outputs of the TCN stack (`tcn`) and of the skip connections (`skip`)."""
+    return Model(model.input, [model.get_layer('tcn_activation').output,
+                               model.get_layer('tcn_merge_skip_connections').output])
+
+
+def head_model(model):
+    """Return a model with the output layers of `model`, fed with the `tcn` and `skip` activations.
+
+    The layers are shared with `model`, i.e. training the head model updates
+    the output layers of `model` as well. Frames of the `skip` activations
+    equal to `MASK_VALUE` (i.e. padding) are ignored by the tempo head.
+    """
+    num_filters = model.get_layer('tcn_activation').output_shape[-1]
+    num_skip_filters = model.get_layer('tcn_merge_skip_connections').output_shape[-1]
+    tcn = Input(shape=(None, num_filters), name='tcn')
+    skip = Input(shape=(None, num_skip_filters), name='skip')
+    beats = tcn
+    for name in ('beats_dropout', 'beats_dense', 'beats'):
+        beats = model.get_layer(name)(beats)
+    downbeats = tcn
+    for name in ('downbeats_dropout', 'downbeats_dense', 'downbeats'):
+        downbeats = model.get_layer(name)(downbeats)
+    tempo = Masking(MASK_VALUE, name='skip_masking')(skip)
+    for name in ('tempo_dropout', 'tempo_global_average_pooling', 'tempo_noise', 'tempo_dense', 'tempo'):
+        tempo = model.get_layer(name)(tempo)
+    return Model([tcn, skip], outputs=[beats, downbeats, tempo])
+
+
+class TrunkCache:
+    """Persistent, memory-mapped cache of the trunk's activations and the targets of a dataset.
+
+    Same layout as `FeatureStore`: the `tcn` and `skip` activations and the
+    targets of all tracks are stored (as float32) one after the other in a
+    single data file, an index holds the offsets and shapes of each track.
+
+    Args:
+        path: directory of the cache
+        mode: mode used to memory-map the data file
+    """
+
+    DATA_FILE = 'data.f32'
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, path, mode='r'):
+        self.path = os.path.expanduser(path)
+        with open(os.path.join(self.path, self.INDEX_FILE)) as f:
+            index = json.load(f)
+        self.num_tempo_bins = index['num_tempo_bins']
+        self.index = index['tracks']
+        self.mode = mode
+        self._data = None
+
+    @classmethod
+    def create(cls, path, model, sequence):
+        """Run the trunk of a model once per track and write its activations and the targets to a new cache.
+
+        Args:
+            path: directory of the cache (must not exist)
+            model: Keras model created by `create_model`
+            sequence: sequence with the features and (widened) targets of the
+                tracks (e.g. `DataSequence`); a `TempoAugmentedSequence`
+                caches all its frame rates as individual tracks
+
+        Returns:
+            TrunkCache: the newly created cache
+        """
+        if isinstance(sequence, TempoAugmentedSequence) and sequence.sample:
+            # the cache would freeze the frame rates randomly chosen for a single epoch
+            raise ValueError('cannot cache a TempoAugmentedSequence with randomly sampled frame rates, '
+                             'use sample=False to cache all frame rates')
+        trunk = trunk_model(model)
+        path = os.path.expanduser(path)
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        # write to a temporary directory first so that no partial caches are left behind
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp')
+        try:
+            index = {}
+            offset = 0
+            num_tempo_bins = None
+            with open(os.path.join(tmp, cls.DATA_FILE), 'wb') as f:
+                for i, key in enumerate(sequence.ids):
+                    x, y = sequence[i]
+                    tcn, skip = trunk.predict(x, verbose=0)
+                    num_tempo_bins = y['tempo'].shape[-1]
+                    index[key] = {'offset': offset, 'tcn': list(tcn.shape[1:]), 'skip': list(skip.shape[1:])}
+                    for array in (tcn[0], skip[0], y['beats'][0, :, 0], y['downbeats'][0, :, 0], y['tempo'][0]):
+                        array = np.ascontiguousarray(array, dtype=np.float32)
+                        f.write(array.tobytes())
+                        offset += array.size
+            with open(os.path.join(tmp, cls.INDEX_FILE), 'w') as f:
+                json.dump({'num_tempo_bins': num_tempo_bins, 'tracks': index}, f)
+            os.rename(tmp, path)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        return cls(path)
+
+    @property
+    def data(self):
+        """Memory-mapped data file (mapped on first access)."""
+        if self._data is None:
+            self._data = np.memmap(os.path.join(self.path, self.DATA_FILE), dtype=np.float32, mode=self.mode)
+        return self._data
+
+    @property
+    def ids(self):
+        return list(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, key):
+        """Return the activations and targets of a track as a dictionary of memory-mapped arrays."""
+        entry = self.index[key]
+        offset = entry['offset']
+        shapes = {'tcn': entry['tcn'], 'skip': entry['skip'], 'beats': entry['tcn'][:1],
+                  'downbeats': entry['tcn'][:1], 'tempo': [self.num_tempo_bins]}
+        arrays = {}
+        for name, shape in shapes.items():
+            size = int(np.prod(shape))
+            arrays[name] = self.data[offset:offset + size].reshape(shape)
+            offset += size
+        return arrays
+
+
+class TrunkSequence(Sequence):
+    """Cached trunk activations and targets wrapped as a Keras sequence (for a model created by `head_model`).
+
+    Tracks of similar length are grouped into batches (see `bucket_batches`),
+    shorter tracks are padded with `MASK_VALUE`.
+
+    Args:
+        cache: `TrunkCache` or its path
+        ids: names of the tracks to use (None: all tracks of the cache)
+        batch_size: maximum number of tracks per batch
+        max_padding: maximum fraction of padded frames per batch
+        shuffle: shuffle the tracks of equal length every epoch
+        seed: random seed used for shuffling
+    """
+
+    def __init__(self, cache, ids=None, batch_size=8, max_padding=0.25, shuffle=True, seed=None):
+        if not isinstance(cache, TrunkCache):
+            cache = TrunkCache(cache)
+        self.cache = cache
+        self.ids = cache.ids if ids is None else list(ids)
+        self.lengths = np.array([cache.index[key]['tcn'][0] for key in self.ids])
+        self.batch_size = batch_size
+        self.max_padding = max_padding
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        self.on_epoch_end()
+
+    def on_epoch_end(self):
+        """Re-bucket the tracks."""
+        self.batches = bucket_batches(self.lengths, self.batch_size, max_padding=self.max_padding,
+                                      rng=self.rng if self.shuffle else None)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, idx):
+        tracks = [self.cache[self.ids[i]] for i in self.batches[idx]]
+        num_frames = max(len(track['tcn']) for track in tracks)
+        # allocate the padded batch
+        buffer = BatchBuffer()
+        tcn = buffer.array('tcn', (len(tracks), num_frames, tracks[0]['tcn'].shape[-1]), 0)
+        skip = buffer.array('skip', (len(tracks), num_frames, tracks[0]['skip'].shape[-1]), MASK_VALUE)
+        y = {'beats': buffer.array('beats', (len(tracks), num_frames, 1), MASK_VALUE),
+             'downbeats': buffer.array('downbeats', (len(tracks), num_frames, 1), MASK_VALUE),
+             'tempo': buffer.array('tempo', (len(tracks), self.cache.num_tempo_bins))}
+        for i, track in enumerate(tracks):
+            length = len(track['tcn'])
+            tcn[i, :length] = track['tcn']
+            skip[i, :length] = track['skip']
+            y['beats'][i, :length, 0] = track['beats']
+            y['downbeats'][i, :length, 0] = track['downbeats']
+            y['tempo'][i] = track['tempo']
+        return [tcn, skip], y
+
+
+def fine_tune_heads(model, cache, epochs=10, batch_size=8, compile_fn=compile_model, callbacks=None, verbose=0):
+    """Fine-tune the output layers of a model from cached trunk activations.
+
+    Only `beats_dense`, `downbeats_dense` and `tempo_dense` are trained, the
+    weights of all other layers of `model` are left untouched. The model
+    is updated in place (and can be saved or used with `predict` afterwards).
+
+    Args:
+        model: (trained) Keras model created by `create_model`
+        cache: `TrunkCache` (see `TrunkCache.create`), its path or a `TrunkSequence`
+        epochs: number of epochs to train
+        batch_size: maximum number of tracks per batch (if `cache` is not a `TrunkSequence`)
+        compile_fn: function compiling the head model (with the masked losses)
+        callbacks: Keras callbacks (e.g. learn rate schedule)
+        verbose: verbosity of the training
+
+    Returns:
+        keras.callbacks.History: training history
+    """
+    train = cache if isinstance(cache, TrunkSequence) else TrunkSequence(cache, batch_size=batch_size)
+    heads = head_model(model)
+    compile_fn(heads)
+    return heads.fit_generator(train, steps_per_epoch=len(train), epochs=epochs, shuffle=True,
+                               callbacks=callbacks, verbose=verbose)
@@ -0,0 +1,195 @@
+"""Batched multi-track inference with post-processing in worker processes."""
+
+import multiprocessing as mp
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from .data import bucket_batches
+from .postprocessing import FPS, _post_process, activation_dict, create_trackers, post_process, save_detections
+
+
+class InferenceEngine:
+    """Predict and post-process a dataset with overlapping network and DBN decoding.
+
+    Instead of predicting one track at a time and decoding it right away (as
+    the notebook's `predict` does), the forward passes of several tracks are
+    batched and the activations are handed to a pool of worker processes
+    running the (madmom) DBN post-processing. While the workers decode, the
+    network already predicts the next batch, so the wall time approaches
+    max(network time, post-processing time / workers) instead of their sum.
+
+    By default only tracks of equal length are batched, i.e. the activations
+    are the same as when predicting the tracks one by one (up to floating
+    point precision). With `max_padding` > 0, tracks of different lengths
+    are batched as well; shorter tracks are padded by repeating their last
+    frame, which changes the activations near their end and the tempo
+    activations (averaged over all frames) slightly.
+
+    Args:
+        model: Keras model
+        batch_size: maximum number of tracks per forward pass
+        max_padding: maximum fraction of padded frames per batch
+        num_workers: number of worker processes for the post-processing
+            (None: number of CPU cores, 0: post-process in this process)
+        fps: frame rate of the activations
+    """
+
+    def __init__(self, model, batch_size=8, max_padding=0.0, num_workers=None, fps=FPS):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_padding = max_padding
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
+        self.fps = fps
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_tracks = 0
+        self.num_batches = 0
+        self.num_frames = 0
+        self.num_padded_frames = 0
+        self.network_time = 0.0
+        self.post_process_time = 0.0
+        self.wall_time = 0.0
+
+    @property
+    def stats(self):
+        """Statistics of the last run.
+
+        Returns:
+            dict: number of tracks and batches, fraction of padded frames, time
+                spent in the network, in the post-processing (summed over all
+                workers) and the total wall time
+        """
+        return {
+            'tracks': self.num_tracks,
+            'batches': self.num_batches,
+            'padding': self.num_padded_frames / max(self.num_frames, 1),
+            'network_time': self.network_time,
+            'post_process_time': self.post_process_time,
+            'wall_time': self.wall_time,
+        }
+
+    @staticmethod
+    def _lengths(dataset):
+        if hasattr(dataset, 'lengths'):
+            return list(dataset.lengths)
+        return [dataset[i][0].shape[1] for i in range(len(dataset))]
+
+    def _forward(self, dataset, batch):
+        """Predict the tracks of the batch, yield name and (unpadded) activations of each track."""
+        xs = [dataset[int(i)][0] for i in batch]
+        num_frames = max(x.shape[1] for x in xs)
+        x_batch = np.concatenate([np.pad(x, [(0, 0), (0, num_frames - x.shape[1])] + [(0, 0)] * (x.ndim - 2),
+                                         mode='edge') for x in xs])
+        start = time.perf_counter()
+        beats, downbeats, tempo = self.model.predict(x_batch, batch_size=len(xs), verbose=0)
+        self.network_time += time.perf_counter() - start
+        self.num_batches += 1
+        self.num_frames += x_batch.shape[0] * x_batch.shape[1]
+        self.num_padded_frames += sum(num_frames - x.shape[1] for x in xs)
+        # frames lost due to the (unpadded) convolutions of the network
+        context = num_frames - beats.shape[1]
+        for i, (idx, x) in enumerate(zip(batch, xs)):
+            length = x.shape[1] - context
+            yield dataset.ids[int(idx)], beats[i, :length, 0].copy(), downbeats[i, :length, 0].copy(), tempo[i].copy()
+
+    def _collect(self, done, pending):
+        for future in done:
+            activations = pending.pop(future)
+            key, detections, duration = future.result()
+            self.post_process_time += duration
+            self.num_tracks += 1
+            yield key, activations, detections
+
+    def run(self, dataset):
+        """Predict and post-process all tracks of the dataset.
+
+        Args:
+            dataset: sequence yielding a single track per item (e.g. `DataSequence`)
+
+        Yields:
+            tuple: name, activations and detections of a track, in the order
+                the post-processing of the tracks finishes
+        """
+        self.reset_stats()
+        start = time.perf_counter()
+        batches = bucket_batches(self._lengths(dataset), self.batch_size, max_padding=self.max_padding)
+        if not self.num_workers:
+            trackers = create_trackers(self.fps)
+            for batch in batches:
+                for key, *act in self._forward(dataset, batch):
+                    activations = activation_dict(*act)
+                    post_start = time.perf_counter()
+                    detections = post_process(activations, trackers, self.fps)
+                    self.post_process_time += time.perf_counter() - post_start
+                    self.num_tracks += 1
+                    yield key, activations, detections
+            self.wall_time = time.perf_counter() - start
+            return
+        # spawn the workers, since TensorFlow is not fork-safe
+        pending = {}
+        with ProcessPoolExecutor(self.num_workers, mp_context=mp.get_context('spawn')) as pool:
+            for batch in batches:
+                for key, *act in self._forward(dataset, batch):
+                    pending[pool.submit(_post_process, key, *act, self.fps)] = activation_dict(*act)
+                # stream the tracks finished so far without waiting for the others
+                yield from self._collect([future for future in pending if future.done()], pending)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                yield from self._collect(done, pending)
+        self.wall_time = time.perf_counter() - start
+
+    def predict(self, dataset, detdir=None, activations=None, detections=None):
+        """Same as the notebook's `predict`, i.e. return (and save) activations and detections of all tracks.
+
+        The dictionaries are filled in the order of the tracks of the dataset.
+        """
+        activations = {} if activations is None else activations
+        detections = {} if detections is None else detections
+        results = {}
+        for i, (key, act, det) in enumerate(self.run(dataset)):
+            # print progress
+            sys.stderr.write('\rprocessing file %d of %d: %12s' % (i + 1, len(dataset), key))
+            sys.stderr.flush()
+            # save activations & detections
+            if detdir is not None:
+                save_detections(detdir, key, act, det)
+            results[key] = act, det
+        for key in dataset.ids:
+            activations[key], detections[key] = results[key]
+        return activations, detections
+
+
+def predict(model, dataset, detdir=None, activations=None, detections=None, batch_size=8, max_padding=0.0,
+            num_workers=None, fps=FPS):
+    """Drop-in replacement for the notebook's `predict` using an `InferenceEngine`."""
+    engine = InferenceEngine(model, batch_size, max_padding, num_workers, fps)
+    return engine.predict(dataset, detdir, activations, detections)
+
+
+def benchmark_inference(model, dataset, batch_size=8, max_padding=0.0, num_workers=None, fps=FPS):
+    """Compare the per-track loop of the notebook with batched inference and parallel post-processing.
+
+    Returns:
+        dict: statistics (see `InferenceEngine.stats`) of the serial
+            (batch size 1, post-processing in this process) and the batched
+            and parallel configuration, and the max. deviation of their
+            activations
+    """
+    results, outputs = {}, {}
+    configs = {'serial': (1, 0.0, 0), 'batched': (batch_size, max_padding, num_workers)}
+    for name, (size, padding, workers) in configs.items():
+        engine = InferenceEngine(model, size, padding, workers, fps)
+        outputs[name] = {key: act for key, act, _ in engine.run(dataset)}
+        results[name] = engine.stats
+    max_deviation = 0.0
+    for key, act in outputs['serial'].items():
+        for name in ('beats', 'downbeats', 'tempo'):
+            deviation = float(np.max(np.abs(act[name] - outputs['batched'][key][name])))
+            max_deviation = max(max_deviation, deviation)
+    results['max_deviation'] = max_deviation
+    return results
@@ -0,0 +1,434 @@
+"""Multi-task TCN model, optimizers and losses of the notebook.
+
+The code is the same as in the notebook, but importable, e.g. by worker
+processes (see `common.training`).
+"""
+
+import keras
+import keras.backend as K
+from keras.models import Model
+from keras.layers import (
+    Activation,
+    Dense,
+    Input,
+    Conv1D,
+    Conv2D,
+    MaxPooling2D,
+    Reshape,
+    Dropout,
+    SpatialDropout1D,
+    GaussianNoise,
+    GlobalAveragePooling1D,
+)
+
+from .tempo import MASK_VALUE
+
+
+def residual_block(x, i, activation, num_filters, kernel_size, padding, dropout_rate=0, name='', inner_filters=None):
+    # name of the layer
+    name = name + '_dilation_%d' % i
+    # number of filters of the dilated convolutions (can be pruned independently of the residual/skip width)
+    inner_filters = inner_filters or num_filters
+    # 1x1 conv. of input (so it can be added as residual)
+    res_x = Conv1D(num_filters, 1, padding='same', name=name + '_1x1_conv_residual')(x)
+    # two dilated convolutions, with dilation rates of i and 2i
+    conv_1 = Conv1D(
+        filters=inner_filters,
+        kernel_size=kernel_size,
+        dilation_rate=i,
+        padding=padding,
+        name=name + '_dilated_conv_1',
+    )(x)
+    conv_2 = Conv1D(
+        filters=inner_filters,
+        kernel_size=kernel_size,
+        dilation_rate=i * 2,
+        padding=padding,
+        name=name + '_dilated_conv_2',
+    )(x)
+    # concatenate the output of the two dilations
+    concat = keras.layers.concatenate([conv_1, conv_2], name=name + '_concat')
+    # apply activation function
+    x = Activation(activation, name=name + '_activation')(concat)
+    # apply spatial dropout
+    x = SpatialDropout1D(dropout_rate, name=name + '_spatial_dropout_%f' % dropout_rate)(x)
+    # 1x1 conv. to obtain a representation with the same size as the residual
+    x = Conv1D(num_filters, 1, padding='same', name=name + '_1x1_conv')(x)
+    # add the residual to the processed data and also return it as skip connection
+    return keras.layers.add([res_x, x], name=name + '_merge_residual'), x
+
+
+class TCN:
+    def __init__(
+        self,
+        num_filters=20,
+        kernel_size=5,
+        dilations=[1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024],
+        activation='elu',
+        padding='same',
+        dropout_rate=0.15,
+        name='tcn',
+        inner_filters=None,
+    ):
+        self.name = name
+        self.inner_filters = inner_filters or [None] * len(dilations)
+        self.dropout_rate = dropout_rate
+        self.activation = activation
+        self.dilations = dilations
+        self.kernel_size = kernel_size
+        self.num_filters = num_filters
+        self.padding = padding
+
+        if padding != 'causal' and padding != 'same':
+            raise ValueError("Only 'causal' or 'same' padding are compatible for this layer.")
+
+    def __call__(self, inputs):
+        x = inputs
+        # gather skip connections, each having a different context
+        skip_connections = []
+        # build the TCN models
+        for i, num_filters, inner_filters in zip(self.dilations, self.num_filters, self.inner_filters):
+            # feed the output of the previous layer into the next layer
+            # increase dilation rate for each consecutive layer
+            x, skip_out = residual_block(
+                x,
+                i,
+                self.activation,
+                num_filters,
+                self.kernel_size,
+                self.padding,
+                self.dropout_rate,
+                name=self.name,
+                inner_filters=inner_filters,
+            )
+            # collect skip connection
+            skip_connections.append(skip_out)
+        # activate the output of the TCN stack
+        x = Activation(self.activation, name=self.name + '_activation')(x)
+        # merge the skip connections by simply adding them
+        skip = keras.layers.add(skip_connections, name=self.name + '_merge_skip_connections')
+        return x, skip
+
+
+def create_model(input_shape, num_filters=20, num_dilations=11, kernel_size=5, activation='elu', dropout_rate=0.15,
+                 padding='same', inner_filters=None):
+    # Note: with padding='causal' the TCN does not look into the future, i.e. the model can be used for
+    #       streaming (see `common.streaming`); the conv layers still see 2 future frames
+    # input layer
+    input_layer = Input(shape=input_shape)
+
+    # stack of 3 conv layers, each conv, activation, max. pooling & dropout
+    conv_1 = Conv2D(num_filters, (3, 3), padding='valid', name='conv_1_conv')(input_layer)
+    conv_1 = Activation(activation, name='conv_1_activation')(conv_1)
+    conv_1 = MaxPooling2D((1, 3), name='conv_1_max_pooling')(conv_1)
+    conv_1 = Dropout(dropout_rate, name='conv_1_dropout')(conv_1)
+
+    conv_2 = Conv2D(num_filters, (1, 10), padding='valid', name='conv_2_conv')(conv_1)
+    conv_2 = Activation(activation, name='conv_2_activation')(conv_2)
+    conv_2 = MaxPooling2D((1, 3), name='conv_2_max_pooling')(conv_2)
+    conv_2 = Dropout(dropout_rate, name='conv_2_dropout')(conv_2)
+
+    conv_3 = Conv2D(num_filters, (3, 3), padding='valid', name='conv_3_conv')(conv_2)
+    conv_3 = Activation(activation, name='conv_3_activation')(conv_3)
+    conv_3 = MaxPooling2D((1, 3), name='conv_3_max_pooling')(conv_3)
+    conv_3 = Dropout(dropout_rate, name='conv_3_dropout')(conv_3)
+
+    # reshape layer to reduce dimensions
+    x = Reshape((-1, num_filters), name='tcn_input_reshape')(conv_3)
+
+    # TCN layers
+    dilations = [2 ** i for i in range(num_dilations)]
+    tcn, skip = TCN(
+        num_filters=[num_filters] * len(dilations),
+        kernel_size=kernel_size,
+        dilations=dilations,
+        activation=activation,
+        padding=padding,
+        dropout_rate=dropout_rate,
+        inner_filters=inner_filters,
+    )(x)
+
+    # output layers; beats & downbeats use TCN output, tempo the skip connections
+    beats = Dropout(dropout_rate, name='beats_dropout')(tcn)
+    beats = Dense(1, name='beats_dense')(beats)
+    beats = Activation('sigmoid', name='beats')(beats)
+
+    downbeats = Dropout(dropout_rate, name='downbeats_dropout')(tcn)
+    downbeats = Dense(1, name='downbeats_dense')(downbeats)
+    downbeats = Activation('sigmoid', name='downbeats')(downbeats)
+
+    tempo = Dropout(dropout_rate, name='tempo_dropout')(skip)
+    tempo = GlobalAveragePooling1D(name='tempo_global_average_pooling')(tempo)
+    tempo = GaussianNoise(dropout_rate, name='tempo_noise')(tempo)
+    tempo = Dense(300, name='tempo_dense')(tempo)
+    tempo = Activation('softmax', name='tempo')(tempo)
+
+    # instantiate a Model and return it
+    return Model(input_layer, outputs=[beats, downbeats, tempo])
+
+
+# code based on: https://github.com/CyberZHG/keras-radam
+
+
+class RAdam(keras.optimizers.Optimizer):
+    """RAdam optimizer.
+
+    # Arguments
+        learning_rate: float >= 0. Learning rate.
+        beta_1: float, 0 < beta < 1. Generally close to 1.
+        beta_2: float, 0 < beta < 1. Generally close to 1.
+        epsilon: float >= 0. Fuzz factor. If `None`, defaults to `K.epsilon()`.
+        decay: float >= 0. Learning rate decay over each update.
+        weight_decay: float >= 0. Weight decay for each param.
+        amsgrad: boolean. Whether to apply the AMSGrad variant of this
+            algorithm from the paper "On the Convergence of Adam and
+            Beyond".
+        total_steps: int >= 0. Total number of training steps. Enable warmup by setting a positive value.
+        warmup_proportion: 0 < warmup_proportion < 1. The proportion of increasing steps.
+        min_lr: float >= 0. Minimum learning rate after warmup.
+    # References
+        - [Adam - A Method for Stochastic Optimization](https://arxiv.org/abs/1412.6980v8)
+        - [On the Convergence of Adam and Beyond](https://openreview.net/forum?id=ryQu7f-RZ)
+        - [On The Variance Of The Adaptive Learning Rate And Beyond](https://arxiv.org/pdf/1908.03265v1.pdf)
+    """
+
+    def __init__(
+        self,
+        learning_rate=0.001,
+        beta_1=0.9,
+        beta_2=0.999,
+        epsilon=None,
+        decay=0.0,
+        weight_decay=0.0,
+        amsgrad=False,
+        total_steps=0,
+        warmup_proportion=0.1,
+        min_lr=0.0,
+        **kwargs
+    ):
+        learning_rate = kwargs.pop('lr', learning_rate)
+        super(RAdam, self).__init__(**kwargs)
+        with K.name_scope(self.__class__.__name__):
+            self.iterations = K.variable(0, dtype='int64', name='iterations')
+            self.learning_rate = K.variable(learning_rate, name='learning_rate')
+            self.beta_1 = K.variable(beta_1, name='beta_1')
+            self.beta_2 = K.variable(beta_2, name='beta_2')
+            self.decay = K.variable(decay, name='decay')
+            self.weight_decay = K.variable(weight_decay, name='weight_decay')
+            self.total_steps = K.variable(total_steps, name='total_steps')
+            self.warmup_proportion = K.variable(warmup_proportion, name='warmup_proportion')
+            self.min_lr = K.variable(min_lr, name='min_lr')
+        if epsilon is None:
+            epsilon = K.epsilon()
+        self.epsilon = epsilon
+        self.initial_decay = decay
+        self.initial_weight_decay = weight_decay
+        self.initial_total_steps = total_steps
+        self.amsgrad = amsgrad
+
+    def get_updates(self, loss, params):
+        grads = self.get_gradients(loss, params)
+        self.updates = [K.update_add(self.iterations, 1)]
+
+        lr = self.lr
+
+        if self.initial_decay > 0:
+            lr = lr * (1.0 / (1.0 + self.decay * K.cast(self.iterations, K.dtype(self.decay))))
+
+        t = K.cast(self.iterations, K.floatx()) + 1
+
+        if self.initial_total_steps > 0:
+            warmup_steps = self.total_steps * self.warmup_proportion
+            decay_steps = K.maximum(self.total_steps - warmup_steps, 1)
+            decay_rate = (self.min_lr - lr) / decay_steps
+            lr = K.switch(
+                t <= warmup_steps,
+                lr * (t / warmup_steps),
+                lr + decay_rate * K.minimum(t - warmup_steps, decay_steps),
+            )
+
+        ms = [K.zeros(K.int_shape(p), dtype=K.dtype(p), name='m_' + str(i)) for (i, p) in enumerate(params)]
+        vs = [K.zeros(K.int_shape(p), dtype=K.dtype(p), name='v_' + str(i)) for (i, p) in enumerate(params)]
+
+        if self.amsgrad:
+            vhats = [K.zeros(K.int_shape(p), dtype=K.dtype(p), name='vhat_' + str(i)) for (i, p) in enumerate(params)]
+        else:
+            vhats = [K.zeros(1, name='vhat_' + str(i)) for i in range(len(params))]
+
+        self.weights = [self.iterations] + ms + vs + vhats
+
+        beta_1_t = K.pow(self.beta_1, t)
+        beta_2_t = K.pow(self.beta_2, t)
+
+        sma_inf = 2.0 / (1.0 - self.beta_2) - 1.0
+        sma_t = sma_inf - 2.0 * t * beta_2_t / (1.0 - beta_2_t)
+
+        for p, g, m, v, vhat in zip(params, grads, ms, vs, vhats):
+            m_t = (self.beta_1 * m) + (1.0 - self.beta_1) * g
+            v_t = (self.beta_2 * v) + (1.0 - self.beta_2) * K.square(g)
+
+            m_corr_t = m_t / (1.0 - beta_1_t)
+            if self.amsgrad:
+                vhat_t = K.maximum(vhat, v_t)
+                v_corr_t = K.sqrt(vhat_t / (1.0 - beta_2_t))
+                self.updates.append(K.update(vhat, vhat_t))
+            else:
+                v_corr_t = K.sqrt(v_t / (1.0 - beta_2_t))
+
+            r_t = K.sqrt((sma_t - 4.0) / (sma_inf - 4.0) * (sma_t - 2.0) / (sma_inf - 2.0) * sma_inf / sma_t)
+
+            p_t = K.switch(sma_t >= 5, r_t * m_corr_t / (v_corr_t + self.epsilon), m_corr_t)
+
+            if self.initial_weight_decay > 0:
+                p_t += self.weight_decay * p
+
+            p_t = p - lr * p_t
+
+            self.updates.append(K.update(m, m_t))
+            self.updates.append(K.update(v, v_t))
+            new_p = p_t
+
+            # Apply constraints.
+            if getattr(p, 'constraint', None) is not None:
+                new_p = p.constraint(new_p)
+
+            self.updates.append(K.update(p, new_p))
+        return self.updates
+
+    @property
+    def lr(self):
+        return self.learning_rate
+
+    @lr.setter
+    def lr(self, learning_rate):
+        self.learning_rate = learning_rate
+
+    def get_config(self):
+        config = {
+            'learning_rate': float(K.get_value(self.learning_rate)),
+            'beta_1': float(K.get_value(self.beta_1)),
+            'beta_2': float(K.get_value(self.beta_2)),
+            'decay': float(K.get_value(self.decay)),
+            'weight_decay': float(K.get_value(self.weight_decay)),
+            'epsilon': self.epsilon,
+            'amsgrad': self.amsgrad,
+            'total_steps': float(K.get_value(self.total_steps)),
+            'warmup_proportion': float(K.get_value(self.warmup_proportion)),
+            'min_lr': float(K.get_value(self.min_lr)),
+        }
+        base_config = super(RAdam, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+# code based on: https://github.com/CyberZHG/keras-lookahead
+
+
+class Lookahead(keras.optimizers.Optimizer):
+    """The lookahead mechanism for optimizers.
+
+    Default parameters follow those provided in the original paper.
+    # Arguments
+        optimizer: An existed optimizer.
+        sync_period: int > 0. The synchronization period.
+        slow_step: float, 0 < alpha < 1. The step size of slow weights.
+    # References
+        - [Lookahead Optimizer: k steps forward, 1 step back]
+          (https://arxiv.org/pdf/1907.08610v1.pdf)
+    """
+
+    def __init__(self, optimizer, sync_period=5, slow_step=0.5, **kwargs):
+        super(Lookahead, self).__init__(**kwargs)
+        self.optimizer = keras.optimizers.get(optimizer)
+        with K.name_scope(self.__class__.__name__):
+            self.sync_period = K.variable(sync_period, dtype='int64', name='sync_period')
+            self.slow_step = K.variable(slow_step, name='slow_step')
+
+    @property
+    def lr(self):
+        return self.optimizer.lr
+
+    @lr.setter
+    def lr(self, lr):
+        self.optimizer.lr = lr
+
+    @property
+    def learning_rate(self):
+        return self.optimizer.learning_rate
+
+    @learning_rate.setter
+    def learning_rate(self, learning_rate):
+        self.optimizer.learning_rate = learning_rate
+
+    @property
+    def iterations(self):
+        return self.optimizer.iterations
+
+    def get_updates(self, loss, params):
+        sync_cond = K.equal((self.iterations + 1) // self.sync_period * self.sync_period, (self.iterations + 1))
+        slow_params = [K.variable(K.get_value(p), name='sp_{}'.format(i)) for i, p in enumerate(params)]
+        self.updates = self.optimizer.get_updates(loss, params)
+        slow_updates = []
+        for p, sp in zip(params, slow_params):
+            sp_t = sp + self.slow_step * (p - sp)
+            slow_updates.append(
+                K.update(
+                    sp,
+                    K.switch(
+                        sync_cond,
+                        sp_t,
+                        sp,
+                    ),
+                )
+            )
+            slow_updates.append(
+                K.update_add(
+                    p,
+                    K.switch(
+                        sync_cond,
+                        sp_t - p,
+                        K.zeros_like(p),
+                    ),
+                )
+            )
+        self.updates += slow_updates
+        self.weights = self.optimizer.weights + slow_params
+        return self.updates
+
+    def get_config(self):
+        config = {
+            'optimizer': keras.optimizers.serialize(self.optimizer),
+            'sync_period': int(K.get_value(self.sync_period)),
+            'slow_step': float(K.get_value(self.slow_step)),
+        }
+        base_config = super(Lookahead, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+    @classmethod
+    def from_config(cls, config):
+        optimizer = keras.optimizers.deserialize(config.pop('optimizer'))
+        return cls(optimizer, **config)
+
+
+# https://github.com/keras-team/keras/issues/3893
+def build_masked_loss(loss_function, mask_value=MASK_VALUE):
+    """Builds a loss function that masks based on targets
+
+    Args:
+        loss_function: The loss function to mask
+        mask_value: The value to mask in the targets
+
+    Returns:
+        function: a loss function that acts like loss_function with masked inputs
+    """
+
+    def masked_loss_function(y_true, y_pred):
+        mask = K.cast(K.not_equal(y_true, mask_value), K.floatx())
+        return loss_function(y_true * mask, y_pred * mask)
+
+    return masked_loss_function
+
+
+def masked_accuracy(y_true, y_pred):
+    total = K.sum(K.not_equal(y_true, MASK_VALUE))
+    correct = K.sum(K.equal(y_true, K.round(y_pred)))
+    return correct / total
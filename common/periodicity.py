@@ -0,0 +1,196 @@
+"""Periodicity analysis (tempo estimation) as used in the baseline section (ch2)."""
+
+from functools import cached_property
+
+import numpy as np
+import librosa
+import scipy.fft
+import scipy.signal
+
+from .baseline import beat_track_dp
+from .features import SR, HOP_LENGTH
+from .tempo import tempo_hypotheses_from_acf
+
+
+def tempo_prior(bpms, start_bpm=120.0, std_bpm=1.0, max_tempo=320.0):
+    """Log-normal prior over tempi as used by `librosa.beat.tempo`."""
+    logprior = -0.5 * ((np.log2(bpms) - np.log2(start_bpm)) / std_bpm) ** 2
+    # kill everything above the max tempo
+    if max_tempo is not None:
+        max_idx = np.argmax(bpms < max_tempo)
+        logprior[:max_idx] = -np.inf
+    return logprior
+
+
+def lag_range(win_length, sr=SR, hop_length=HOP_LENGTH, min_bpm=None, max_bpm=None):
+    """Return the lags (in frames) of an autocorrelation corresponding to the given tempo range."""
+    fps = sr / hop_length
+    start = 0 if max_bpm is None else int(np.ceil(60.0 * fps / max_bpm))
+    stop = win_length if min_bpm is None else min(win_length, int(np.floor(60.0 * fps / min_bpm)) + 1)
+    return np.arange(start, stop)
+
+
+def global_autocorrelation(oenv, max_size, norm=True):
+    """Autocorrelation of the onset envelope for lags up to `max_size`.
+
+    Unlike `librosa.autocorrelate`, only the padding needed for the requested
+    lags is added and a real-valued FFT of (fast) length is used.
+    """
+    oenv = np.asarray(oenv, dtype=float)
+    max_size = int(min(max_size, len(oenv)))
+    n_fft = scipy.fft.next_fast_len(len(oenv) + max_size)
+    acf = scipy.fft.irfft(np.abs(scipy.fft.rfft(oenv, n_fft)) ** 2, n_fft)[:max_size]
+    return librosa.util.normalize(acf) if norm else acf
+
+
+def tempogram_blocks(oenv, win_length=384, sr=SR, hop_length=HOP_LENGTH, min_bpm=None, max_bpm=None,
+                     block_size=4096, center=True):
+    """Compute the local autocorrelation tempogram block-wise.
+
+    The windows are a strided view of the (padded) onset envelope, each block
+    of `block_size` frames is autocorrelated with a single batched FFT. Only
+    lags corresponding to tempi between `min_bpm` and `max_bpm` are returned,
+    hence the working set is bounded by the block size and the full
+    (lags x frames) tempogram never needs to be held in memory. Concatenated,
+    the blocks equal `librosa.feature.tempogram` (for the selected lags) up to
+    floating point precision.
+
+    Args:
+        oenv: onset envelope (e.g. spectral flux)
+        win_length: window length (in frames)
+        sr: sample rate
+        hop_length: hop length used to compute the onset envelope
+        min_bpm: minimum tempo to keep
+        max_bpm: maximum tempo to keep
+        block_size: number of frames processed at once
+        center: center the windows on the frames
+
+    Yields:
+        tuple: first frame of the block and the tempogram block (lags x frames)
+    """
+    oenv = np.asarray(oenv, dtype=float)
+    n = len(oenv)
+    if center:
+        oenv = np.pad(oenv, int(win_length // 2), mode='linear_ramp', end_values=[0, 0])
+    frames = np.lib.stride_tricks.sliding_window_view(oenv, win_length)[:n]
+    window = scipy.signal.get_window('hann', win_length, fftbins=True)
+    n_fft = scipy.fft.next_fast_len(2 * win_length - 1)
+    lags = lag_range(win_length, sr, hop_length, min_bpm, max_bpm)
+    tiny = np.finfo(float).tiny
+    for start in range(0, len(frames), block_size):
+        x = frames[start:start + block_size] * window
+        acf = scipy.fft.irfft(np.abs(scipy.fft.rfft(x, n_fft, axis=1)) ** 2, n_fft, axis=1)[:, :win_length]
+        # normalise by the maximum (i.e. lag 0) of each frame
+        length = np.max(np.abs(acf), axis=1, keepdims=True)
+        length[length < tiny] = 1.0
+        yield start, (acf[:, lags] / length).T
+
+
+def tempogram(oenv, win_length=384, sr=SR, hop_length=HOP_LENGTH, min_bpm=None, max_bpm=None, block_size=4096):
+    """Local autocorrelation tempogram (lags in the given tempo range x frames)."""
+    return np.hstack([block for _, block in tempogram_blocks(oenv, win_length, sr, hop_length, min_bpm, max_bpm,
+                                                               block_size)])
+
+
+def mean_tempogram(oenv, win_length=384, sr=SR, hop_length=HOP_LENGTH, min_bpm=None, max_bpm=None, block_size=4096):
+    """Mean local autocorrelation (lags in the given tempo range) computed block-wise."""
+    total = 0
+    for _, block in tempogram_blocks(oenv, win_length, sr, hop_length, min_bpm, max_bpm, block_size):
+        total = total + np.sum(block, axis=1)
+    return total / len(oenv)
+
+
+class PeriodicityAnalysis:
+    """Periodicity analysis of an onset envelope.
+
+    Computes the local tempogram, the global autocorrelation, the tempo
+    frequencies and the (prior weighted) tempo estimate of the baseline
+    section without plotting anything. All results are computed on first
+    access only and then cached, so they can be shared by plotting, tempo
+    estimation and beat tracking.
+
+    The tempo is estimated the same way `librosa.beat.tempo` does it, i.e. from
+    the mean of a tempogram computed with a window of `ac_size` seconds. If
+    this window equals `win_length`, the tempogram is shared as well,
+    otherwise the mean is computed block-wise without keeping the tempogram.
+
+    Args:
+        oenv: onset envelope (e.g. spectral flux)
+        sr: sample rate
+        hop_length: hop length used to compute the onset envelope
+        win_length: window length (in frames) of the local tempogram
+        ac_size: window length (in seconds) used for tempo estimation
+        start_bpm: centre of the tempo prior
+        std_bpm: standard deviation (in octaves) of the tempo prior
+        max_tempo: maximum tempo (in BPM) to consider
+    """
+
+    def __init__(self, oenv, sr=SR, hop_length=HOP_LENGTH, win_length=384, ac_size=8.0, start_bpm=120.0,
+                 std_bpm=1.0, max_tempo=320.0):
+        self.oenv = oenv
+        self.sr = sr
+        self.hop_length = hop_length
+        self.win_length = win_length
+        self.ac_size = ac_size
+        self.start_bpm = start_bpm
+        self.std_bpm = std_bpm
+        self.max_tempo = max_tempo
+
+    @property
+    def fps(self):
+        return self.sr / self.hop_length
+
+    @cached_property
+    def tempogram(self):
+        """Local (autocorrelation) tempogram with shape (lags x frames)."""
+        return tempogram(self.oenv, self.win_length, self.sr, self.hop_length)
+
+    @cached_property
+    def mean_local_acf(self):
+        """Mean local autocorrelation, i.e. the tempogram averaged over time."""
+        return np.mean(self.tempogram, axis=1)
+
+    @cached_property
+    def global_acf(self):
+        """Normalised global autocorrelation of the onset envelope."""
+        return global_autocorrelation(self.oenv, self.win_length)
+
+    @cached_property
+    def lags(self):
+        """Lags (in seconds) of the autocorrelation functions."""
+        return np.linspace(0, self.win_length * float(self.hop_length) / self.sr, num=self.win_length)
+
+    @cached_property
+    def tempo_frequencies(self):
+        """Tempi (in BPM) corresponding to the lags of the autocorrelation functions."""
+        return librosa.tempo_frequencies(self.win_length, hop_length=self.hop_length, sr=self.sr)
+
+    @cached_property
+    def tempo_strength(self):
+        """Tempo strength (i.e. mean local autocorrelation) used for tempo estimation."""
+        win_length = librosa.time_to_frames(self.ac_size, sr=self.sr, hop_length=self.hop_length).item()
+        if win_length == self.win_length:
+            return self.mean_local_acf
+        # the tempogram itself is not needed, thus do not keep it in memory
+        return mean_tempogram(self.oenv, win_length, self.sr, self.hop_length)
+
+    @cached_property
+    def tempo_prior(self):
+        """Log prior over the tempi of `tempo_strength`."""
+        bpms = librosa.tempo_frequencies(len(self.tempo_strength), hop_length=self.hop_length, sr=self.sr)
+        return tempo_prior(bpms, self.start_bpm, self.std_bpm, self.max_tempo)
+
+    @cached_property
+    def tempo(self):
+        """Prior weighted tempo estimate (in BPM), same as `librosa.beat.tempo`."""
+        bpms = librosa.tempo_frequencies(len(self.tempo_strength), hop_length=self.hop_length, sr=self.sr)
+        return bpms[np.argmax(np.log1p(1e6 * self.tempo_strength) + self.tempo_prior)]
+
+    def tempo_hypotheses(self, k=3, min_bpm=30.0, max_bpm=None):
+        """Return the `k` strongest (prior weighted) tempo hypotheses as (tempo, strength) rows."""
+        max_bpm = self.max_tempo if max_bpm is None else max_bpm
+        return tempo_hypotheses_from_acf(self.tempo_strength, self.fps, k, min_bpm, max_bpm, prior=self.tempo_prior)
+
+    def beat_track(self, tightness=100, alpha=0.5):
+        """Track the beats with the estimated tempo, see `beat_track_dp`."""
+        return beat_track_dp(self.oenv, self.tempo, self.fps, self.sr, self.hop_length, tightness, alpha)
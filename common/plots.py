@@ -0,0 +1,58 @@
+"""Plotting helpers of the baseline section (ch2)."""
+
+import numpy as np
+import librosa
+import librosa.display
+import matplotlib.pyplot as plt
+
+from .periodicity import PeriodicityAnalysis
+
+
+def periodicity_estimation_plots(oenv, sr, hop_length, ref_beats=None, analysis=None):
+    """Plot the onset envelope, tempogram and autocorrelation functions.
+
+    Args:
+        oenv: onset envelope (e.g. spectral flux)
+        sr: sample rate
+        hop_length: hop length used to compute the onset envelope
+        ref_beats: annotated beats (used to derive a reference tempo)
+        analysis: pre-computed `PeriodicityAnalysis` of `oenv`
+
+    Returns:
+        float: estimated tempo
+    """
+    if analysis is None:
+        analysis = PeriodicityAnalysis(oenv, sr=sr, hop_length=hop_length)
+    tempogram = analysis.tempogram
+    tempo = analysis.tempo
+
+    fig, ax = plt.subplots(nrows=4, figsize=(14, 14))
+    times = librosa.times_like(oenv, sr=sr, hop_length=hop_length)
+    ax[0].plot(times, oenv)
+    ax[0].set_title('Spectral flux', fontsize=15)
+    ax[0].label_outer()
+    ax[0].set(xlim=[0, len(oenv) / analysis.fps])
+    librosa.display.specshow(tempogram, sr=sr, hop_length=hop_length, x_axis='time', y_axis='tempo', cmap='magma',
+                             ax=ax[1])
+    ax[1].axhline(tempo, color='w', linestyle='--', alpha=1, label='Estimated tempo={:g}'.format(tempo))
+    ax[1].legend(loc='upper right')
+    ax[1].set_title('Tempogram', fontsize=15)
+    ax[2].plot(analysis.lags, analysis.mean_local_acf, label='Mean local autocorrelation')
+    ax[2].plot(analysis.lags, analysis.global_acf, '--', alpha=0.75, label='Global autocorrelation')
+    ax[2].set(xlabel='Lag (seconds)')
+    ax[2].legend(frameon=True)
+    freqs = analysis.tempo_frequencies
+    ax[3].semilogx(freqs[1:], analysis.mean_local_acf[1:], label='Mean local autocorrelation', base=2)
+    ax[3].semilogx(freqs[1:], analysis.global_acf[1:], '--', alpha=0.75, label='Global autocorrelation', base=2)
+    ax[3].axvline(tempo, color='black', linestyle='--', alpha=.8, label='Estimated tempo={:g}'.format(tempo))
+
+    if ref_beats is not None:
+        gt_tempo = 60. / np.median(np.diff(ref_beats))
+        ax[3].axvline(gt_tempo, color='red', linestyle='--', alpha=.8,
+                      label='Tempo derived from beat annotations={:g}'.format(gt_tempo))
+
+    ax[3].legend(frameon=True)
+    ax[3].legend(loc='upper right')
+    ax[3].set(xlabel='BPM')
+    ax[3].grid(True)
+    return tempo
@@ -0,0 +1,100 @@
+"""Post-processing of the network's activations (beat, downbeat, bar tracking and tempo detection).
+
+Same as the `predict` function of the notebook, but split per track so it can
+run in worker processes. This module does not import Keras, i.e. worker
+processes start quickly and do not hold a copy of TensorFlow.
+"""
+
+import os
+import time
+
+import madmom
+import numpy as np
+from scipy.ndimage import maximum_filter1d
+
+from .tempo import detect_tempo
+
+FPS = 100
+
+# trackers of the current (worker) process, see `_post_process`
+_trackers = None
+
+
+def create_trackers(fps=FPS):
+    """Create the beat, downbeat and bar trackers (same settings as the notebook)."""
+    # track beats with a DBN
+    beat_tracker = madmom.features.beats.DBNBeatTrackingProcessor(
+        min_bpm=55.0, max_bpm=215.0, fps=fps, transition_lambda=100, threshold=0.05
+    )
+    # track downbeats with a DBN
+    # as input, use a combined beat & downbeat activation function
+    downbeat_tracker = madmom.features.downbeats.DBNDownBeatTrackingProcessor(
+        beats_per_bar=[3, 4], min_bpm=55.0, max_bpm=215.0, fps=fps, transition_lambda=100
+    )
+    # track bars, i.e. first track the beats and then infer the downbeat positions
+    bar_tracker = madmom.features.downbeats.DBNBarTrackingProcessor(
+        beats_per_bar=(3, 4), meter_change_prob=1e-3, observation_weight=4
+    )
+    return beat_tracker, downbeat_tracker, bar_tracker
+
+
+def activation_dict(beats_act, downbeats_act, tempo_act):
+    """Collect the activations of a track the same way the notebook does."""
+    combined_act = np.vstack((np.maximum(beats_act - downbeats_act, 0), downbeats_act)).T
+    return {'beats': beats_act, 'downbeats': downbeats_act, 'combined': combined_act, 'tempo': tempo_act}
+
+
+def post_process(activations, trackers, fps=FPS):
+    """Detect beats, downbeats, bars and tempo from the activations of a track.
+
+    Args:
+        activations: activations of the track (see `activation_dict`)
+        trackers: beat, downbeat and bar tracker (see `create_trackers`)
+        fps: frame rate of the activations
+
+    Returns:
+        dict: detected beats, downbeats, bars and tempo
+    """
+    beat_tracker, downbeat_tracker, bar_tracker = trackers
+    # beats
+    beats = beat_tracker(activations['beats'])
+    # downbeats (the same as for bars, if no beats are found at all)
+    try:
+        downbeats = downbeat_tracker(activations['combined'])
+    except IndexError:
+        downbeats = np.empty((0, 2))
+    # bars (i.e. track beats and then downbeats)
+    beat_idx = (beats * fps).astype(int)
+    bar_act = maximum_filter1d(activations['downbeats'], size=3)
+    bar_act = bar_act[beat_idx]
+    bar_act = np.vstack((beats, bar_act)).T
+    try:
+        bars = bar_tracker(bar_act)
+    except IndexError:
+        bars = np.empty((0, 2))
+    # tempo
+    tempo = detect_tempo(activations['tempo'])
+    return {'beats': beats, 'downbeats': downbeats, 'bars': bars, 'tempo': tempo}
+
+
+def _post_process(key, beats_act, downbeats_act, tempo_act, fps=FPS):
+    """Post-process a track in a worker process; return its detections and the time it took."""
+    global _trackers
+    start = time.perf_counter()
+    # the trackers are created only once per process
+    if _trackers is None:
+        _trackers = create_trackers(fps)
+    detections = post_process(activation_dict(beats_act, downbeats_act, tempo_act), _trackers, fps)
+    return key, detections, time.perf_counter() - start
+
+
+def save_detections(detdir, key, activations, detections):
+    """Save the activations & detections of a track (same files as the notebook)."""
+    os.makedirs(detdir, exist_ok=True)
+    np.save('%s/%s.beats.npy' % (detdir, key), activations['beats'])
+    np.save('%s/%s.downbeats.npy' % (detdir, key), activations['downbeats'])
+    np.save('%s/%s.tempo.npy' % (detdir, key), activations['tempo'])
+    madmom.io.write_beats(detections['beats'], '%s/%s.beats.txt' % (detdir, key))
+    madmom.io.write_beats(detections['downbeats'], '%s/%s.downbeats.txt' % (detdir, key))
+    madmom.io.write_beats(detections['bars'], '%s/%s.bars.txt' % (detdir, key))
+    madmom.io.write_tempo(detections['tempo'], '%s/%s.bpm.txt' % (detdir, key))
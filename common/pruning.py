@@ -0,0 +1,330 @@
+"""Structured pruning of the TCN and search for the best accuracy/speed trade-off.
+
+Filters of the dilated convolutions are pruned per `residual_block`, ranked
+either by the magnitude of their weights or by their mean (absolute)
+activation on a sample of tracks. Blocks with the largest dilations can be
+dropped as well (depth). The width (`num_filters`) can be reduced, too: the
+filters of the conv layers of the front end are pruned per layer, the
+channels of the residual/skip connections are shared by all blocks (and are
+the input of the output layers, e.g. the tempo head), hence the same
+channels are kept everywhere. The kernel size of the dilated convolutions
+is changed by keeping the taps with the same offsets (in time), missing
+taps are zero. Pruned models are fine-tuned briefly, their speed is
+measured with the NumPy runtime and their performance with the notebook's
+evaluation, resulting in a Pareto table of frames/sec vs. scores.
+"""
+
+import itertools
+import time
+
+import keras.backend as K
+import numpy as np
+
+from .evaluation import evaluate, scores
+from .inference import InferenceEngine
+from .model import Lookahead, RAdam, build_masked_loss, create_model
+from .runtime import NumpyTCN
+
+OBJECTIVES = ('frames_per_sec', 'beats_fmeasure', 'downbeats_fmeasure', 'tempo_acc1')
+# conv layers of the front end pruned per layer (the filters of the last one are the residual channels)
+FRONT_END = ('conv_1_conv', 'conv_2_conv')
+# conv layers of the front end reading the filters of the previous one
+PREVIOUS = {'conv_2_conv': 'conv_1_conv', 'conv_3_conv': 'conv_2_conv'}
+# key of the channels of the residual/skip connections in `filter_importance`
+RESIDUAL = 'residual'
+
+
+def _blocks(model):
+    """Names and dilation rates of the residual blocks of a (Keras) model."""
+    blocks = []
+    for layer in model.layers:
+        if layer.name.endswith('_dilated_conv_1'):
+            blocks.append((layer.name[:-len('_dilated_conv_1')], layer.get_config()['dilation_rate'][0]))
+    return blocks
+
+
+class _ActivationStats(NumpyTCN):
+    """Accumulate the mean absolute activation of the filters of the conv layers and the residual channels."""
+
+    def __init__(self, model):
+        super().__init__(model.weights, **model.config)
+        self.sums = {}
+        self.counts = {}
+
+    def _add(self, key, x):
+        x = np.abs(x).reshape(-1, x.shape[-1])
+        self.sums[key] = self.sums.get(key, 0) + np.sum(x, axis=0)
+        self.counts[key] = self.counts.get(key, 0) + len(x)
+
+    def _input(self, name, x):
+        if name.endswith('_1x1_conv'):
+            # the input of the 1x1 conv. are the activated dilated convolutions
+            self._add(name, x)
+        elif name.endswith('_1x1_conv_residual'):
+            # the input of each residual block are the residual channels
+            self._add(RESIDUAL, x)
+        elif name in PREVIOUS:
+            # the (pooled) activations of the previous conv layer
+            self._add(PREVIOUS[name], x)
+        return x
+
+    def mean(self, key):
+        return self.sums[key] / self.counts[key]
+
+
+def filter_importance(model, method='magnitude', sequence=None, num_tracks=8, seed=None):
+    """Rank the filters of the dilated convolutions of each residual block.
+
+    Args:
+        model: Keras model
+        method: 'magnitude' (L1 norm of the filter weights) or 'activation'
+            (mean absolute activation on a sample of tracks)
+        sequence: sequence yielding single tracks (needed for 'activation')
+        num_tracks: number of (randomly chosen) tracks used for 'activation'
+        seed: random seed used to choose the tracks
+
+    Returns:
+        dict: block name -> importance of the filters of the first and the
+            second dilated convolution, name of the front end conv layers ->
+            importance of their filters and `RESIDUAL` -> importance of the
+            channels of the residual/skip connections
+    """
+    if method == 'magnitude':
+
+        def magnitude(name):
+            # L1 norm of the weights of each filter (i.e. output channel)
+            kernel = model.get_layer(name).get_weights()[0]
+            return np.sum(np.abs(kernel.reshape(-1, kernel.shape[-1])), axis=0)
+
+        importance = {}
+        for block, _ in _blocks(model):
+            importance[block] = tuple(magnitude(block + suffix) for suffix in ('_dilated_conv_1', '_dilated_conv_2'))
+        for name in FRONT_END:
+            importance[name] = magnitude(name)
+        # all layers writing into the residual channels
+        importance[RESIDUAL] = magnitude('conv_3_conv') + sum(magnitude(block + suffix) for block, _ in _blocks(model)
+                                                              for suffix in ('_1x1_conv_residual', '_1x1_conv'))
+        return importance
+    if method == 'activation':
+        stats = _ActivationStats(NumpyTCN.from_keras(model))
+        rng = np.random.RandomState(seed)
+        for idx in rng.permutation(len(sequence))[:num_tracks]:
+            stats.forward(sequence[int(idx)][0][0])
+        importance = {}
+        for block, _ in _blocks(model):
+            importance[block] = tuple(np.split(stats.mean(block + '_1x1_conv'), 2))
+        for name in FRONT_END + (RESIDUAL,):
+            importance[name] = stats.mean(name)
+        return importance
+    raise ValueError("unknown method '%s', use 'magnitude' or 'activation'" % method)
+
+
+def _most_important(scores, num):
+    """Indices of the `num` highest scores (in ascending order)."""
+    return np.sort(np.argsort(scores)[::-1][:num])
+
+
+def resize_kernel(kernel, size, dilation_rate, padding):
+    """Change the size of a (dilated) Conv1D kernel, keeping the taps with the same offsets in time.
+
+    Taps not present in the original kernel are zero, i.e. enlarging a
+    kernel does not change the output of the convolution.
+    """
+    old_size = len(kernel)
+
+    def offsets(num_taps):
+        # offset (in frames) of each tap relative to the output frame
+        taps = np.arange(num_taps) * dilation_rate
+        return taps - taps[-1] if padding == 'causal' else taps - taps[-1] // 2
+
+    old = {offset: tap for tap, offset in enumerate(offsets(old_size))}
+    resized = np.zeros((size,) + kernel.shape[1:], dtype=kernel.dtype)
+    for tap, offset in enumerate(offsets(size)):
+        if offset in old:
+            resized[tap] = kernel[old[offset]]
+    return resized
+
+
+def prune_model(model, keep=1.0, num_dilations=None, method='magnitude', sequence=None, importance=None,
+                num_filters=None, kernel_size=None):
+    """Create a smaller copy of a model by pruning the filters of its residual blocks.
+
+    Args:
+        model: (trained) Keras model created by `create_model`
+        keep: fraction of filters of the dilated convolutions to keep, either
+            the same for all blocks or a list with a value per block
+        num_dilations: number of residual blocks to keep (None: all)
+        method: how to rank the filters, see `filter_importance`
+        sequence: sequence used to rank the filters by their activations
+        importance: pre-computed `filter_importance` (computed if None)
+        num_filters: number of filters of the front end conv layers and of
+            the residual/skip channels (None: same as the model)
+        kernel_size: kernel size of the dilated convolutions (None: same as
+            the model)
+
+    Returns:
+        keras.Model: pruned (not compiled) model with the remaining weights
+    """
+    blocks = _blocks(model)
+    num_dilations = num_dilations or len(blocks)
+    keep = [keep] * num_dilations if np.isscalar(keep) else list(keep)[:num_dilations]
+    if importance is None:
+        importance = filter_importance(model, method, sequence)
+    # keep the most important filters of each dilated convolution
+    selected = {}
+    for (block, _), fraction in zip(blocks[:num_dilations], keep):
+        selected[block] = [_most_important(scores, max(1, int(round(fraction * len(scores)))))
+                           for scores in importance[block]]
+    # keep the most important filters of the front end and residual channels
+    conv = model.get_layer(blocks[0][0] + '_dilated_conv_1').get_config()
+    num_filters = num_filters or model.get_layer('conv_1_conv').get_config()['filters']
+    kernel_size = kernel_size or conv['kernel_size'][0]
+    for name in FRONT_END + (RESIDUAL,):
+        selected[name] = _most_important(importance[name], num_filters)
+    # same hyper-parameters as the original model otherwise
+    pruned = create_model(
+        model.input_shape[1:],
+        num_filters=num_filters,
+        num_dilations=num_dilations,
+        kernel_size=kernel_size,
+        activation=model.get_layer('conv_1_activation').get_config()['activation'],
+        dropout_rate=model.get_layer('conv_1_dropout').get_config()['rate'],
+        padding=conv['padding'],
+        inner_filters=[len(selected[block][0]) for block, _ in blocks[:num_dilations]],
+    )
+    # copy the weights, slicing the pruned input channels and filters (output channels)
+    for layer in pruned.layers:
+        if not layer.weights:
+            continue
+        name = layer.name
+        kernel, bias = model.get_layer(name).get_weights()
+        if name == 'conv_1_conv':
+            inputs, outputs = None, selected[name]
+        elif name in PREVIOUS:
+            inputs = selected[PREVIOUS[name]]
+            outputs = selected[RESIDUAL] if name == 'conv_3_conv' else selected[name]
+        elif name.endswith(('_dilated_conv_1', '_dilated_conv_2')):
+            inputs, outputs = selected[RESIDUAL], selected[name[:-len('_dilated_conv_1')]][int(name[-1]) - 1]
+            config = model.get_layer(name).get_config()
+            kernel = resize_kernel(kernel, kernel_size, config['dilation_rate'][0], config['padding'])
+        elif name.endswith('_1x1_conv'):
+            # the 1x1 conv. combines the (concatenated) outputs of both dilated convolutions
+            block = name[:-len('_1x1_conv')]
+            inputs = np.concatenate([selected[block][0], len(importance[block][0]) + selected[block][1]])
+            outputs = selected[RESIDUAL]
+        elif name.endswith('_1x1_conv_residual'):
+            inputs, outputs = selected[RESIDUAL], selected[RESIDUAL]
+        else:
+            # output layers
+            inputs, outputs = selected[RESIDUAL], None
+        if inputs is not None:
+            kernel = kernel.take(inputs, axis=-2)
+        if outputs is not None:
+            kernel, bias = kernel.take(outputs, axis=-1), bias[outputs]
+        layer.set_weights([kernel, bias])
+    return pruned
+
+
+def compile_model(model, learnrate=0.002, clipnorm=0.5, optimizer=None):
+    """Compile a (pruned) model the same way as the notebook does."""
+    model.compile(
+        optimizer=optimizer or Lookahead(RAdam(lr=learnrate, clipnorm=clipnorm)),
+        loss=[
+            build_masked_loss(K.binary_crossentropy),
+            build_masked_loss(K.binary_crossentropy),
+            build_masked_loss(K.binary_crossentropy),
+        ],
+        metrics=['binary_accuracy'],
+    )
+    return model
+
+
+def frames_per_second(model, num_frames=6000, num_runs=3):
+    """Measure the inference speed (frames/sec) of a model with the NumPy runtime (see `NumpyTCN`)."""
+    runtime = NumpyTCN.from_keras(model)
+    x = np.random.RandomState(0).rand(1, num_frames, *model.input_shape[2:]).astype(np.float32)
+    runtime.predict(x)
+    start = time.perf_counter()
+    for _ in range(num_runs):
+        runtime.predict(x)
+    return num_frames * num_runs / (time.perf_counter() - start)
+
+
+def score_model(model, dataset, tracks, batch_size=8, infer_missing_tempo=False):
+    """Evaluate a model on a dataset, return the beat/downbeat F-measures and tempo accuracies (see `scores`)."""
+    _, detections = InferenceEngine(NumpyTCN.from_keras(model), batch_size, num_workers=0).predict(dataset)
+    return scores(evaluate(detections, tracks, infer_missing_tempo))
+
+
+def pareto_front(rows, objectives=OBJECTIVES):
+    """Mark the rows not dominated by any other row (all objectives are maximised)."""
+    objectives = [key for key in objectives if all(key in row for row in rows)]
+    for row in rows:
+        row['pareto'] = not any(all(other[key] >= row[key] for key in objectives) and
+                                any(other[key] > row[key] for key in objectives) for other in rows)
+    return rows
+
+
+def pruning_search(model, train, test, tracks, keep=(1.0, 0.75, 0.5, 0.25), num_dilations=(None,),
+                   num_filters=(None,), kernel_size=(None,), method='magnitude', epochs=2, compile_fn=compile_model,
+                   batch_size=8, infer_missing_tempo=False):
+    """Prune a model to different sizes, fine-tune and evaluate them.
+
+    All combinations of the given values are evaluated.
+
+    Args:
+        model: (trained) Keras model created by `create_model`
+        train: sequence used to fine-tune the pruned models (and to rank the
+            filters by their activations)
+        test: sequence used for evaluation
+        tracks: dictionary with mirdata tracks (i.e. the annotations)
+        keep: fractions of filters of the dilated convolutions to keep
+        num_dilations: numbers of residual blocks to keep (None: all)
+        num_filters: numbers of filters of the front end and of residual
+            channels (None: same as the model)
+        kernel_size: kernel sizes of the dilated convolutions (None: same
+            as the model)
+        method: how to rank the filters, see `filter_importance`
+        epochs: number of epochs to fine-tune each pruned model
+        compile_fn: function compiling the pruned models
+        batch_size: number of tracks per forward pass for evaluation
+        infer_missing_tempo: see `evaluate`
+
+    Returns:
+        list: a row per configuration with the number of parameters, the
+            frames/sec, the scores and whether it is on the Pareto front;
+            the pruned models are returned in the 'model' column
+    """
+    importance = filter_importance(model, method, train)
+    blocks = _blocks(model)
+    original = {'num_dilations': len(blocks), 'num_filters': model.get_layer('conv_1_conv').get_config()['filters'],
+                'kernel_size': model.get_layer(blocks[0][0] + '_dilated_conv_1').get_config()['kernel_size'][0]}
+    rows = []
+    for depth, width, size, fraction in itertools.product(num_dilations, num_filters, kernel_size, keep):
+        pruned = prune_model(model, fraction, depth, importance=importance, num_filters=width, kernel_size=size)
+        row = {'keep': fraction, 'num_dilations': depth or original['num_dilations'],
+               'num_filters': width or original['num_filters'], 'kernel_size': size or original['kernel_size']}
+        if epochs and (fraction < 1 or any(row[key] != value for key, value in original.items())):
+            compile_fn(pruned)
+            pruned.fit_generator(train, steps_per_epoch=len(train), epochs=epochs, shuffle=True, verbose=0)
+        row.update({'params': pruned.count_params(), 'frames_per_sec': frames_per_second(pruned)})
+        row.update(score_model(pruned, test, tracks, batch_size, infer_missing_tempo))
+        row['model'] = pruned
+        rows.append(row)
+    return pareto_front(rows)
+
+
+def format_table(rows):
+    """Format the rows of `pruning_search` as a table (Pareto-optimal rows marked with '*')."""
+    columns = [key for key in rows[0] if key not in ('model', 'pareto')]
+    lines = [' '.join('%14s' % key for key in columns)]
+    for row in sorted(rows, key=lambda row: -row['frames_per_sec']):
+        values = ['%14.4g' % row[key] if isinstance(row[key], float) else '%14s' % row[key] for key in columns]
+        lines.append(' '.join(values) + (' *' if row['pareto'] else ''))
+    return '\n'.join(lines)
+
+
+def smallest_model(rows, floor):
+    """Return the fastest row meeting the accuracy floor (e.g. {'beats_fmeasure': 0.75}), None if there is none."""
+    candidates = [row for row in rows if all(row[key] >= value for key, value in floor.items())]
+    return max(candidates, key=lambda row: row['frames_per_sec']) if candidates else None
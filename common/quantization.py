@@ -0,0 +1,199 @@
+"""Post-training int8 quantization analysis of the multi-task TCN.
+
+Weights are quantized symmetrically per output channel, the inputs of all
+layers (conv, dilated conv, 1x1 conv and dense layers) with an affine
+(scale and zero point) int8 quantizer, whose range is calibrated on a
+sample of tracks. Biases are kept in float32.
+
+`QuantizedTCN` keeps only the int8 weights in memory. Every layer quantizes
+its input to int8, multiplies it with the int8 kernel accumulating in int32
+and corrects for the zero point of the input, the same integer arithmetic
+as int8 kernels (e.g. of TFLite) use. Only the int32 result is rescaled to
+float32 (and the bias added), followed by the activation function.
+
+Note: this is a tool to measure what int8 inference would cost in accuracy
+and gain in size (a quarter of the float weights), not an inference path.
+NumPy's integer matrix multiplication does not use BLAS, hence
+`QuantizedTCN` is about 4x slower than the float model (`NumpyTCN`). Nor
+were optimised int8 kernels faster on a single CPU core: a TFLite int8
+model of `create_model` needed as long as `NumpyTCN` and twice as long as
+Keras (6000 frames). Use the float model for inference.
+"""
+
+import time
+
+import numpy as np
+
+from .evaluation import evaluate, scores
+from .inference import InferenceEngine
+from .runtime import NumpyTCN, conv1d, conv2d
+
+NUM_LEVELS = 256
+QMIN, QMAX = -128, 127
+
+
+def quantize_kernel(kernel):
+    """Quantize a kernel symmetrically per output channel (last axis).
+
+    Returns:
+        tuple: int8 kernel and the scale of each output channel
+    """
+    max_abs = np.max(np.abs(kernel.reshape(-1, kernel.shape[-1])), axis=0)
+    scale = np.where(max_abs > 0, max_abs / QMAX, 1).astype(np.float32)
+    return np.clip(np.round(kernel / scale), -QMAX, QMAX).astype(np.int8), scale
+
+
+def quantization_params(low, high):
+    """Scale and zero point of an affine int8 quantizer covering [low, high] (and 0)."""
+    low, high = min(low, 0.0), max(high, 0.0)
+    scale = (high - low) / (NUM_LEVELS - 1) or 1.0
+    zero_point = int(np.clip(np.round(QMIN - low / scale), QMIN, QMAX))
+    return np.float32(scale), zero_point
+
+
+class _Calibrator(NumpyTCN):
+    """Record the range of the inputs of all layers."""
+
+    def __init__(self, model, percentile=99.99):
+        super().__init__(model.weights, **model.config)
+        self.percentile = percentile
+        self.ranges = {}
+
+    def _input(self, name, x):
+        low, high = np.percentile(x, [100 - self.percentile, self.percentile])
+        if name in self.ranges:
+            low, high = min(low, self.ranges[name][0]), max(high, self.ranges[name][1])
+        self.ranges[name] = low, high
+        return x
+
+
+class QuantizedTCN(NumpyTCN):
+    """Multi-task TCN with int8 weights and activations (emulated in NumPy, for analysis only).
+
+    Args:
+        kernels: layer name -> (int8 kernel, scales, float bias)
+        activations: layer name -> (scale, zero point) of the layer's input
+        **kwargs: see `NumpyTCN`
+    """
+
+    def __init__(self, kernels, activations, **kwargs):
+        # the int8 kernels are the only copy of the weights
+        super().__init__({name: [q, bias] for name, (q, _, bias) in kernels.items()}, **kwargs)
+        self.kernels = kernels
+        self.activations = activations
+        # scale of the integer result of each layer, i.e. product of input and weight scales
+        self.scales = {name: activations[name][0] * scale for name, (_, scale, _) in kernels.items()}
+
+    @classmethod
+    def calibrate(cls, model, dataset, num_tracks=32, percentile=99.99, seed=None):
+        """Quantize a model, calibrating the activation ranges on a sample of tracks.
+
+        Args:
+            model: `NumpyTCN` with float weights
+            dataset: sequence yielding single tracks (e.g. `DataSequence`)
+            num_tracks: number of (randomly chosen) tracks used for calibration
+            percentile: percentile of the values used as the range of the
+                inputs of a layer (100: min./max.), ignoring outliers
+            seed: random seed used to choose the tracks
+
+        Returns:
+            QuantizedTCN: quantized model
+        """
+        calibrator = _Calibrator(model, percentile)
+        rng = np.random.RandomState(seed)
+        for idx in rng.permutation(len(dataset))[:num_tracks]:
+            calibrator.forward(dataset[int(idx)][0][0])
+        kernels = {name: quantize_kernel(kernel) + (bias,) for name, (kernel, bias) in model.weights.items()}
+        activations = {name: quantization_params(*calibrator.ranges[name]) for name in kernels}
+        return cls(kernels, activations, **model.config)
+
+    def _input(self, name, x):
+        """Quantize the input of a layer to int8."""
+        scale, zero_point = self.activations[name]
+        return np.clip(np.round(x / scale) + zero_point, QMIN, QMAX).astype(np.int8)
+
+    def _integer_kernel(self, name):
+        """Kernel (widened to int32 for accumulating) and the correction for the zero point of the input."""
+        kernel = self.kernels[name][0].astype(np.int32)
+        # sum((q - zero_point) * w) = sum(q * w) - zero_point * sum(w)
+        correction = -self.activations[name][1] * kernel.reshape(-1, kernel.shape[-1]).sum(axis=0)
+        return kernel, correction
+
+    def _output(self, name, acc):
+        """Rescale the int32 result of a layer and add the bias."""
+        return acc.astype(np.float32) * self.scales[name] + self.kernels[name][2]
+
+    def _conv2d(self, name, x):
+        return self._output(name, conv2d(self._input(name, x), *self._integer_kernel(name)))
+
+    def _conv1d(self, name, x, dilation_rate=1):
+        # pad with the zero point, i.e. the integer representing 0
+        return self._output(name, conv1d(self._input(name, x), *self._integer_kernel(name), dilation_rate,
+                                         self.padding, self.activations[name][1]))
+
+    def _dense(self, name, x):
+        kernel, correction = self._integer_kernel(name)
+        return self._output(name, self._input(name, x) @ kernel + correction)
+
+    @property
+    def num_bytes(self):
+        """Size (in bytes) of the quantized parameters (int8 kernels, float32 scales and biases)."""
+        return sum(q.nbytes + scale.nbytes + bias.nbytes for q, scale, bias in self.kernels.values())
+
+    def save(self, path):
+        """Save the quantized model (int8 weights) to a `.npz` file."""
+        arrays = {}
+        for name, (q, scale, bias) in self.kernels.items():
+            arrays[name + '/kernel'] = q
+            arrays[name + '/scale'] = scale
+            arrays[name + '/bias'] = bias
+            arrays[name + '/input'] = np.array(self.activations[name], dtype=np.float64)
+        np.savez(path, **arrays, config=np.array(list(self.config.items()), dtype=str))
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Load a quantized model saved with `save`."""
+        with np.load(path) as f:
+            names = {key.rsplit('/', 1)[0] for key in f.files if '/' in key}
+            kernels = {name: (f[name + '/kernel'], f[name + '/scale'], f[name + '/bias']) for name in names}
+            activations = {name: (np.float32(f[name + '/input'][0]), int(f[name + '/input'][1])) for name in names}
+            config = dict(f['config'].tolist())
+        config.update(kwargs)
+        return cls(kernels, activations, **config)
+
+
+def quantization_report(model, dataset, tracks, calibration=None, num_tracks=32, percentile=99.99, batch_size=8,
+                        seed=None, infer_missing_tempo=False):
+    """Quantize a model and compare size and performance with the float model.
+
+    The quantized model is only evaluated, not timed (see the module's
+    docstring).
+
+    Args:
+        model: `NumpyTCN` with float weights
+        dataset: sequence with the tracks to evaluate (e.g. test `DataSequence`)
+        tracks: dictionary with mirdata tracks (i.e. the annotations)
+        calibration: sequence used for calibration (None: use `dataset`)
+        num_tracks: number of tracks used for calibration
+        percentile: see `QuantizedTCN.calibrate`
+        batch_size: number of tracks per forward pass
+        seed: random seed used to choose the calibration tracks
+        infer_missing_tempo: see `evaluate`
+
+    Returns:
+        tuple: quantized model and a dictionary with the size of the
+            parameters and the scores (see `scores`) of the float and the
+            int8 model
+    """
+    start = time.perf_counter()
+    quantized = QuantizedTCN.calibrate(model, dataset if calibration is None else calibration, num_tracks,
+                                       percentile, seed)
+    calibration_time = time.perf_counter() - start
+    report = {}
+    for name, predictor in (('float', model), ('int8', quantized)):
+        _, detections = InferenceEngine(predictor, batch_size, num_workers=0).predict(dataset)
+        report[name] = {'num_bytes': sum(w.nbytes for weights in model.weights.values() for w in weights)
+                        if name == 'float' else quantized.num_bytes}
+        report[name].update(scores(evaluate(detections, tracks, infer_missing_tempo)))
+    report['calibration_time'] = calibration_time
+    return quantized, report
@@ -0,0 +1,220 @@
+"""Lightweight NumPy inference runtime for the multi-task TCN.
+
+Inference only needs the forward pass of `create_model`, i.e. three conv /
+max. pooling blocks, the stack of dilated residual blocks and the dense
+output layers. `NumpyTCN` reads the weights of a trained model (as saved by
+Keras, e.g. `model_best.h5`) and computes the same activations with NumPy
+only. Dropout and Gaussian noise are only active during training and thus
+elided. Neither TensorFlow nor Keras are imported, hence worker processes
+start quickly and need only a fraction of the memory.
+"""
+
+import re
+import time
+
+import h5py
+import numpy as np
+
+
+def elu(x):
+    """Exponential linear unit (alpha=1)."""
+    return np.where(x > 0, x, np.expm1(np.minimum(x, 0)))
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def softmax(x, axis=-1):
+    e = np.exp(x - np.max(x, axis=axis, keepdims=True))
+    return e / np.sum(e, axis=axis, keepdims=True)
+
+
+ACTIVATIONS = {'elu': elu, 'relu': lambda x: np.maximum(x, 0), 'linear': lambda x: x}
+
+
+def conv2d(x, kernel, bias, block_size=1024):
+    """Valid 2D convolution of `x` (time x frequency x channels) with a Keras kernel (kh x kw x in x out).
+
+    The patches are gathered into a matrix (im2col) and multiplied with the
+    kernel, `block_size` frames at a time to bound the memory needed. The
+    result has the type of the product, e.g. int32 for int8 inputs and int32
+    kernels.
+    """
+    kh, kw, num_channels, num_filters = kernel.shape
+    num_frames, num_bins = x.shape[0] - kh + 1, x.shape[1] - kw + 1
+    # patches have shape (frames x bins x channels x kh x kw)
+    patches = np.lib.stride_tricks.sliding_window_view(x, (kh, kw), axis=(0, 1))
+    kernel = kernel.transpose(2, 0, 1, 3).reshape(-1, num_filters)
+    out = np.empty((num_frames, num_bins, num_filters), dtype=np.result_type(x, kernel))
+    for start in range(0, num_frames, block_size):
+        block = patches[start:start + block_size]
+        out[start:start + block_size] = (block.reshape(-1, kernel.shape[0]) @ kernel).reshape(len(block), num_bins, -1)
+    out += bias
+    return out
+
+
+def max_pool_frequency(x, size):
+    """Max. pooling along the frequency axis (Keras' `MaxPooling2D((1, size))`)."""
+    num_bins = x.shape[1] // size
+    return x[:, :num_bins * size].reshape(x.shape[0], num_bins, size, x.shape[2]).max(axis=2)
+
+
+def conv1d(x, kernel, bias, dilation_rate=1, padding='same', pad_value=0):
+    """Dilated 1D convolution of `x` (time x channels) with a Keras kernel (k x in x out).
+
+    `pad_value` is the value representing zero, e.g. the zero point of quantized inputs.
+    """
+    size = kernel.shape[0]
+    total = dilation_rate * (size - 1)
+    left = total if padding == 'causal' else total // 2
+    x = np.pad(x, ((left, total - left), (0, 0)), constant_values=pad_value)
+    num_frames = len(x) - total
+    out = x[:num_frames] @ kernel[0] + bias
+    for k in range(1, size):
+        out += x[k * dilation_rate:k * dilation_rate + num_frames] @ kernel[k]
+    return out
+
+
+def load_weights(path):
+    """Load the weights of a model saved by Keras (`model.save` or `model.save_weights`).
+
+    Returns:
+        dict: layer name -> list of weights (e.g. kernel and bias)
+    """
+    weights = {}
+    with h5py.File(path, 'r') as f:
+        group = f['model_weights'] if 'model_weights' in f else f
+        for layer in group.attrs['layer_names']:
+            layer = layer.decode() if isinstance(layer, bytes) else layer
+            names = group[layer].attrs['weight_names']
+            if len(names):
+                weights[layer] = [np.array(group[layer][n.decode() if isinstance(n, bytes) else n], dtype=np.float32)
+                                  for n in names]
+    return weights
+
+
+class NumpyTCN:
+    """NumPy implementation of the forward pass of the multi-task TCN (see `create_model`).
+
+    Has the same `predict` interface as the Keras model, i.e. it can be used
+    as a drop-in replacement for inference (e.g. by `InferenceEngine`).
+
+    Args:
+        weights: layer name -> list of weights, see `load_weights`
+        activation: activation function used by the model
+        padding: padding of the dilated convolutions ('same' or 'causal')
+        name: name of the TCN stack
+    """
+
+    def __init__(self, weights, activation='elu', padding='same', name='tcn'):
+        self.weights = weights
+        self.config = {'activation': activation, 'padding': padding, 'name': name}
+        self.activation = ACTIVATIONS[activation]
+        self.padding = padding
+        # the dilation rates are part of the layer names
+        pattern = re.compile(r'%s_dilation_(\d+)_1x1_conv$' % name)
+        self.dilations = sorted(int(m.group(1)) for m in map(pattern.match, weights) if m)
+        self.name = name
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Create a `NumpyTCN` from a model (weights) file saved by Keras, e.g. `model_best.h5`."""
+        return cls(load_weights(path), **kwargs)
+
+    @classmethod
+    def from_keras(cls, model, **kwargs):
+        """Create a `NumpyTCN` from a Keras model.
+
+        Unless given, the padding is that of the model's dilated convolutions
+        (e.g. 'causal' for `create_model(..., padding='causal')`).
+        """
+        if 'padding' not in kwargs:
+            name = kwargs.get('name', 'tcn')
+            convs = [layer for layer in model.layers if re.match(r'%s_dilation_\d+_dilated_conv_1$' % name, layer.name)]
+            if convs:
+                kwargs['padding'] = convs[0].get_config()['padding']
+        return cls({layer.name: [np.array(w, dtype=np.float32) for w in layer.get_weights()]
+                    for layer in model.layers if layer.get_weights()}, **kwargs)
+
+    def _input(self, name, x):
+        """Called with the input of every layer before it is applied (e.g. to quantize it)."""
+        return x
+
+    def _conv2d(self, name, x):
+        return conv2d(self._input(name, x), *self.weights[name])
+
+    def _conv1d(self, name, x, dilation_rate=1):
+        return conv1d(self._input(name, x), *self.weights[name], dilation_rate, self.padding)
+
+    def _dense(self, name, x):
+        kernel, bias = self.weights[name]
+        return self._input(name, x) @ kernel + bias
+
+    def forward(self, x):
+        """Compute the activations of a single track.
+
+        Args:
+            x: (padded) features with shape (frames x bins), a trailing
+                channel axis is allowed
+
+        Returns:
+            tuple: beat, downbeat (frames) and tempo (bins) activations
+        """
+        act = self.activation
+        x = np.asarray(x, dtype=np.float32).reshape(x.shape[0], x.shape[1], -1)
+        # stack of 3 conv layers, each conv, activation & max. pooling
+        x = max_pool_frequency(act(self._conv2d('conv_1_conv', x)), 3)
+        x = max_pool_frequency(act(self._conv2d('conv_2_conv', x)), 3)
+        x = max_pool_frequency(act(self._conv2d('conv_3_conv', x)), 3)
+        x = x.reshape(len(x), -1)
+        # TCN layers
+        skip = 0
+        for i in self.dilations:
+            name = '%s_dilation_%d' % (self.name, i)
+            res_x = self._conv1d(name + '_1x1_conv_residual', x)
+            conv_1 = self._conv1d(name + '_dilated_conv_1', x, i)
+            conv_2 = self._conv1d(name + '_dilated_conv_2', x, i * 2)
+            out = self._conv1d(name + '_1x1_conv', act(np.concatenate([conv_1, conv_2], axis=-1)))
+            x = res_x + out
+            skip = skip + out
+        tcn = act(x)
+        # output layers; beats & downbeats use TCN output, tempo the skip connections
+        beats = sigmoid(self._dense('beats_dense', tcn))
+        downbeats = sigmoid(self._dense('downbeats_dense', tcn))
+        tempo = softmax(self._dense('tempo_dense', np.mean(skip, axis=0)))
+        return beats[:, 0], downbeats[:, 0], tempo
+
+    def predict(self, x, batch_size=None, verbose=0):
+        """Same as Keras' `model.predict`, i.e. return beat, downbeat and tempo activations of a batch."""
+        beats, downbeats, tempo = zip(*(self.forward(item) for item in x))
+        return np.stack(beats)[..., np.newaxis], np.stack(downbeats)[..., np.newaxis], np.stack(tempo)
+
+
+def benchmark_runtime(model, x, path=None, num_runs=3):
+    """Compare the NumPy runtime with the Keras model.
+
+    Args:
+        model: (trained) Keras model
+        x: batch of features (e.g. `DataSequence[i][0]`)
+        path: weights file to load the runtime from (None: use the weights of `model`)
+        num_runs: number of predictions to time
+
+    Returns:
+        dict: load time of the runtime, mean prediction time of Keras and
+            NumPy, and the max. absolute deviation of the activations
+    """
+    start = time.perf_counter()
+    runtime = NumpyTCN.from_keras(model) if path is None else NumpyTCN.load(path)
+    load_time = time.perf_counter() - start
+    times = {}
+    outputs = {}
+    for name, predictor in (('keras', model), ('numpy', runtime)):
+        outputs[name] = predictor.predict(x)
+        start = time.perf_counter()
+        for _ in range(num_runs):
+            predictor.predict(x)
+        times[name] = (time.perf_counter() - start) / num_runs
+    deviation = max(float(np.max(np.abs(a - b))) for a, b in zip(outputs['keras'], outputs['numpy']))
+    return {'load_time': load_time, 'keras_time': times['keras'], 'numpy_time': times['numpy'],
+            'max_deviation': deviation}
@@ -0,0 +1,277 @@
+"""Streaming (frame-by-frame) inference with a causal TCN.
+
+`StreamingPreProcessor` computes the same spectrogram frames as the
+notebook's `PreProcessor` from blocks of audio samples as they arrive.
+`StreamingTCN` runs a causal TCN (`create_model(..., padding='causal')`)
+one frame at a time. It keeps a ring buffer with the history of each
+(dilated) convolution, so every new frame costs a constant amount of work
+instead of recomputing the whole sequence.
+
+The latency is fixed: a spectrogram frame is complete half a frame (1024
+samples, 23.2 ms) after its centre, and the conv layers of the network
+need 2 future frames (20 ms).
+"""
+
+import time
+
+import numpy as np
+from madmom.audio.filters import LogarithmicFilterbank
+from madmom.audio.stft import fft_frequencies, stft
+
+from .runtime import conv2d, max_pool_frequency, sigmoid, softmax
+
+FPS = 100
+FFT_SIZE = 2048
+NUM_BANDS = 12
+SAMPLE_RATE = 44100
+
+
+class StreamingPreProcessor:
+    """Compute the spectrogram frames of `PreProcessor` from an audio stream.
+
+    Frames are centred on multiples of the hop size, the same as the offline
+    `PreProcessor` does, hence a frame is returned as soon as the second half
+    of its window has arrived. The audio must be mono and sampled at
+    `sample_rate` already.
+
+    Args:
+        frame_size: size of the FFT frames
+        num_bands: number of bands per octave of the filterbank
+        log: logarithm used to scale the magnitudes
+        add: value added before taking the logarithm
+        fps: frame rate
+        sample_rate: sample rate of the audio
+    """
+
+    def __init__(self, frame_size=FFT_SIZE, num_bands=NUM_BANDS, log=np.log, add=1e-6, fps=FPS,
+                 sample_rate=SAMPLE_RATE):
+        self.frame_size = frame_size
+        self.hop_size = sample_rate / float(fps)
+        self.log = log
+        self.add = add
+        self.fps = fps
+        self.window = np.hanning(frame_size)
+        # same filterbank as `FilteredSpectrogramProcessor(num_bands=num_bands)`
+        self.filterbank = LogarithmicFilterbank(fft_frequencies(frame_size >> 1, sample_rate), num_bands=num_bands,
+                                                fmin=30.0, fmax=17000.0, fref=440.0, norm_filters=True,
+                                                unique_filters=True)
+        self.reset()
+
+    def reset(self):
+        """Start a new stream."""
+        # the first window starts half a frame before the first sample
+        self.buffer = np.zeros(self.frame_size // 2, dtype=np.float32)
+        self.offset = -(self.frame_size // 2)
+        self.num_samples = 0
+        self.num_frames = 0
+
+    def _frames(self, last):
+        """Compute the spectrogram of all frames up to (excluding) frame `last`."""
+        starts = [int(i * self.hop_size) - self.frame_size // 2 - self.offset for i in range(self.num_frames, last)]
+        if not starts:
+            return np.empty((0, self.filterbank.shape[1]), dtype=np.float32)
+        frames = np.stack([self.buffer[start:start + self.frame_size] for start in starts])
+        spec = np.abs(stft(frames, self.window, self.frame_size))
+        spec = self.log(np.dot(spec, self.filterbank) + self.add)
+        # drop the samples not needed any more
+        self.num_frames = last
+        keep = int(last * self.hop_size) - self.frame_size // 2 - self.offset
+        self.buffer = self.buffer[keep:]
+        self.offset += keep
+        return spec
+
+    def process(self, samples):
+        """Append audio samples to the stream and return the spectrogram frames completed by them."""
+        samples = np.asarray(samples)
+        if np.issubdtype(samples.dtype, np.integer):
+            samples = samples / float(np.iinfo(samples.dtype).max)
+        self.buffer = np.concatenate((self.buffer, samples.astype(np.float32)))
+        self.num_samples += len(samples)
+        # frames whose window ends within the samples received so far
+        last = self.num_frames
+        while int(last * self.hop_size) + self.frame_size // 2 <= self.num_samples:
+            last += 1
+        return self._frames(last)
+
+    def flush(self):
+        """End the stream and return the remaining (zero-padded) frames."""
+        self.buffer = np.concatenate((self.buffer, np.zeros(self.frame_size, dtype=np.float32)))
+        return self._frames(int(np.ceil(self.num_samples / self.hop_size)))
+
+
+class RingBuffer:
+    """History of the last `size` frames (all zeros before the stream starts)."""
+
+    def __init__(self, size, shape, dtype=np.float32):
+        self.data = np.zeros((size,) + tuple(shape), dtype=dtype)
+        self.pos = -1
+        self.count = 0
+
+    def push(self, frame):
+        self.pos = (self.pos + 1) % len(self.data)
+        self.data[self.pos] = frame
+        self.count += 1
+
+    def taps(self, offsets):
+        """Return the frames `offsets` frames before the most recent one."""
+        return self.data[(self.pos - offsets) % len(self.data)]
+
+
+class StreamingTCN:
+    """Frame-by-frame inference with a causal multi-task TCN.
+
+    Every (dilated) convolution keeps a ring buffer with as many frames of
+    its input as its kernel spans, i.e. processing a frame needs a constant
+    number of small matrix multiplications. The activations are the same as
+    those of the offline (causal) model given features padded the same way
+    as `DataSequence` does (`cnn_pad`).
+
+    Args:
+        model: `NumpyTCN` with causal padding
+        pad_frames: number of times the first (and last) frame is repeated
+    """
+
+    def __init__(self, model, pad_frames=2):
+        if model.padding != 'causal':
+            raise ValueError('streaming requires a TCN with causal padding')
+        self.act = model.activation
+        self.pad_frames = pad_frames
+        weights = model.weights
+        # conv layers; the first frame of the stream is needed to know the number of bins
+        self.conv_layers = [weights['conv_%d_conv' % i] for i in (1, 2, 3)]
+        # TCN layers
+        self.blocks = []
+        for i in model.dilations:
+            name = '%s_dilation_%d' % (model.name, i)
+            kernel_1, bias_1 = weights[name + '_dilated_conv_1']
+            kernel_2, bias_2 = weights[name + '_dilated_conv_2']
+            size, num_channels = kernel_1.shape[:2]
+            self.blocks.append({
+                # the buffer must cover the larger dilation, i.e. the second conv.
+                'size': (size - 1) * 2 * i + 1,
+                'channels': num_channels,
+                'taps_1': np.arange(size - 1, -1, -1) * i,
+                'taps_2': np.arange(size - 1, -1, -1) * 2 * i,
+                'conv_1': (kernel_1.reshape(-1, kernel_1.shape[-1]), bias_1),
+                'conv_2': (kernel_2.reshape(-1, kernel_2.shape[-1]), bias_2),
+                'residual': [w.reshape(-1, w.shape[-1]) if w.ndim > 1 else w
+                             for w in weights[name + '_1x1_conv_residual']],
+                'conv': [w.reshape(-1, w.shape[-1]) if w.ndim > 1 else w for w in weights[name + '_1x1_conv']],
+            })
+        self.beats = weights['beats_dense']
+        self.downbeats = weights['downbeats_dense']
+        self.tempo_dense = weights['tempo_dense']
+        self.reset()
+
+    def reset(self):
+        """Start a new stream."""
+        self.conv_buffers = None
+        self.last_frame = None
+        self.buffers = [RingBuffer(block['size'], (block['channels'],)) for block in self.blocks]
+        self.skip_sum = 0
+        self.num_frames = 0
+
+    def _conv_frame(self, frame):
+        """Feed a spectrogram frame through the conv layers, return the TCN input (or None if incomplete)."""
+        x = frame.reshape(len(frame), -1)
+        if self.conv_buffers is None:
+            # each conv layer keeps as many frames of its input as its kernel spans in time
+            self.conv_buffers = []
+            shape = x.shape
+            for kernel, bias in self.conv_layers:
+                self.conv_buffers.append(RingBuffer(kernel.shape[0], shape))
+                shape = ((shape[0] - kernel.shape[1] + 1) // 3, kernel.shape[-1])
+        for (kernel, bias), buffer in zip(self.conv_layers, self.conv_buffers):
+            buffer.push(x)
+            if buffer.count < len(buffer.data):
+                return None
+            x = buffer.taps(np.arange(len(buffer.data) - 1, -1, -1))
+            x = max_pool_frequency(self.act(conv2d(x, kernel, bias)), 3)[0]
+        return x.reshape(-1)
+
+    def _tcn_frame(self, x):
+        """Feed a frame through the TCN and the output layers, return beat and downbeat activations."""
+        act = self.act
+        skip = 0
+        for block, buffer in zip(self.blocks, self.buffers):
+            buffer.push(x)
+            res_x = x @ block['residual'][0] + block['residual'][1]
+            conv_1 = buffer.taps(block['taps_1']).reshape(-1) @ block['conv_1'][0] + block['conv_1'][1]
+            conv_2 = buffer.taps(block['taps_2']).reshape(-1) @ block['conv_2'][0] + block['conv_2'][1]
+            out = act(np.concatenate([conv_1, conv_2])) @ block['conv'][0] + block['conv'][1]
+            x = res_x + out
+            skip = skip + out
+        self.skip_sum = self.skip_sum + skip
+        self.num_frames += 1
+        tcn = act(x)
+        beats = sigmoid(tcn @ self.beats[0] + self.beats[1])
+        downbeats = sigmoid(tcn @ self.downbeats[0] + self.downbeats[1])
+        return beats[0], downbeats[0]
+
+    def process(self, frames):
+        """Process spectrogram frames, return the beat and downbeat activations of the frames completed."""
+        activations = []
+        for frame in frames:
+            if self.last_frame is None:
+                # pad the start of the stream the same way as `cnn_pad`
+                for _ in range(self.pad_frames):
+                    self._conv_frame(frame)
+            self.last_frame = frame
+            x = self._conv_frame(frame)
+            if x is not None:
+                activations.append(self._tcn_frame(x))
+        return np.array(activations, dtype=np.float32).reshape(-1, 2)
+
+    def flush(self):
+        """End the stream, return the activations of the last frames (padded the same way as `cnn_pad`)."""
+        activations = []
+        if self.last_frame is not None:
+            for _ in range(self.pad_frames):
+                x = self._conv_frame(self.last_frame)
+                if x is not None:
+                    activations.append(self._tcn_frame(x))
+        return np.array(activations, dtype=np.float32).reshape(-1, 2)
+
+    def tempo(self):
+        """Tempo activations of the stream so far (global average of the skip connections)."""
+        return softmax((self.skip_sum / max(self.num_frames, 1)) @ self.tempo_dense[0] + self.tempo_dense[1])
+
+
+def streaming_latency(tcn, audio, pre_processor=None, block_size=441):
+    """Measure the processing time of streaming inference on a single core.
+
+    The audio is fed in blocks of `block_size` samples (a hop, i.e. one frame,
+    by default), the time needed to process each block is measured.
+
+    Args:
+        tcn: `StreamingTCN`
+        audio: mono audio signal (sampled at the sample rate of the pre-processor)
+        pre_processor: `StreamingPreProcessor` (None: create a default one)
+        block_size: number of samples per block
+
+    Returns:
+        dict: activations, mean/99th percentile/max. processing time per block
+            (seconds), real-time factor (processing time / audio duration) and
+            the algorithmic latency (seconds) caused by the look-ahead of the
+            STFT window and the conv layers
+    """
+    pre_processor = pre_processor or StreamingPreProcessor()
+    pre_processor.reset()
+    tcn.reset()
+    sample_rate = pre_processor.hop_size * pre_processor.fps
+    activations, times = [], []
+    for start in range(0, len(audio), block_size):
+        block_start = time.perf_counter()
+        activations.append(tcn.process(pre_processor.process(audio[start:start + block_size])))
+        times.append(time.perf_counter() - block_start)
+    activations.append(tcn.process(pre_processor.flush()))
+    activations.append(tcn.flush())
+    times = np.array(times)
+    return {
+        'activations': np.concatenate(activations),
+        'mean_time': float(np.mean(times)),
+        'p99_time': float(np.percentile(times, 99)),
+        'max_time': float(np.max(times)),
+        'real_time_factor': float(np.sum(times) / (len(audio) / sample_rate)),
+        'latency': pre_processor.frame_size / 2 / sample_rate + tcn.pad_frames / pre_processor.fps,
+    }
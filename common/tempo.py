@@ -0,0 +1,178 @@
+"""Tempo estimation from tempo strength functions (histograms, activations, ACFs)."""
+
+import numpy as np
+import scipy.interpolate
+
+MASK_VALUE = -1
+# resolution of the (virtual) interpolation grid used to locate peaks
+GRID_RESOLUTION = 0.001
+
+
+def smooth(signal, kernel):
+    """Smooth the signal with a Hamming window of the given size (same as `madmom.audio.signal.smooth`)."""
+    if kernel is None or kernel <= 1:
+        return signal
+    return np.convolve(signal, np.hamming(kernel), 'same')
+
+
+def _spline_peaks(x, y, resolution=GRID_RESOLUTION, wrap=True):
+    """Local maxima of the quadratic interpolation of `y` on a dense grid.
+
+    Finds the same peaks as evaluating `interp1d(x, y, 'quadratic')` on the
+    grid `np.arange(x[0], x[-1], resolution)` and applying `argrelmax(...,
+    mode='wrap')` to it (or `mode='clip'` if `wrap` is false, i.e. the grid
+    boundaries are no peaks), but without evaluating the whole grid. The derivative
+    of a quadratic spline is piecewise linear, thus all maxima can be located
+    from the derivative at the knots; the interpolation is then evaluated only
+    at the grid points around them.
+
+    Returns:
+        tuple: grid positions and interpolated values of the peaks
+    """
+    spline = scipy.interpolate.make_interp_spline(x, y, k=2, check_finite=False)
+    # grid points, computed the same way as `np.arange` does it
+    start = x[0]
+    delta = (start + resolution) - start
+    num_points = int(np.ceil((x[-1] - start) / resolution))
+    if num_points < 3:
+        return np.empty(0), np.empty(0)
+
+    def grid(idx):
+        return start + idx * delta
+
+    # zero crossings (+ -> -) of the derivative between consecutive knots
+    knots = np.unique(spline.t)
+    slope = spline.derivative()(knots)
+    crossings = np.flatnonzero((slope[:-1] > 0) & (slope[1:] <= 0))
+    left, right = knots[crossings], knots[crossings + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        maxima = np.where(slope[crossings + 1] < 0,
+                          left + slope[crossings] * (right - left) / (slope[crossings] - slope[crossings + 1]), right)
+    # evaluate the grid points around the maxima (and the grid boundaries, which wrap)
+    centres = np.round((maxima - start) / delta).astype(int)
+    idx = np.unique(np.concatenate([centres + i for i in range(-3, 4)] + [[0, 1, num_points - 2, num_points - 1]]))
+    idx = idx[(idx >= 0) & (idx < num_points)]
+    values = spline(grid(idx))
+    # strict local maxima w.r.t. the neighbouring grid points
+    lookup = dict(zip(idx, values))
+    if not wrap:
+        idx, values = idx[1:-1], values[1:-1]
+    peaks = [i for i, v in zip(idx, values)
+             if (i - 1) % num_points in lookup and (i + 1) % num_points in lookup
+             and v > lookup[(i - 1) % num_points] and v > lookup[(i + 1) % num_points]]
+    peaks = np.array(peaks, dtype=int)
+    return grid(peaks), np.array([lookup[i] for i in peaks])
+
+
+def infer_tempo(beats, hist_smooth=15, fps=100, no_tempo=MASK_VALUE):
+    """Infer the (global) tempo from beats.
+
+    Same result as `infer_tempo` of the notebook (up to floating point
+    precision of the grid positions, i.e. < 1e-9 BPM), but without evaluating
+    the interpolated histogram on a dense grid of 0.001 frames resolution.
+    """
+    ibis = np.diff(beats) * fps
+    bins = np.bincount(np.round(ibis).astype(int))
+    # if no beats are present, there is no tempo
+    if not bins.any():
+        return no_tempo
+    intervals = np.arange(len(bins))
+    # smooth histogram bins
+    if hist_smooth > 0:
+        bins = smooth(bins, hist_smooth)
+    positions, heights = _spline_peaks(intervals, bins)
+    if len(positions) == 0:
+        # no peaks, no tempo
+        return no_tempo
+    # report only the strongest tempo
+    return 60.0 * fps / positions[np.argmax(heights)]
+
+
+def detect_tempo(bins, hist_smooth=11, min_bpm=10, k=2):
+    """Detect the `k` strongest tempi from the tempo activations of the network.
+
+    Same result as `detect_tempo` of the notebook (up to floating point
+    precision, i.e. < 1e-9 BPM and strength), but without evaluating the
+    interpolated activations on a dense grid of 0.001 BPM resolution. A single
+    peak is returned with shape (1, 2) instead of (2,).
+    """
+    min_bpm = int(np.floor(min_bpm))
+    tempi = np.arange(min_bpm, len(bins))
+    bins = bins[min_bpm:]
+    # smooth histogram bins
+    if hist_smooth > 0:
+        bins = smooth(bins, hist_smooth)
+    positions, heights = _spline_peaks(tempi, bins)
+    if len(positions) == 0:
+        # no peaks, no tempo
+        return np.array([], ndmin=2)
+    # sort the peaks in descending order of bin heights
+    order = np.argsort(heights)[::-1]
+    # normalize their strengths
+    strengths = heights[order] / np.sum(heights)
+    # return the tempi and their normalized strengths
+    return np.vstack((positions[order], strengths)).T[:k]
+
+
+def tempo_hypotheses_from_activations(bins, k=2, hist_smooth=11, min_bpm=10):
+    """Tempo hypotheses from the tempo activation (softmax) of the network.
+
+    Same peaks as `detect_tempo`, but `k` of them and always with shape
+    (num_hypotheses, 2), i.e. also if no peaks are found.
+
+    Args:
+        bins: tempo activations, bin `i` corresponds to `i` BPM
+        k: number of hypotheses to return
+        hist_smooth: size of the smoothing kernel
+        min_bpm: minimum tempo to consider
+
+    Returns:
+        numpy array: (tempo, strength) rows, strengths are normalised to sum
+            to 1 over all peaks found
+    """
+    return detect_tempo(np.asarray(bins, dtype=float), hist_smooth, min_bpm, k).reshape(-1, 2)
+
+
+def tempo_hypotheses_from_acf(acf, fps, k=2, min_bpm=30.0, max_bpm=320.0, prior=None):
+    """Tempo hypotheses from an autocorrelation function (or mean tempogram).
+
+    The function is weighted the same way `librosa.beat.tempo` does it, i.e.
+    peaks are located on `log1p(1e6 * acf) + prior`, thus the strongest
+    hypothesis agrees with `PeriodicityAnalysis.tempo`. Peaks are located on
+    the quadratic interpolation in the lag domain (where the function is
+    sampled uniformly), the same way `detect_tempo` does it, and converted
+    to tempi afterwards.
+
+    Args:
+        acf: autocorrelation function, bin `i` corresponds to a lag of `i` frames
+        fps: frame rate of the underlying onset envelope
+        k: number of hypotheses to return
+        min_bpm: minimum tempo to consider
+        max_bpm: maximum tempo to consider
+        prior: log prior over the lags of `acf` (e.g. `PeriodicityAnalysis.tempo_prior`)
+
+    Returns:
+        numpy array: (tempo, strength) rows, strengths are the (exponentiated)
+            weighted peak heights normalised to sum to 1
+    """
+    scores = np.log1p(1e6 * np.maximum(np.asarray(acf, dtype=float), 0))
+    if prior is not None:
+        scores = scores + prior
+    # restrict lags to the tempo range
+    min_lag = max(1, int(np.floor(60.0 * fps / max_bpm)))
+    max_lag = min(len(scores) - 1, int(np.ceil(60.0 * fps / min_bpm)))
+    scores = scores[min_lag:max_lag + 1]
+    finite = np.isfinite(scores)
+    if not finite.any():
+        return np.empty((0, 2))
+    # lags killed by the prior cannot be peaks
+    scores = np.where(finite, scores, np.min(scores[finite]))
+    positions, heights = _spline_peaks(np.arange(min_lag, min_lag + len(scores)), scores, wrap=False)
+    tempi = 60.0 * fps / positions
+    valid = (tempi >= min_bpm) & (tempi <= max_bpm)
+    if not valid.any():
+        return np.empty((0, 2))
+    order = np.argsort(heights[valid])[::-1]
+    tempi, heights = tempi[valid][order], heights[valid][order]
+    strengths = np.exp(heights - np.max(heights))
+    return np.vstack((tempi, strengths / np.sum(strengths))).T[:k]
@@ -0,0 +1,390 @@
+"""Data-parallel training of the multi-task TCN on a single (many-core) host.
+
+Every worker process holds a replica of the model and the optimizer, computes
+the gradients on its own shard of the training data and the gradients are
+averaged over all workers via shared memory (all-reduce). All replicas apply
+the very same averaged gradients, hence model weights and optimizer states
+(e.g. of `RAdam` and `Lookahead`) stay identical without ever being
+exchanged (except for the initial weights).
+"""
+
+import multiprocessing as mp
+import os
+import queue
+import time
+import traceback
+
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+
+from .data import BucketedSequence, DataSequence, FeatureStore
+from .model import Lookahead, RAdam, build_masked_loss, create_model
+
+# seconds a worker waits for the others before giving up (e.g. if one of them hangs or crashed)
+TIMEOUT = 600
+
+
+class SharedMemoryAllReduce:
+    """All-reduce (averaging) of float32 vectors among worker processes via shared memory.
+
+    Each worker writes its vector into its own slot, then every worker sums
+    one chunk of all slots (reduce-scatter) and finally all workers read the
+    result (all-gather), i.e. every worker only touches `2 / num_workers` of
+    the data of the others.
+
+    Args:
+        num_workers: number of worker processes
+        size: length of the vectors
+        ctx: multiprocessing context used to create the shared memory
+        timeout: seconds to wait for the other workers; afterwards the
+            barrier is broken, i.e. all waiting workers raise
+            `threading.BrokenBarrierError`
+    """
+
+    def __init__(self, num_workers, size, ctx=mp, timeout=TIMEOUT):
+        self.num_workers = num_workers
+        self.size = size
+        self._slots = ctx.RawArray('f', num_workers * size)
+        self._result = ctx.RawArray('f', size)
+        self.barrier = ctx.Barrier(num_workers, timeout=timeout)
+
+    @property
+    def slots(self):
+        return np.frombuffer(self._slots, dtype=np.float32).reshape(self.num_workers, self.size)
+
+    @property
+    def result(self):
+        return np.frombuffer(self._result, dtype=np.float32)
+
+    def __call__(self, rank, vector):
+        """Return the mean of the vectors of all workers."""
+        size = len(vector)
+        slots, result = self.slots[:, :size], self.result[:size]
+        slots[rank] = vector
+        self.barrier.wait()
+        # reduce the chunk of this worker
+        start, stop = size * rank // self.num_workers, size * (rank + 1) // self.num_workers
+        np.sum(slots[:, start:stop], axis=0, out=result[start:stop])
+        result[start:stop] /= self.num_workers
+        self.barrier.wait()
+        return result.copy()
+
+    def broadcast(self, rank, vector=None, root=0, size=None):
+        """Return the vector (of length `size`) of the `root` worker."""
+        size = self.size if size is None else size
+        # the other workers may still read the result of the previous all-reduce
+        self.barrier.wait()
+        if rank == root:
+            self.result[:size] = vector
+        self.barrier.wait()
+        # the next operation writes the result only after all workers passed one more barrier
+        return self.result[:size].copy()
+
+    def gather(self, rank, value):
+        """Return the (scalar) values of all workers."""
+        slots = self.slots
+        slots[rank, 0] = value
+        self.barrier.wait()
+        values = slots[:, 0].copy()
+        self.barrier.wait()
+        return values
+
+    def minimum(self, rank, value):
+        """Return the minimum of the (integer) values of all workers."""
+        return int(self.gather(rank, value).min())
+
+    def maximum(self, rank, value):
+        """Return the maximum of the values of all workers."""
+        return float(self.gather(rank, value).max())
+
+
+def limit_threads(num_threads):
+    """Limit the number of threads used by TensorFlow (of the current process)."""
+    if tf.executing_eagerly():
+        # training functions are built as (TF1 style) graphs
+        tf.compat.v1.disable_eager_execution()
+    config = tf.compat.v1.ConfigProto(intra_op_parallelism_threads=num_threads, inter_op_parallelism_threads=1)
+    set_session = getattr(K, 'set_session', None) or tf.compat.v1.keras.backend.set_session
+    set_session(tf.compat.v1.Session(config=config))
+
+
+class GradientTrainer:
+    """Compute gradients and apply (externally averaged) gradients separately.
+
+    Keras' `train_on_batch` computes and applies the gradients in one go. In
+    order to average them over workers, the gradients are computed with one
+    function and fed into the optimizer's updates with another one. Gradient
+    clipping (`clipnorm`, `clipvalue` of the optimizer) is applied to the
+    averaged gradients, i.e. the same as when training with the combined
+    batch in a single process.
+
+    Args:
+        model: Keras model (not compiled)
+        optimizer: Keras optimizer (e.g. `Lookahead(RAdam(...))`)
+        losses: loss function for each output of the model
+    """
+
+    def __init__(self, model, optimizer, losses):
+        self.model = model
+        self.params = model.trainable_weights
+        self.shapes = [K.int_shape(p) for p in self.params]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.outputs = model.output_names
+        # loss (sum of the mean loss of all outputs) and its gradients
+        targets = [K.placeholder(ndim=K.ndim(output), name=f'{name}_target')
+                   for name, output in zip(self.outputs, model.outputs)]
+        loss = sum(K.mean(fn(target, output)) for fn, target, output in zip(losses, targets, model.outputs))
+        inputs = model.inputs + targets
+        self.learning_phase = not isinstance(K.learning_phase(), int)
+        if self.learning_phase:
+            inputs.append(K.learning_phase())
+        self.gradient_fn = K.function(inputs, [loss] + K.gradients(loss, self.params))
+        # feed the averaged gradients into the optimizer (in case of Lookahead into the wrapped optimizer)
+        placeholders = [K.placeholder(shape=shape, dtype=K.dtype(p)) for shape, p in zip(self.shapes, self.params)]
+        inner = getattr(optimizer, 'optimizer', optimizer)
+        inner.get_gradients = lambda loss, params: placeholders
+        self.clipnorm = getattr(inner, 'clipnorm', 0) or 0
+        self.clipvalue = getattr(inner, 'clipvalue', 0) or 0
+        # (newer Keras versions require at least one output)
+        self.apply_fn = K.function(placeholders, [K.constant(0)], updates=optimizer.get_updates(loss, self.params))
+
+    def gradients(self, x, y):
+        """Return the loss and the (flattened) gradients for the batch."""
+        inputs = [x] + [y[name] for name in self.outputs]
+        if self.learning_phase:
+            inputs.append(1)
+        loss, *grads = self.gradient_fn(inputs)
+        return loss, np.concatenate([g.ravel() for g in grads]).astype(np.float32)
+
+    def apply(self, grads):
+        """Apply the (flattened) gradients."""
+        if self.clipnorm > 0:
+            norm = np.sqrt(np.sum(np.square(grads, dtype=np.float64)))
+            if norm >= self.clipnorm:
+                grads = grads * (self.clipnorm / norm)
+        if self.clipvalue > 0:
+            grads = np.clip(grads, -self.clipvalue, self.clipvalue)
+        splits = np.split(grads, np.cumsum(self.sizes)[:-1])
+        self.apply_fn([g.reshape(shape) for g, shape in zip(splits, self.shapes)])
+
+
+def flat_weights(model):
+    """Return all weights of the model as a single (float32) vector."""
+    return np.concatenate([w.ravel() for w in model.get_weights()]).astype(np.float32)
+
+
+def set_flat_weights(model, weights):
+    """Set all weights of the model from a single vector (see `flat_weights`)."""
+    shapes = [w.shape for w in model.get_weights()]
+    splits = np.split(weights, np.cumsum([int(np.prod(shape)) for shape in shapes])[:-1])
+    model.set_weights([w.reshape(shape) for w, shape in zip(splits, shapes)])
+
+
+def build_model(num_bins, learnrate=0.005, clipnorm=0.5, **kwargs):
+    """Create the model, optimizer and losses the same way as the notebook does.
+
+    The number of frequency bins of the features depends on the pre-processor,
+    e.g. use `functools.partial(build_model, StoreShards(path).num_bins)`.
+    """
+    model = create_model((None, num_bins, 1), **kwargs)
+    optimizer = Lookahead(RAdam(lr=learnrate, clipnorm=clipnorm))
+    losses = [build_masked_loss(K.binary_crossentropy)] * 3
+    return model, optimizer, losses
+
+
+class StoreShards:
+    """Shards of a `FeatureStore` as length-bucketed sequences, one per worker.
+
+    Instances can be pickled (i.e. sent to worker processes), since only the
+    path of the store is kept.
+
+    Args:
+        path: path of the `FeatureStore`
+        pad_frames: number of frames to pad the features with
+        batch_size: batch size (per worker)
+        ids: names of the tracks to use (None: all tracks of the store)
+        widen: widen the targets the same way as in the notebook
+        **kwargs: passed to `BucketedSequence`
+    """
+
+    def __init__(self, path, pad_frames=2, batch_size=1, ids=None, widen=True, **kwargs):
+        self.path = path
+        self.pad_frames = pad_frames
+        self.batch_size = batch_size
+        self.ids = ids
+        self.widen = widen
+        self.kwargs = kwargs
+
+    @property
+    def num_bins(self):
+        """Number of frequency bins of the features of the store."""
+        return FeatureStore(self.path).num_bins
+
+    def __call__(self, rank, num_workers):
+        ids = FeatureStore(self.path).ids if self.ids is None else self.ids
+        # disjoint shards, i.e. every track is used by exactly one worker
+        ids = ids[rank::num_workers]
+        sequence = DataSequence.from_store(self.path, self.pad_frames, ids)
+        if self.widen:
+            sequence.widen_beat_targets()
+            sequence.widen_downbeat_targets()
+            sequence.widen_tempo_targets()
+            sequence.widen_tempo_targets()
+        return BucketedSequence(sequence, self.batch_size, **self.kwargs)
+
+
+def _worker(rank, num_workers, model_fn, sequence_fn, allreduce, epochs, steps_per_epoch, num_threads, seed,
+            results):
+    try:
+        limit_threads(num_threads)
+        np.random.seed(seed + rank)
+        model, optimizer, losses = model_fn()
+        sequence = sequence_fn(rank, num_workers)
+        num_bins = sequence[0][0].shape[2]
+        if model.input_shape[2] != num_bins:
+            raise ValueError(f'model expects {model.input_shape[2]} bins, the features have {num_bins}')
+        # start from the weights of the first worker (before the optimizer creates e.g. the slow weights)
+        weights = flat_weights(model)
+        set_flat_weights(model, allreduce.broadcast(rank, weights if rank == 0 else None, size=len(weights)))
+        trainer = GradientTrainer(model, optimizer, losses)
+        # all workers must perform the same number of steps
+        steps = allreduce.minimum(rank, len(sequence))
+        if steps_per_epoch is not None:
+            steps = min(steps, steps_per_epoch)
+        history = []
+        step_times = []
+        for _ in range(epochs):
+            epoch_losses = []
+            for i in range(steps):
+                start = time.perf_counter()
+                x, y = sequence[i]
+                loss, grads = trainer.gradients(x, y)
+                # average gradients (and the loss, for logging) over all workers
+                grads = allreduce(rank, np.append(grads, np.float32(loss)))
+                trainer.apply(grads[:-1])
+                epoch_losses.append(grads[-1])
+                step_times.append(time.perf_counter() - start)
+            sequence.on_epoch_end()
+            history.append(float(np.mean(epoch_losses)))
+        # sanity check: all replicas applied the same gradients, hence their weights must equal the mean
+        weights = flat_weights(model)
+        divergence = allreduce.maximum(rank, np.max(np.abs(allreduce(rank, weights) - weights)))
+        # the shared memory belongs to the parent, i.e. the workers can exit right away (after `maximum` none of
+        # them accesses it any more)
+        if rank == 0:
+            results.put({'history': history, 'weights': model.get_weights(), 'step_times': step_times,
+                         'steps_per_epoch': steps, 'divergence': divergence})
+    except Exception:
+        # the other workers raise `BrokenBarrierError` and report it as well
+        results.put({'error': traceback.format_exc(), 'rank': rank})
+        allreduce.barrier.abort()
+
+
+def _wait_for_result(workers, results):
+    """Return the result of the first worker, raise if any worker failed or died."""
+    while True:
+        try:
+            result = results.get(timeout=1)
+        except queue.Empty:
+            for rank, worker in enumerate(workers):
+                # e.g. killed when running out of memory, the others would wait at the barrier until timeout
+                if worker.exitcode not in (None, 0):
+                    raise RuntimeError(f'worker {rank} died with exit code {worker.exitcode}')
+            continue
+        if 'error' in result:
+            raise RuntimeError(f"worker {result['rank']} failed:\n{result['error']}")
+        return result
+
+
+def train_data_parallel(model_fn, sequence_fn, num_workers=8, epochs=1, steps_per_epoch=None, num_threads=None,
+                        seed=1234, timeout=TIMEOUT):
+    """Train a model with data-parallel worker processes.
+
+    Each worker creates a replica of the model and optimizer with `model_fn`
+    and its shard of the training data with `sequence_fn`. In every step,
+    each worker computes the gradients of one batch of its shard; the
+    gradients are averaged over all workers and applied by all of them. Hence
+    a step corresponds to training with a batch `num_workers` times larger.
+
+    Worker processes are spawned (not forked, TensorFlow does not support
+    that), thus `model_fn` and `sequence_fn` must be picklable, e.g. module
+    level functions, `functools.partial` objects or `StoreShards`. If a
+    worker fails, dies or does not reach the next all-reduce within `timeout`
+    seconds, all workers are terminated and a `RuntimeError` is raised.
+
+    Args:
+        model_fn: function returning the (uncompiled) model, the optimizer and
+            the losses, e.g. `build_model`
+        sequence_fn: function returning the training sequence of a worker
+            given its rank and the number of workers, e.g. `StoreShards`
+        num_workers: number of worker processes
+        epochs: number of epochs to train
+        steps_per_epoch: maximum number of steps per epoch
+        num_threads: number of TensorFlow threads per worker
+            (None: number of CPU cores divided by the number of workers)
+        seed: random seed (of the first worker, the others use consecutive seeds)
+        timeout: seconds a worker waits for the others
+
+    Returns:
+        dict: loss per epoch ('history'), the final weights of the model
+            ('weights'), the duration of the individual steps ('step_times'),
+            the number of steps per epoch ('steps_per_epoch') and the maximum
+            deviation of the weights of any replica from their mean
+            ('divergence', should be 0 up to rounding)
+    """
+    ctx = mp.get_context('spawn')
+    if num_threads is None:
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    # size of the gradients (plus the loss)
+    model, _, _ = model_fn()
+    size = max(int(sum(K.count_params(p) for p in model.trainable_weights)) + 1, len(flat_weights(model)))
+    del model
+    allreduce = SharedMemoryAllReduce(num_workers, size, ctx, timeout)
+    results = ctx.Queue()
+    workers = [ctx.Process(target=_worker, args=(rank, num_workers, model_fn, sequence_fn, allreduce, epochs,
+                                                 steps_per_epoch, num_threads, seed, results))
+               for rank in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        result = _wait_for_result(workers, results)
+    except BaseException:
+        # the remaining workers may wait at a barrier (or still compute), do not wait for them
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
+    return result
+
+
+def scaling_benchmark(model_fn, sequence_fn, worker_counts=(1, 2, 4, 8), steps=20, num_threads=1):
+    """Measure the training throughput for different numbers of worker processes.
+
+    Each configuration is trained for `steps` steps (after one warm-up step)
+    with `num_threads` TensorFlow threads per worker. The speedup is only
+    meaningful if the host has a core for every thread; configurations with
+    more threads than cores (`oversubscribed`) share the cores and measure
+    the overhead of the all-reduce and the context switches instead.
+
+    Returns:
+        dict: for each number of workers the mean time per step, the number of
+            batches processed per second, the speedup relative to the first
+            configuration, the parallel efficiency and whether there were
+            more threads than CPU cores
+    """
+    num_cores = os.cpu_count() or 1
+    results = {}
+    for num_workers in worker_counts:
+        result = train_data_parallel(model_fn, sequence_fn, num_workers, epochs=1, steps_per_epoch=steps + 1,
+                                     num_threads=num_threads)
+        step_time = float(np.mean(result['step_times'][1:]))
+        results[num_workers] = {'step_time': step_time, 'batches_per_sec': num_workers / step_time,
+                                'oversubscribed': num_workers * num_threads > num_cores}
+    reference = results[worker_counts[0]]
+    for num_workers, result in results.items():
+        result['speedup'] = result['batches_per_sec'] / reference['batches_per_sec']
+        result['efficiency'] = result['speedup'] * worker_counts[0] / num_workers
+    return results
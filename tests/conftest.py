@@ -0,0 +1,15 @@
+import os
+
+import pytest
+
+AUDIO_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'book', 'assets', 'ch2_basics', 'audio')
+
+
+@pytest.fixture(scope='session')
+def audio_file():
+    """Return the path of one of the book's example audio files."""
+
+    def path(name):
+        return os.path.join(AUDIO_DIR, name + '.flac')
+
+    return path
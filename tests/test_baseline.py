@@ -0,0 +1,134 @@
+"""Tests of the dynamic programming beat trackers (`common.baseline`) against the loop of the book."""
+
+import numpy as np
+import pytest
+
+librosa = pytest.importorskip('librosa')
+
+from packaging.version import Version  # noqa: E402
+
+# the beat trackers (as the book) use private helpers of `librosa.beat`, which changed in version 0.10
+pytestmark = pytest.mark.skipif(Version(librosa.__version__) >= Version('0.10'),
+                                reason='requires the private beat tracking helpers of librosa < 0.10')
+
+mir_eval = pytest.importorskip('mir_eval')
+
+from common.baseline import OnlineBeatTracker, beat_track_dp, beat_track_dp_sweep  # noqa: E402
+from common.features import FPS, HOP_LENGTH, SR, compute_features  # noqa: E402
+
+EXAMPLES = ['easy_example', 'expressive_example', 'mini']
+
+
+def beat_track_dp_loop(oenv, tempo, fps, sr, hop_length, tightness=100, alpha=0.5):
+    # reference implementation of the baseline section (iterates over all frames)
+    period = (fps * 60. / tempo)
+    localscore = librosa.beat.__beat_local_score(oenv, period)
+    backlink = np.zeros_like(localscore, dtype=int)
+    cumulative_score = np.zeros_like(localscore)
+    window = np.arange(-2 * period, -np.round(period / 2) + 1, dtype=int)
+    txwt = -tightness * (np.log(-window / period) ** 2)
+    first_beat = True
+    for i, score_i in enumerate(localscore):
+        z_pad = np.maximum(0, min(-window[0], len(window)))
+        candidates = txwt.copy()
+        candidates[z_pad:] = candidates[z_pad:] + cumulative_score[window[z_pad:]]
+        beat_location = np.argmax(candidates)
+        cumulative_score[i] = (1 - alpha) * score_i + alpha * candidates[beat_location]
+        if first_beat and score_i < 0.01 * localscore.max():
+            backlink[i] = -1
+        else:
+            backlink[i] = window[beat_location]
+            first_beat = False
+        window = window + 1
+    beats = [librosa.beat.__last_beat(cumulative_score)]
+    while backlink[beats[-1]] >= 0:
+        beats.append(backlink[beats[-1]])
+    beats = np.array(beats[::-1], dtype=int)
+    beats = librosa.beat.__trim_beats(oenv, beats, trim=True)
+    beats = librosa.frames_to_time(beats, hop_length=hop_length, sr=sr)
+    return beats, cumulative_score
+
+
+@pytest.fixture(scope='module', params=EXAMPLES)
+def onset_envelope(request, audio_file):
+    _, flux = compute_features(audio_file(request.param))
+    return np.asarray(flux)
+
+
+@pytest.mark.parametrize('tempo', [60.0, 100.0, 137.5])
+@pytest.mark.parametrize('tightness, alpha', [(100, 0.5), (400, 0.9), (10, 0.1)])
+def test_beat_track_dp(onset_envelope, tempo, tightness, alpha):
+    beats, cumulative_score = beat_track_dp(onset_envelope, tempo, FPS, SR, HOP_LENGTH, tightness, alpha)
+    ref_beats, ref_cumulative_score = beat_track_dp_loop(onset_envelope, tempo, FPS, SR, HOP_LENGTH, tightness, alpha)
+    assert np.array_equal(beats, ref_beats)
+    assert np.array_equal(cumulative_score, ref_cumulative_score)
+
+
+def test_beat_track_dp_sweep(onset_envelope):
+    tempi, tightness, alpha = [60.0, 137.5], [10, 100, 400], [0.1, 0.5, 0.9]
+    results = beat_track_dp_sweep(onset_envelope, tempi, FPS, SR, HOP_LENGTH, tightness, alpha)
+    assert len(results) == len(tempi) * len(tightness) * len(alpha)
+    for result in results:
+        beats, cumulative_score = beat_track_dp(onset_envelope, result['tempo'], FPS, SR, HOP_LENGTH,
+                                                result['tightness'], result['alpha'])
+        assert np.array_equal(result['beats'], beats)
+        assert np.array_equal(result['cumulative_score'], cumulative_score)
+    assert {(r['tempo'], r['tightness'], r['alpha']) for r in results} == \
+        {(tempo, t, a) for tempo in tempi for t in tightness for a in alpha}
+
+
+def online_beats(oenv, tempo, **kwargs):
+    tracker = OnlineBeatTracker(tempo, FPS, **kwargs)
+    return np.concatenate([tracker.process(oenv), tracker.flush()])
+
+
+def click_track(tempo, num_frames=3000, seed=0):
+    """Noisy onset envelope with a slightly drifting pulse, a few missing and spurious onsets."""
+    rng = np.random.RandomState(seed)
+    period = 60.0 * FPS / tempo
+    oenv = rng.gamma(1.0, 0.3, num_frames)
+    onsets = np.cumsum(period * (1 + 0.01 * rng.randn(int(num_frames / period) + 5)))
+    onsets = onsets[onsets < num_frames - 1].astype(int)
+    oenv[onsets] += 3 * (rng.rand(len(onsets)) > 0.1)
+    oenv[rng.randint(0, num_frames, 20)] += 2
+    return oenv
+
+
+def test_online_cumulative_score(onset_envelope):
+    # with the same normalisation and a buffer covering the whole input, the DP equals the offline one
+    tempo = 120.0
+    num_frames = len(onset_envelope)
+    tracker = OnlineBeatTracker(tempo, FPS, latency=(num_frames + 100) / FPS, lookahead=0.5,
+                                std=np.std(onset_envelope, ddof=1))
+    tracker.process(np.concatenate([onset_envelope, np.zeros(100)]))
+    _, cumulative_score = beat_track_dp(onset_envelope, tempo, FPS, SR, HOP_LENGTH)
+    # librosa normalises the (float32) envelope in single precision
+    assert np.allclose(tracker.cumulative_score[:num_frames], cumulative_score, rtol=1e-6)
+
+
+@pytest.mark.parametrize('tempo', [80.0, 100.0, 120.0, 150.0])
+def test_online_beat_tracker(tempo):
+    # agreement with the offline beats (within a frame, ignoring the warm-up of the running normalisation)
+    fmeasure = {0.1: [], None: []}
+    for seed in range(3):
+        oenv = click_track(tempo, seed=seed)
+        ref_beats, _ = beat_track_dp(oenv, tempo, FPS, SR, HOP_LENGTH)
+        for lookahead in fmeasure:
+            beats = online_beats(oenv, tempo, latency=0.1, lookahead=lookahead)
+            fmeasure[lookahead].append(mir_eval.beat.f_measure(ref_beats[ref_beats >= 2], beats[beats >= 2],
+                                                               f_measure_threshold=0.011))
+    assert np.mean(fmeasure[None]) >= 0.9
+    # revising the most recent beats by backtracking is better than reporting them greedily
+    assert np.mean(fmeasure[None]) > np.mean(fmeasure[0.1])
+
+
+def test_online_beat_tracker_example(audio_file):
+    # the easy example has a steady tempo, thus the online beats are (almost) the offline ones
+    _, flux = compute_features(audio_file('easy_example'))
+    oenv = np.asarray(flux)
+    tempo = float(librosa.beat.tempo(onset_envelope=oenv, sr=SR, hop_length=HOP_LENGTH)[0])
+    ref_beats, _ = beat_track_dp(oenv, tempo, FPS, SR, HOP_LENGTH)
+    beats = online_beats(oenv, tempo)
+    # the offline tracker trims leading beats, the online one reports all
+    beats = beats[beats >= ref_beats[0] - 0.07]
+    assert mir_eval.beat.f_measure(ref_beats, beats) >= 0.95
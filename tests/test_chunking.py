@@ -0,0 +1,37 @@
+"""Tests of the chunked inference (`common.chunking`) against predicting whole tracks."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+
+from common.chunking import ChunkedModel  # noqa: E402
+from common.model import create_model  # noqa: E402
+
+NUM_BINS = 81
+
+
+@pytest.fixture(scope='module', params=['same', 'causal'])
+def model(request):
+    return create_model((None, NUM_BINS, 1), num_filters=8, num_dilations=5, padding=request.param)
+
+
+@pytest.mark.parametrize('num_frames', [50, 1004])
+@pytest.mark.parametrize('chunk_size, batch_size', [(100, 1), (128, 3), (2000, 1)])
+def test_chunked_model(model, num_frames, chunk_size, batch_size):
+    x = np.random.RandomState(num_frames).randn(1, num_frames, NUM_BINS, 1).astype(np.float32)
+    chunked = ChunkedModel(model, chunk_size=chunk_size, batch_size=batch_size)
+    for full_act, chunked_act in zip(model.predict(x, verbose=0), chunked.predict(x)):
+        assert full_act.shape == chunked_act.shape
+        assert np.allclose(full_act, chunked_act, atol=1e-5)
+
+
+def test_chunks(model):
+    chunked = ChunkedModel(model, chunk_size=100)
+    chunks = chunked.chunks(250)
+    # the output frames cover the track exactly once
+    assert [frames for frames, _ in chunks] == [(0, 100), (100, 200), (200, 250)]
+    # the input frames cover the context of the output frames (as far as the track reaches)
+    for (start, stop), (input_start, input_stop) in chunks:
+        assert input_start == max(0, start - chunked.context)
+        assert input_stop == min(250, stop + chunked.context) + chunked.frames_lost
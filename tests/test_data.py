@@ -0,0 +1,327 @@
+"""Tests of the dataset handling (`common.data`) with fake tracks cut from the book's examples."""
+
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+madmom = pytest.importorskip('madmom')
+sf = pytest.importorskip('soundfile')
+
+from madmom.audio.signal import FramedSignalProcessor, SignalProcessor  # noqa: E402
+from madmom.audio.spectrogram import FilteredSpectrogramProcessor, LogarithmicSpectrogramProcessor  # noqa: E402
+from madmom.audio.stft import ShortTimeFourierTransformProcessor  # noqa: E402
+from madmom.processors import SequentialProcessor  # noqa: E402
+
+from common.data import (  # noqa: E402
+    MASK_VALUE, BucketedSequence, CropSequence, DataSequence, FeatureStore, PrefetchLoader, TempoAugmentedSequence,
+    bucket_batches, process_tracks, receptive_field, resample_frames, tempo_target, track_data, widen_targets,
+)
+
+FPS = 100
+
+
+class PreProcessor(SequentialProcessor):
+    # pre-processor of the notebook
+    def __init__(self, frame_size=2048, num_bands=12, log=np.log, add=1e-6, fps=FPS):
+        sig = SignalProcessor(num_channels=1, sample_rate=44100)
+        frames = FramedSignalProcessor(frame_size=frame_size, fps=fps)
+        stft = ShortTimeFourierTransformProcessor()
+        filt = FilteredSpectrogramProcessor(num_bands=num_bands)
+        spec = LogarithmicSpectrogramProcessor(log=log, add=add)
+        super().__init__((sig, frames, stft, filt, spec, np.array))
+        self.fps = fps
+
+
+class Beats:
+    # beat annotations of a mirdata track, `positions` only if downbeats are annotated
+    def __init__(self, times, positions=None):
+        self.times = times
+        if positions is not None:
+            self.positions = positions
+
+
+class Track:
+    # the parts of a mirdata track used by `track_data`
+    def __init__(self, filename, start, stop, downbeats=True):
+        y, sr = sf.read(filename, dtype='float32')
+        self.audio = y[int(start * sr):int(stop * sr)], sr
+        filename = os.path.splitext(filename)[0] + '.beats'
+        if os.path.exists(filename):
+            beats = np.loadtxt(filename)
+            beats = beats[(beats[:, 0] >= start) & (beats[:, 0] < stop)]
+            self.beats = Beats(beats[:, 0] - start, beats[:, 1] if downbeats else None)
+
+
+@pytest.fixture(scope='module')
+def tracks(audio_file):
+    return {'easy': Track(audio_file('easy_example'), 0, 8),
+            'expressive': Track(audio_file('expressive_example'), 2, 8, downbeats=False),
+            'no_beats': Track(audio_file('mini'), 0, 3),
+            'nonwestern': Track(audio_file('nonwestern_example'), 5, 15),
+            'short': Track(audio_file('easy_example'), 20, 23)}
+
+
+@pytest.fixture(scope='module')
+def items(tracks):
+    return list(process_tracks(tracks, PreProcessor()))
+
+
+@pytest.fixture(scope='module')
+def store(items, tmp_path_factory):
+    return FeatureStore.write(str(tmp_path_factory.mktemp('data') / 'store'), items, FPS)
+
+
+def assert_items_equal(data, reference):
+    for name in ('x', 'beats', 'downbeats', 'tempo', 'beat_times', 'downbeat_times'):
+        if reference[name] is None:
+            assert data[name] is None
+        else:
+            assert np.array_equal(data[name], reference[name])
+
+
+def test_process_tracks(tracks, items):
+    # tracks without beats are skipped
+    assert [key for key, _ in items] == ['easy', 'expressive', 'nonwestern', 'short']
+    for key, data in items:
+        assert_items_equal(data, track_data(key, tracks[key], PreProcessor()))
+    # missing downbeats are masked
+    data = dict(items)['expressive']
+    assert data['downbeat_times'] is None
+    assert np.all(data['downbeats'] == MASK_VALUE)
+
+
+@pytest.mark.parametrize('num_workers', [2, 3])
+def test_process_tracks_parallel(tracks, items, num_workers):
+    parallel = list(process_tracks(tracks, PreProcessor(), num_workers=num_workers))
+    # same results in the same order
+    assert [key for key, _ in parallel] == [key for key, _ in items]
+    for (_, data), (_, reference) in zip(parallel, items):
+        assert_items_equal(data, reference)
+
+
+def test_feature_store(tmp_path, store, items):
+    assert store.ids == [key for key, _ in items]
+    assert len(store) == len(items)
+    assert 'easy' in store and 'no_beats' not in store
+    assert store.fps == FPS
+    assert store.num_bins == items[0][1]['x'].shape[1]
+    for key, data in items:
+        # data is stored as float32
+        reference = dict(data, x=data['x'].astype(np.float32))
+        assert_items_equal(store[key], reference)
+        assert isinstance(store[key]['x'], np.memmap)
+    # an empty store
+    empty = FeatureStore.write(str(tmp_path / 'empty'), [], FPS)
+    assert len(empty) == 0
+    assert empty.num_bins is None
+
+
+def test_feature_store_copy_on_write(store):
+    beats = store['easy']['beats']
+    reference = np.array(beats)
+    beats[:] = 0.5
+    # modifications are visible through the store, but not written to disk
+    assert np.all(store['easy']['beats'] == 0.5)
+    assert np.array_equal(FeatureStore(store.path)['easy']['beats'], reference)
+    beats[:] = reference
+    # read-only stores cannot be modified
+    with pytest.raises(ValueError):
+        FeatureStore(store.path, mode='r')['easy']['beats'][:] = 0.5
+
+
+def test_feature_store_create(tmp_path, tracks, store):
+    created = FeatureStore.create(str(tmp_path / 'store'), tracks, PreProcessor())
+    assert created.ids == store.ids
+    for key in store.ids:
+        assert_items_equal(created[key], store[key])
+    # existing stores are not overwritten, no partial stores are left behind
+    with pytest.raises(OSError):
+        FeatureStore.create(str(tmp_path / 'store'), tracks, PreProcessor())
+    assert os.listdir(tmp_path) == ['store']
+
+
+@pytest.mark.parametrize('widen', [False, True])
+def test_tempo_augmented_sequence(store, items, widen):
+    sequence = TempoAugmentedSequence(store, fps=(95, 105), pad_frames=2, widen=widen)
+    assert len(sequence) == 3 * len(store)
+    assert sequence.ids[:len(store)] == store.ids
+    assert sequence.ids[len(store):] == [f'{key}_{fps}' for fps in (95, 105) for key in store.ids]
+    reference = {}
+    for i, (key, fps) in enumerate(sequence.items):
+        data = store[key]
+        x = resample_frames(data['x'], fps / FPS)
+        beats = madmom.utils.quantize_events(data['beat_times'], fps=fps, length=len(x))
+        if data['downbeat_times'] is None:
+            downbeats = np.full(len(x), MASK_VALUE, dtype=np.float32)
+        else:
+            downbeats = madmom.utils.quantize_events(data['downbeat_times'], fps=fps, length=len(x))
+        tempo = tempo_target(key, data['beat_times'], fps)
+        if widen:
+            widen_targets(beats)
+            widen_targets(downbeats)
+            widen_targets(widen_targets(tempo))
+        x_batch, y_batch = sequence[i]
+        # length of the resampled (and padded) features
+        assert x_batch.shape == (1, sequence.lengths[i], store.num_bins, 1)
+        assert len(x) == max(1, int(round(len(data['x']) * fps / FPS)))
+        assert np.allclose(x_batch[0, 2:-2, :, 0], x)
+        assert np.array_equal(x_batch[0, :2, :, 0], np.repeat(x[:1], 2, axis=0))
+        assert np.array_equal(y_batch['beats'][0, :, 0], beats)
+        assert np.array_equal(y_batch['downbeats'][0, :, 0], downbeats)
+        assert np.array_equal(y_batch['tempo'][0], tempo)
+        reference[sequence.ids[i]] = x_batch, y_batch
+    # the same as computing a `DataSequence` for each frame rate (without widening the targets)
+    if not widen:
+        for fps in (95, 105):
+            augmented = DataSequence.from_store(store, pad_frames=2, fps=fps)
+            for i, key in enumerate(augmented.ids):
+                x_batch, y_batch = augmented[i]
+                assert np.array_equal(reference[key][0], x_batch)
+                for name in ('beats', 'downbeats', 'tempo'):
+                    assert np.array_equal(reference[key][1][name], y_batch[name])
+    # targets are widened on copies, the store is not modified
+    for key, data in items:
+        assert_items_equal(store[key], dict(data, x=data['x'].astype(np.float32)))
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_tempo_augmented_sequence_sample(store, seed):
+    sequence = TempoAugmentedSequence(store, fps=(95, 105), sample=True, seed=seed)
+    for _ in range(3):
+        assert len(sequence) == len(store)
+        assert [key for key, _ in sequence.items] == store.ids
+        assert all(fps in (FPS, 95, 105) for _, fps in sequence.items)
+        assert sequence.lengths == [len(sequence[i][0][0]) for i in range(len(sequence))]
+        sequence.on_epoch_end()
+
+
+@pytest.mark.parametrize('batch_size', [1, 4, 16])
+@pytest.mark.parametrize('max_padding', [0.0, 0.1, 0.25, 1.0])
+@pytest.mark.parametrize('boundaries', [None, [500, 1000, 2000]])
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_bucket_batches(batch_size, max_padding, boundaries, shuffle):
+    rng = np.random.RandomState(1)
+    # include items of equal length
+    lengths = np.concatenate((rng.randint(100, 3000, 200), [700] * 10))
+    batches = bucket_batches(lengths, batch_size, boundaries, max_padding, rng if shuffle else None)
+    # each item exactly once
+    assert np.array_equal(np.sort(np.concatenate(batches)), np.arange(len(lengths)))
+    for batch in batches:
+        assert 1 <= len(batch) <= batch_size
+        padding = 1 - np.sum(lengths[batch]) / (len(batch) * np.max(lengths[batch]))
+        assert padding <= max_padding + 1e-12
+        if boundaries is not None:
+            assert len(set(np.digitize(lengths[batch], boundaries))) == 1
+    if max_padding == 1.0 and boundaries is None:
+        # only the last batch is not full
+        assert all(len(batch) == batch_size for batch in batches[:-1])
+    if max_padding == 0.0:
+        assert all(len(set(lengths[batch])) == 1 for batch in batches)
+        assert sum(len(batch) for batch in batches if lengths[batch[0]] == 700) == 10
+
+
+def test_bucketed_sequence(store):
+    sequence = DataSequence.from_store(store, pad_frames=2)
+    batches = BucketedSequence(sequence, batch_size=2, max_padding=1.0, shuffle=False)
+    assert sorted(key for i in range(len(batches)) for key in batches.batch_ids(i)) == sorted(sequence.ids)
+    for i in range(len(batches)):
+        x_batch, y_batch = batches[i]
+        for j, key in enumerate(batches.batch_ids(i)):
+            x, y = sequence[key]
+            length = x.shape[1] - 4
+            assert np.array_equal(x_batch[j, :length + 4], x[0])
+            # features are padded with the last frame, targets are masked
+            assert np.all(x_batch[j, length + 4:] == x[0, -1])
+            for name in ('beats', 'downbeats'):
+                assert np.array_equal(y_batch[name][j, :length], y[name][0])
+                assert np.all(y_batch[name][j, length:] == MASK_VALUE)
+            assert np.array_equal(y_batch['tempo'][j], y['tempo'][0])
+
+
+@pytest.mark.parametrize('crop_length, context', [(400, 50), (100, 0), (200, receptive_field(3))])
+def test_crop_sequence(store, crop_length, context):
+    sequence = DataSequence.from_store(store, pad_frames=2)
+    crops = CropSequence(sequence, context, crop_length=crop_length, batch_size=3, crops_per_track=2, seed=0)
+    assert len(crops) == int(np.ceil(2 * len(sequence) / 3))
+    assert sorted(key for key, _ in crops.crops) == sorted(sequence.ids * 2)
+    for i in range(len(crops)):
+        x_batch, y_batch = crops[i]
+        assert x_batch.shape[1:] == (crop_length + 2 * context + 4, store.num_bins, 1)
+        for j, (key, start) in enumerate(crops.crops[i * 3:(i + 1) * 3]):
+            x, beats, downbeats, tempo = sequence.track(key)
+            stop = min(start + crop_length, len(x))
+            assert 0 <= start < max(1, len(x) - crop_length + 1)
+            # features of the excerpt with context, repeating the first/last frame outside the track
+            frames = np.clip(np.arange(start - context - 2, start + crop_length + context + 2), 0, len(x) - 1)
+            assert np.array_equal(x_batch[j, :, :, 0], x[frames])
+            # targets of the excerpt only, the context (and frames outside the track) is masked
+            for name, target in (('beats', beats), ('downbeats', downbeats)):
+                y = y_batch[name][j, :, 0]
+                assert np.all(y[:context] == MASK_VALUE)
+                assert np.array_equal(y[context:context + stop - start], target[start:stop])
+                assert np.all(y[context + stop - start:] == MASK_VALUE)
+            assert np.array_equal(y_batch['tempo'][j], tempo)
+    # the tracks shorter than an excerpt
+    assert any(len(sequence.track(key)[0]) < crop_length for key in sequence.ids) == (crop_length == 400)
+
+
+class Batches:
+    # batches filled with their index, counts the batches loaded and the epochs
+    def __init__(self, num_batches):
+        self.num_batches = num_batches
+        self.num_loaded = 0
+        self.num_epochs = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.num_batches
+
+    def load(self, idx, buffer):
+        x = buffer.array('x', (4, 100), fill=idx)
+        time.sleep(0.001)
+        with self.lock:
+            self.num_loaded += 1
+        return x, {'idx': idx}
+
+    def on_epoch_end(self):
+        self.num_epochs += 1
+
+
+@pytest.mark.parametrize('num_workers, queue_size', [(1, 1), (2, 3), (4, 16)])
+def test_prefetch_loader_order(num_workers, queue_size):
+    sequence = Batches(10)
+    loader = PrefetchLoader(sequence, num_workers=num_workers, queue_size=queue_size, shuffle=False)
+    assert len(loader) == 10
+    for epoch in range(3):
+        assert [next(loader)[1]['idx'] for _ in range(len(loader))] == list(range(10))
+    assert sequence.num_epochs >= 2
+    assert loader.stats['batches'] == 30
+    # shuffled, every batch once per epoch, reproducible with the same seed
+    orders = []
+    for _ in range(2):
+        loader = PrefetchLoader(Batches(10), num_workers=num_workers, queue_size=queue_size, seed=3)
+        orders.append([[next(loader)[1]['idx'] for _ in range(len(loader))] for _ in range(3)])
+    assert orders[0] == orders[1]
+    assert all(sorted(order) == list(range(10)) for order in orders[0])
+    assert orders[0][0] != orders[0][1]
+
+
+@pytest.mark.parametrize('num_workers, queue_size', [(1, 1), (2, 3), (4, 16)])
+def test_prefetch_loader_buffers(num_workers, queue_size):
+    sequence = Batches(10)
+    loader = PrefetchLoader(sequence, num_workers=num_workers, queue_size=queue_size, shuffle=False)
+    for i in range(25):
+        x, y = next(loader)
+        assert y['idx'] == i % 10
+        # wait for the loaders to fill the queue (with batches of the current epoch only), the batch held must
+        # not be overwritten
+        num_loaded = min(i + 1 + queue_size, (i // 10 + 1) * 10)
+        deadline = time.time() + 10
+        while sequence.num_loaded < num_loaded and time.time() < deadline:
+            time.sleep(0.001)
+        assert sequence.num_loaded == num_loaded
+        assert np.all(x == i % 10)
@@ -0,0 +1,145 @@
+"""Tests of the knowledge distillation (`common.distillation`)."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+pytest.importorskip('madmom')
+
+from common.data import DataSequence  # noqa: E402
+from common.distillation import DistillationSequence, distill, load_teacher_activations, soften  # noqa: E402
+from common.inference import predict  # noqa: E402
+from common.model import create_model  # noqa: E402
+from common.pruning import compile_model  # noqa: E402
+from common.tempo import MASK_VALUE  # noqa: E402
+
+NUM_BINS = 81
+PAD_FRAMES = 2
+
+
+@pytest.fixture(scope='module')
+def sequence():
+    # tracks with all, without downbeat and without any annotations
+    rng = np.random.RandomState(0)
+    sequence = DataSequence({}, None, pad_frames=PAD_FRAMES)
+    for i, length in enumerate([300, 250, 300]):
+        beats = (rng.rand(length) > 0.9).astype(np.float32)
+        downbeats = (rng.rand(length) > 0.97).astype(np.float32)
+        tempo = np.eye(300, dtype=np.float32)[rng.randint(60, 200)]
+        if i > 0:
+            downbeats[:] = MASK_VALUE
+        if i > 1:
+            beats[:] = MASK_VALUE
+            tempo[:] = MASK_VALUE
+        sequence.add('track_%d' % i, {'x': rng.randn(length, NUM_BINS).astype(np.float32), 'beats': beats,
+                                      'downbeats': downbeats, 'tempo': tempo})
+    return sequence
+
+
+@pytest.fixture(scope='module')
+def teacher():
+    return create_model((None, NUM_BINS, 1), num_filters=8, num_dilations=4)
+
+
+@pytest.fixture(scope='module')
+def teacher_activations(teacher, sequence):
+    activations, _ = predict(teacher, sequence, num_workers=0)
+    return activations
+
+
+def test_soften():
+    rng = np.random.RandomState(0)
+    sigmoid = rng.rand(100)
+    logits = rng.randn(2, 300)
+    softmax = np.exp(logits) / np.sum(np.exp(logits), axis=-1, keepdims=True)
+    # a temperature of 1 is the identity
+    assert soften(sigmoid, 1) is sigmoid
+    assert soften(softmax, 1, axis=-1) is softmax
+    for temperature in (0.5, 2.0):
+        # softmax outputs are still distributions, with the same order of the bins
+        softened = soften(softmax, temperature, axis=-1)
+        assert np.allclose(np.sum(softened, axis=-1), 1)
+        assert np.array_equal(np.argsort(softened, axis=-1), np.argsort(softmax, axis=-1))
+        # sigmoid activations keep their side of 0.5
+        softened = soften(sigmoid, temperature)
+        assert np.all((softened > 0.5) == (sigmoid > 0.5))
+    # higher temperatures move the activations towards 0.5 (uniform), lower ones away
+    assert np.all(np.abs(soften(sigmoid, 2.0) - 0.5) <= np.abs(sigmoid - 0.5) + 1e-12)
+    assert np.all(np.abs(soften(sigmoid, 0.5) - 0.5) >= np.abs(sigmoid - 0.5) - 1e-12)
+    assert np.all(np.max(soften(softmax, 2.0, axis=-1), axis=-1) < np.max(softmax, axis=-1))
+
+
+@pytest.mark.parametrize('temperature', [1.0, 2.0])
+def test_blend(sequence, teacher_activations, temperature):
+    alpha = 0.25
+    distillation = DistillationSequence(sequence, teacher_activations, alpha=alpha, temperature=temperature)
+    assert distillation.ids == sequence.ids
+    assert distillation.lengths == sequence.lengths
+    for key in sequence.ids:
+        teacher = {name: soften(teacher_activations[key][name], temperature, axis=-1 if name == 'tempo' else None)
+                   for name in ('beats', 'downbeats', 'tempo')}
+        x, *targets = distillation.track(key)
+        assert np.array_equal(x, sequence.track(key)[0])
+        for name, target, annotation in zip(('beats', 'downbeats', 'tempo'), targets, sequence.track(key)[1:]):
+            if np.all(annotation == MASK_VALUE):
+                # no annotations, the teacher's activations alone
+                assert np.array_equal(target, teacher[name])
+            else:
+                assert np.allclose(target, alpha * teacher[name] + (1 - alpha) * annotation)
+            assert np.all(target >= 0)
+        # the batches are the same as those of the sequence, with the blended targets
+        x_batch, y_batch = distillation[sequence.ids.index(key)]
+        assert np.array_equal(x_batch, sequence[key][0])
+        assert np.array_equal(y_batch['beats'][0, :, 0], targets[0])
+        assert np.array_equal(y_batch['tempo'][0], targets[2])
+
+
+def test_blend_masked_frames(sequence, teacher_activations):
+    # frames without annotation (e.g. widened or partially annotated targets) keep the teacher's activations
+    key = sequence.ids[0]
+    beats = sequence.track(key)[1].copy()
+    beats[:100] = MASK_VALUE
+    distillation = DistillationSequence(sequence, teacher_activations, alpha=0.5)
+    blended = distillation._blend(teacher_activations[key]['beats'], beats)
+    assert np.array_equal(blended[:100], teacher_activations[key]['beats'][:100])
+    assert np.allclose(blended[100:], 0.5 * teacher_activations[key]['beats'][100:] + 0.5 * beats[100:])
+    # alpha of 1 ignores the annotations
+    distillation = DistillationSequence(sequence, teacher_activations, alpha=1.0)
+    assert distillation._blend(teacher_activations[key]['beats'], beats) is teacher_activations[key]['beats']
+
+
+def test_frame_mismatch(sequence, teacher_activations):
+    teacher = dict(teacher_activations)
+    key = sequence.ids[1]
+    teacher[key] = dict(teacher[key], beats=teacher[key]['beats'][:-1])
+    with pytest.raises(ValueError, match='track %s' % key):
+        DistillationSequence(sequence, teacher)
+
+
+def test_load_teacher_activations(teacher, sequence, teacher_activations, tmp_path):
+    predict(teacher, sequence, detdir=str(tmp_path), num_workers=0)
+    loaded = load_teacher_activations(str(tmp_path), sequence.ids)
+    for key in sequence.ids:
+        for name in ('beats', 'downbeats', 'tempo'):
+            assert np.allclose(loaded[key][name], teacher_activations[key][name])
+
+
+def test_distill(sequence, teacher_activations):
+    student = create_model((None, NUM_BINS, 1), num_filters=4, num_dilations=2)
+    weights = [w.copy() for w in student.get_weights()]
+    history = distill(student, sequence, teacher_activations, epochs=2, alpha=0.5, temperature=2.0,
+                      compile_fn=lambda m: compile_model(m, optimizer='adam'))
+    assert len(history.history['loss']) == 2
+    assert np.all(np.isfinite(history.history['loss']))
+    assert any(not np.array_equal(a, b) for a, b in zip(weights, student.get_weights()))
+    # the student runs through `predict` unchanged, i.e. the same as the teacher
+    activations, detections = predict(student, sequence, num_workers=0)
+    assert list(activations) == list(detections) == sequence.ids
+    for key in sequence.ids:
+        beats, downbeats, tempo = student.predict(sequence[key][0], verbose=0)
+        assert np.allclose(activations[key]['beats'], beats[0, :, 0], atol=1e-6)
+        assert np.allclose(activations[key]['downbeats'], downbeats[0, :, 0], atol=1e-6)
+        assert np.allclose(activations[key]['tempo'], tempo[0], atol=1e-6)
+        for name in ('beats', 'downbeats', 'tempo'):
+            assert activations[key][name].shape == teacher_activations[key][name].shape
+        assert set(detections[key]) == {'beats', 'downbeats', 'bars', 'tempo'}
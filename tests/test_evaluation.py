@@ -0,0 +1,89 @@
+"""Tests of the evaluation (`common.evaluation`) of tracks with and without tempo annotations."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('madmom')
+
+from common.evaluation import annotated_tempo, evaluate, scores  # noqa: E402
+from common.tempo import infer_tempo  # noqa: E402
+
+
+class Beats:
+    def __init__(self, times, positions):
+        self.times = times
+        self.positions = positions
+
+
+class Track:
+    # a mirdata track, attributes the dataset does not annotate are missing
+    def __init__(self, **annotations):
+        self.__dict__.update(annotations)
+
+
+def beats(interval, num_beats=40):
+    times = np.arange(1, num_beats + 1) * interval
+    return Beats(times, np.arange(num_beats) % 4 + 1)
+
+
+def detection(tempo, beat_interval=0.5):
+    times = beats(beat_interval).times
+    return {'beats': times, 'downbeats': times[::4], 'bars': np.vstack((times, np.arange(len(times)) % 4 + 1)).T,
+            'tempo': np.array([[tempo, 1.0]])}
+
+
+@pytest.fixture
+def tracks():
+    return {
+        'annotated': Track(beats=beats(0.5), tempo=120.0),
+        'no_tempo': Track(beats=beats(0.5), tempo=None),
+        'no_tempo_attribute': Track(beats=beats(0.5)),
+        'tempo_only': Track(tempo=90.0),
+        'nothing': Track(),
+    }
+
+
+def test_annotated_tempo(tracks):
+    assert annotated_tempo(tracks['annotated']) == (120.0, False)
+    assert annotated_tempo(tracks['annotated'], infer_missing_tempo=True) == (120.0, False)
+    assert annotated_tempo(tracks['no_tempo']) == (None, False)
+    inferred = infer_tempo(tracks['no_tempo'].beats.times, no_tempo=None)
+    assert annotated_tempo(tracks['no_tempo'], infer_missing_tempo=True) == (inferred, True)
+    assert annotated_tempo(tracks['nothing'], infer_missing_tempo=True) == (None, False)
+    assert annotated_tempo(Track(beats=beats(0.5, 1)), infer_missing_tempo=True) == (None, False)
+
+
+def test_evaluate(tracks):
+    # correct tempo of the annotated tracks, double tempo of the others
+    detections = {key: detection(120.0 if key == 'annotated' else 240.0) for key in tracks}
+    detections['tempo_only'] = detection(90.0)
+    results = evaluate(detections, tracks)
+    assert len(results['beats']) == len(results['downbeats']) == 3
+    assert results['beats'].fmeasure == 1
+    # the notebook's metric, i.e. only annotated tempi
+    assert len(results['tempo']) == 2
+    assert results['tempo'].acc1 == 1
+    assert 'tempo_inferred' not in results
+    assert set(scores(results)) == {'beats_fmeasure', 'downbeats_fmeasure', 'bars_fmeasure', 'tempo_acc1',
+                                    'tempo_acc2'}
+
+    results = evaluate(detections, tracks, infer_missing_tempo=True)
+    assert len(results['tempo']) == 2
+    assert results['tempo'].acc1 == 1
+    assert len(results['tempo_inferred']) == 2
+    assert results['tempo_inferred'].acc1 == 0
+    assert results['tempo_inferred'].acc2 == 1
+    result = scores(results)
+    assert result['tempo_acc1'] == 1
+    assert result['tempo_inferred_acc1'] == 0
+
+
+def test_evaluate_no_tempo(tracks):
+    tracks = {key: track for key, track in tracks.items() if getattr(track, 'tempo', None) is None}
+    detections = {key: detection(120.0) for key in tracks}
+    results = evaluate(detections, tracks)
+    assert 'tempo' not in results
+    assert 'tempo_acc1' not in scores(results)
+    results = evaluate(detections, tracks, infer_missing_tempo=True)
+    assert 'tempo' not in results
+    assert results['tempo_inferred'].acc1 == 1
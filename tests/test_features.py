@@ -0,0 +1,132 @@
+"""Tests of the (multi-band and streaming) feature computation (`common.features`)."""
+
+import functools
+import os
+
+import numpy as np
+import pytest
+
+librosa = pytest.importorskip('librosa')
+
+import common.features  # noqa: E402
+from common.features import (  # noqa: E402
+    BL_N_FFT, SR, FeatureCache, compute_features, mel_spectrogram, multiband_spectral_flux, spectral_flux, stream_mel_spectrogram,
+    stream_spectral_flux,
+)
+
+EXAMPLES = ['easy_example', 'expressive_example', 'mini']
+
+
+@pytest.mark.parametrize('name', EXAMPLES)
+@pytest.mark.parametrize('block_size', [1024, 37])
+def test_stream_mel_spectrogram(audio_file, name, block_size):
+    y, sr = librosa.load(audio_file(name), sr=None)
+    S = mel_spectrogram(y, sr=sr)
+    streamed = np.hstack(list(stream_mel_spectrogram(audio_file(name), block_size=block_size)))
+    assert streamed.shape == S.shape
+    # including the first and the last frames, i.e. the padded ones
+    assert np.allclose(streamed, S, rtol=1e-5, atol=1e-10 * S.max())
+
+
+@pytest.mark.parametrize('name', EXAMPLES)
+def test_stream_spectral_flux(audio_file, name):
+    _, flux = compute_features(audio_file(name))
+    streamed = np.concatenate(list(stream_spectral_flux(audio_file(name))))
+    assert streamed.shape == flux.shape
+    assert np.allclose(streamed, flux, atol=1e-4)
+
+
+@pytest.mark.parametrize('name', EXAMPLES)
+def test_multiband_spectral_flux(audio_file, name):
+    y, sr = librosa.load(audio_file(name), sr=None)
+    bands = [(27.5, 400.0, 40), (400.0, 2000.0, 24), (2000.0, 17000.0, 24)]
+    flux = multiband_spectral_flux(y, bands, sr=sr)
+    for band, (fmin, fmax, n_mels) in zip(flux, bands):
+        S = mel_spectrogram(y, sr=sr, n_fft=BL_N_FFT, n_mels=n_mels, fmin=fmin, fmax=fmax)
+        assert np.allclose(band, spectral_flux(S, sr=sr), atol=1e-4)
+
+
+@pytest.fixture
+def computed(monkeypatch):
+    """Count the calls of `compute_features` (and `file_hash`) made by the feature cache."""
+    calls = {'compute_features': 0, 'file_hash': 0}
+
+    def counting(name):
+        func = getattr(common.features, name)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            calls[name] += 1
+            return func(*args, **kwargs)
+
+        monkeypatch.setattr(common.features, name, wrapper)
+
+    counting('compute_features')
+    counting('file_hash')
+    monkeypatch.setattr(FeatureCache, '_hashes', {})
+    return calls
+
+
+def test_feature_cache_hit_and_miss(tmp_path, audio_file, computed):
+    cache = FeatureCache(str(tmp_path))
+    S, flux = cache(audio_file('mini'))
+    assert computed['compute_features'] == 1
+    reference = compute_features(audio_file('mini'))
+    assert np.array_equal(S, reference[0])
+    assert np.array_equal(flux, reference[1])
+    # hit, also with default values passed explicitly and by a new cache instance
+    computed['compute_features'] = 0
+    cache(audio_file('mini'))
+    cache(audio_file('mini'), sr=SR)
+    FeatureCache(str(tmp_path), sr=SR)(audio_file('mini'))
+    assert computed['compute_features'] == 0
+    # miss, different file or parameters
+    cache(audio_file('easy_example'))
+    cache(audio_file('mini'), n_mels=40)
+    assert computed['compute_features'] == 2
+    assert len(cache.entries()) == 3
+
+
+def test_feature_cache_key(tmp_path, audio_file, computed):
+    filename = audio_file('mini')
+    cache = FeatureCache(str(tmp_path))
+    assert cache.key(filename) == cache.key(filename, sr=SR)
+    assert cache.key(filename) == FeatureCache(str(tmp_path), sr=SR).key(filename)
+    assert cache.key(filename) != cache.key(filename, sr=22050)
+    assert FeatureCache(str(tmp_path), sr=22050).key(filename, n_mels=40) == cache.key(filename, sr=22050, n_mels=40)
+    # the file is hashed only once
+    assert computed['file_hash'] == 1
+
+
+def test_feature_cache_eviction(tmp_path, audio_file):
+    filename = audio_file('mini')
+    cache = FeatureCache(str(tmp_path))
+    paths = []
+    for i, n_mels in enumerate([20, 30, 40]):
+        cache(filename, n_mels=n_mels)
+        paths.append(str(tmp_path / cache.key(filename, n_mels=n_mels)))
+        os.utime(paths[-1], (i, i))
+    sizes = {path: size for _, size, path in cache.entries()}
+    # using an entry marks it as recently used
+    cache(filename, n_mels=20)
+    assert [path for _, _, path in cache.entries()] == paths[1:] + paths[:1]
+    # the least recently used entry is evicted
+    cache.evict(sizes[paths[0]] + sizes[paths[2]])
+    assert [path for _, _, path in cache.entries()] == paths[2:] + paths[:1]
+    # the most recently used entry is always kept
+    cache.evict(0)
+    assert [path for _, _, path in cache.entries()] == paths[:1]
+    # evicted entries are computed again
+    S, _ = cache(filename, n_mels=30)
+    assert S.shape[0] == 30
+    assert len(cache.entries()) == 2
+
+
+def test_feature_cache_max_bytes(tmp_path, audio_file):
+    cache = FeatureCache(str(tmp_path), max_bytes=1)
+    S, flux = cache(audio_file('mini'))
+    # the new entry is returned and kept, even if it exceeds the maximum size
+    assert len(cache.entries()) == 1
+    S, flux = cache(audio_file('easy_example'))
+    assert [path for _, _, path in cache.entries()] == [str(tmp_path / cache.key(audio_file('easy_example')))]
+    assert np.array_equal(S, compute_features(audio_file('easy_example'))[0])
@@ -0,0 +1,87 @@
+"""Tests of the fine-tuning of the output layers from cached trunk activations (`common.finetuning`)."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+pytest.importorskip('madmom')
+
+from common.data import FeatureStore, TempoAugmentedSequence  # noqa: E402
+from common.finetuning import HEADS, TrunkCache, TrunkSequence, fine_tune_heads, head_model  # noqa: E402
+from common.model import create_model  # noqa: E402
+from common.pruning import compile_model  # noqa: E402
+
+NUM_BINS = 81
+
+
+class Tracks:
+    # single tracks of different length, the same interface as `DataSequence`
+    def __init__(self, lengths, seed=0):
+        rng = np.random.RandomState(seed)
+        self.ids = ['track_%d' % i for i in range(len(lengths))]
+        self.items = []
+        for length in lengths:
+            x = rng.randn(1, length + 4, NUM_BINS, 1).astype(np.float32)
+            y = {'beats': (rng.rand(1, length, 1) > 0.9).astype(np.float32),
+                 'downbeats': (rng.rand(1, length, 1) > 0.97).astype(np.float32),
+                 'tempo': np.eye(300, dtype=np.float32)[[rng.randint(60, 200)]]}
+            self.items.append((x, y))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, idx):
+        return self.items[idx]
+
+
+@pytest.fixture(scope='module')
+def model():
+    return create_model((None, NUM_BINS, 1), num_filters=8, num_dilations=4)
+
+
+@pytest.fixture(scope='module')
+def cache(model, tmp_path_factory):
+    return TrunkCache.create(str(tmp_path_factory.mktemp('trunk') / 'cache'), model, Tracks([300, 280, 310, 150]))
+
+
+def test_padded_batch(model, cache):
+    heads = head_model(model)
+    sequence = TrunkSequence(cache, batch_size=4, max_padding=1.0, shuffle=False)
+    assert len(sequence) == 1
+    (tcn, skip), _ = sequence[0]
+    beats, downbeats, tempo = heads.predict([tcn, skip], verbose=0)
+    for i, idx in enumerate(sequence.batches[0]):
+        track = cache[sequence.ids[idx]]
+        length = len(track['tcn'])
+        ref_beats, ref_downbeats, ref_tempo = heads.predict([track['tcn'][np.newaxis], track['skip'][np.newaxis]],
+                                                            verbose=0)
+        assert np.allclose(beats[i, :length], ref_beats[0], atol=1e-6)
+        assert np.allclose(downbeats[i, :length], ref_downbeats[0], atol=1e-6)
+        # the padded frames are masked, i.e. do not alter the average of the tempo head
+        assert np.allclose(tempo[i], ref_tempo[0], atol=1e-6)
+
+
+def test_padded_targets(cache):
+    sequence = TrunkSequence(cache, batch_size=4, max_padding=1.0, shuffle=False)
+    _, y = sequence[0]
+    lengths = [len(cache[sequence.ids[idx]]['tcn']) for idx in sequence.batches[0]]
+    for i, length in enumerate(lengths):
+        assert np.all(y['beats'][i, length:] == -1)
+        assert np.all(y['downbeats'][i, length:] == -1)
+
+
+def test_fine_tune_heads(model, cache):
+    weights = {layer.name: [w.copy() for w in layer.get_weights()] for layer in model.layers}
+    fine_tune_heads(model, cache, epochs=1, batch_size=2, compile_fn=lambda m: compile_model(m, optimizer='adam'))
+    for layer in model.layers:
+        changed = any(not np.array_equal(a, b) for a, b in zip(weights[layer.name], layer.get_weights()))
+        assert changed == (layer.name in HEADS)
+
+
+def test_sampled_augmentation(model, tmp_path):
+    data = {'x': np.zeros((100, NUM_BINS)), 'beats': np.zeros(100), 'downbeats': np.zeros(100),
+            'tempo': np.zeros(300), 'beat_times': np.arange(0.5, 1, 0.5), 'downbeat_times': None}
+    store = FeatureStore.write(str(tmp_path / 'store'), [('track', data)], fps=100)
+    # the cache would freeze the frame rates sampled for a single epoch
+    with pytest.raises(ValueError):
+        TrunkCache.create(str(tmp_path / 'cache'), model, TempoAugmentedSequence(store, sample=True))
@@ -0,0 +1,150 @@
+"""Tests of the batched inference (`common.inference`) against the per-track loop of the notebook."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+pytest.importorskip('madmom')
+
+from scipy.ndimage import maximum_filter1d  # noqa: E402
+
+from common.data import bucket_batches, receptive_field  # noqa: E402
+from common.inference import InferenceEngine, predict  # noqa: E402
+from common.model import create_model  # noqa: E402
+from common.postprocessing import FPS, activation_dict, create_trackers, post_process  # noqa: E402
+from common.tempo import detect_tempo  # noqa: E402
+
+NUM_BINS = 81
+NUM_DILATIONS = 3
+
+
+class Tracks:
+    # single tracks of different length, the same interface as `DataSequence`
+    def __init__(self, lengths, seed=0):
+        rng = np.random.RandomState(seed)
+        self.ids = ['track_%d' % i for i in range(len(lengths))]
+        self.items = []
+        for length in lengths:
+            # features with some periodicity, so that beats are detected
+            x = rng.randn(1, length + 4, NUM_BINS, 1).astype(np.float32)
+            x[:, ::rng.randint(30, 70)] += 3
+            self.items.append((x, {}))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, idx):
+        return self.items[idx]
+
+    @property
+    def lengths(self):
+        return [x.shape[1] for x, _ in self.items]
+
+
+def predict_loop(model, dataset):
+    # reference implementation of the notebook (without saving the detections)
+    beat_tracker, downbeat_tracker, bar_tracker = create_trackers(FPS)
+    activations, detections = {}, {}
+    for i, t in enumerate(dataset):
+        f = dataset.ids[i]
+        x = t[0]
+        beats, downbeats, tempo = model.predict(x, verbose=0)
+        beats_act = beats.squeeze()
+        downbeats_act = downbeats.squeeze()
+        tempo_act = tempo.squeeze()
+        beats = beat_tracker(beats_act)
+        combined_act = np.vstack((np.maximum(beats_act - downbeats_act, 0), downbeats_act)).T
+        downbeats = downbeat_tracker(combined_act)
+        beat_idx = (beats * FPS).astype(int)
+        bar_act = maximum_filter1d(downbeats_act, size=3)
+        bar_act = bar_act[beat_idx]
+        bar_act = np.vstack((beats, bar_act)).T
+        try:
+            bars = bar_tracker(bar_act)
+        except IndexError:
+            bars = np.empty((0, 2))
+        tempo = detect_tempo(tempo_act)
+        activations[f] = {'beats': beats_act, 'downbeats': downbeats_act, 'combined': combined_act,
+                          'tempo': tempo_act}
+        detections[f] = {'beats': beats, 'downbeats': downbeats, 'bars': bars, 'tempo': tempo}
+    return activations, detections
+
+
+def assert_equal_results(activations, detections, ref_activations, ref_detections, keys=None):
+    for key in keys or ref_activations:
+        for name in ('beats', 'downbeats', 'combined', 'tempo'):
+            assert activations[key][name].shape == ref_activations[key][name].shape
+            assert np.allclose(activations[key][name], ref_activations[key][name], atol=1e-5)
+        for name in ('beats', 'downbeats', 'bars', 'tempo'):
+            assert np.shape(detections[key][name]) == np.shape(ref_detections[key][name])
+            assert np.allclose(detections[key][name], ref_detections[key][name], atol=1e-6)
+
+
+@pytest.fixture(scope='module')
+def model():
+    model = create_model((None, NUM_BINS, 1), num_filters=8, num_dilations=NUM_DILATIONS)
+    # fixed weights, the notebook's loop fails if no downbeats are found
+    rng = np.random.RandomState(1)
+    model.set_weights([rng.uniform(-0.2, 0.2, w.shape).astype(w.dtype) for w in model.get_weights()])
+    return model
+
+
+@pytest.fixture(scope='module')
+def dataset():
+    return Tracks([500, 300, 500, 700, 300, 500, 480, 650])
+
+
+@pytest.fixture(scope='module')
+def reference(model, dataset):
+    return predict_loop(model, dataset)
+
+
+def test_predict(model, dataset, reference):
+    engine = InferenceEngine(model, batch_size=4, max_padding=0.0, num_workers=0)
+    activations, detections = engine.predict(dataset)
+    assert list(activations) == list(detections) == dataset.ids
+    # tracks of equal length were batched, no padding
+    assert engine.stats['batches'] < len(dataset)
+    assert engine.stats['padding'] == 0
+    assert_equal_results(activations, detections, *reference)
+    assert all(len(detections[key]['beats']) for key in dataset.ids)
+
+
+def test_predict_padded(model, dataset, reference):
+    engine = InferenceEngine(model, batch_size=4, max_padding=0.5, num_workers=0)
+    activations, detections = engine.predict(dataset)
+    assert list(activations) == dataset.ids
+    assert engine.stats['padding'] > 0
+    trackers = create_trackers(FPS)
+    lengths = np.asarray(dataset.lengths)
+    context = receptive_field(NUM_DILATIONS)
+    num_padded = 0
+    # the same batches as the engine
+    for batch in bucket_batches(lengths, 4, max_padding=0.5):
+        num_frames = max(lengths[batch])
+        for idx in batch:
+            key = dataset.ids[idx]
+            if lengths[idx] == num_frames:
+                # the longest track(s) of the batch are not padded, i.e. the same as predicting them one by one
+                assert_equal_results(activations, detections, *reference, keys=[key])
+                continue
+            num_padded += 1
+            # the same as predicting the track padded by repeating its last frame
+            x = dataset[int(idx)][0]
+            x = np.pad(x, [(0, 0), (0, num_frames - x.shape[1]), (0, 0), (0, 0)], mode='edge')
+            beats, downbeats, tempo = model.predict(x, verbose=0)
+            length = len(reference[0][key]['beats'])
+            act = activation_dict(beats[0, :length, 0], downbeats[0, :length, 0], tempo[0])
+            assert_equal_results(activations, detections, {key: act}, {key: post_process(act, trackers, FPS)})
+            # frames not seeing the padding are the same as without padding
+            for name in ('beats', 'downbeats'):
+                assert np.allclose(activations[key][name][:length - context],
+                                   reference[0][key][name][:length - context], atol=1e-5)
+    assert num_padded > 0
+
+
+def test_predict_num_workers(model, dataset, reference):
+    activations, detections = predict(model, dataset, batch_size=4, num_workers=2)
+    # same order as the tracks of the dataset, although finished in any order
+    assert list(activations) == list(detections) == dataset.ids
+    assert_equal_results(activations, detections, *reference)
@@ -0,0 +1,101 @@
+"""Tests of the periodicity analysis (`common.periodicity`) against `librosa` on the book's examples."""
+
+import numpy as np
+import pytest
+
+librosa = pytest.importorskip('librosa')
+
+from packaging.version import Version  # noqa: E402
+
+from common.baseline import beat_track_dp  # noqa: E402
+from common.features import FPS, HOP_LENGTH, SR, compute_features  # noqa: E402
+from common.periodicity import (  # noqa: E402
+    PeriodicityAnalysis, global_autocorrelation, lag_range, mean_tempogram, tempogram, tempogram_blocks,
+)
+
+EXAMPLES = ['easy_example', 'expressive_example', 'mini']
+
+# `librosa.beat.tempo` was moved to `librosa.feature.tempo` in version 0.10
+librosa_tempo = getattr(librosa.feature, 'tempo', None) or librosa.beat.tempo
+
+
+@pytest.fixture(scope='module')
+def onset_envelope(audio_file):
+    envelopes = {}
+
+    def oenv(name):
+        if name not in envelopes:
+            envelopes[name] = compute_features(audio_file(name))[1]
+        return envelopes[name]
+
+    return oenv
+
+
+@pytest.mark.parametrize('name', EXAMPLES)
+def test_periodicity_analysis(onset_envelope, name):
+    oenv = onset_envelope(name)
+    analysis = PeriodicityAnalysis(oenv)
+    tempogram = librosa.feature.tempogram(onset_envelope=oenv, sr=SR, hop_length=HOP_LENGTH, win_length=384)
+    assert analysis.tempogram.shape == tempogram.shape
+    assert np.allclose(analysis.tempogram, tempogram, atol=1e-8)
+    assert np.allclose(analysis.mean_local_acf, np.mean(tempogram, axis=1), atol=1e-8)
+    acf = librosa.util.normalize(librosa.autocorrelate(oenv, max_size=384))
+    assert np.allclose(analysis.global_acf, acf, atol=1e-10)
+    assert np.array_equal(analysis.tempo_frequencies, librosa.tempo_frequencies(384, sr=SR, hop_length=HOP_LENGTH))
+
+
+@pytest.mark.parametrize('name', EXAMPLES)
+@pytest.mark.parametrize('start_bpm', [120.0, 80.0])
+def test_periodicity_analysis_tempo(onset_envelope, name, start_bpm):
+    oenv = onset_envelope(name)
+    tempo = librosa_tempo(onset_envelope=oenv, sr=SR, hop_length=HOP_LENGTH, start_bpm=start_bpm)
+    assert PeriodicityAnalysis(oenv, start_bpm=start_bpm).tempo == tempo.item()
+    # sharing the tempogram (window of `ac_size` equals `win_length`) gives the same tempo
+    tempo = librosa_tempo(onset_envelope=oenv, sr=SR, hop_length=HOP_LENGTH, start_bpm=start_bpm, ac_size=3.84)
+    assert PeriodicityAnalysis(oenv, start_bpm=start_bpm, ac_size=3.84).tempo == tempo.item()
+
+
+@pytest.mark.skipif(Version(librosa.__version__) >= Version('0.10'),
+                    reason='requires the private beat tracking helpers of librosa < 0.10')
+@pytest.mark.parametrize('name', EXAMPLES)
+def test_periodicity_analysis_beat_track(onset_envelope, name):
+    oenv = onset_envelope(name)
+    tempo = librosa_tempo(onset_envelope=oenv, sr=SR, hop_length=HOP_LENGTH).item()
+    beats, cumulative_score = PeriodicityAnalysis(oenv).beat_track()
+    ref_beats, ref_cumulative_score = beat_track_dp(oenv, tempo, FPS, SR, HOP_LENGTH)
+    assert np.array_equal(beats, ref_beats)
+    assert np.array_equal(cumulative_score, ref_cumulative_score)
+    if name == 'easy_example':
+        # on a steady example, the beats are those of librosa's beat tracker
+        _, ref_beats = librosa.beat.beat_track(onset_envelope=oenv, sr=SR, hop_length=HOP_LENGTH, units='time')
+        assert np.array_equal(beats, ref_beats)
+
+
+@pytest.mark.parametrize('name', EXAMPLES)
+@pytest.mark.parametrize('block_size', [4096, 1000, 1])
+@pytest.mark.parametrize('min_bpm, max_bpm', [(None, None), (30.0, 320.0), (60.0, None)])
+def test_tempogram(onset_envelope, name, block_size, min_bpm, max_bpm):
+    oenv = onset_envelope(name)
+    reference = librosa.feature.tempogram(onset_envelope=oenv, sr=SR, hop_length=HOP_LENGTH, win_length=384)
+    lags = lag_range(384, SR, HOP_LENGTH, min_bpm, max_bpm)
+    tempi = librosa.tempo_frequencies(384, sr=SR, hop_length=HOP_LENGTH)[lags]
+    assert np.all(tempi >= (min_bpm or 0)) and np.all(tempi <= (max_bpm or np.inf))
+    reference = reference[lags]
+    blocks = list(tempogram_blocks(oenv, 384, SR, HOP_LENGTH, min_bpm, max_bpm, block_size))
+    assert [start for start, _ in blocks] == list(range(0, len(oenv), block_size))
+    result = tempogram(oenv, 384, SR, HOP_LENGTH, min_bpm, max_bpm, block_size)
+    assert result.shape == reference.shape
+    assert np.allclose(result, reference, atol=1e-8)
+    mean = mean_tempogram(oenv, 384, SR, HOP_LENGTH, min_bpm, max_bpm, block_size)
+    assert np.allclose(mean, np.mean(reference, axis=1), atol=1e-8)
+
+
+@pytest.mark.parametrize('name', EXAMPLES)
+@pytest.mark.parametrize('max_size', [384, 10000])
+def test_global_autocorrelation(onset_envelope, name, max_size):
+    oenv = onset_envelope(name)
+    reference = librosa.autocorrelate(oenv, max_size=max_size)
+    # newer versions of librosa compute the autocorrelation in the precision of the (single precision) envelope
+    assert np.allclose(global_autocorrelation(oenv, max_size, norm=False), reference, rtol=1e-5,
+                       atol=1e-6 * reference[0])
+    assert np.allclose(global_autocorrelation(oenv, max_size), librosa.util.normalize(reference), atol=1e-6)
@@ -0,0 +1,97 @@
+"""Tests of the structured pruning (`common.pruning`)."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+pytest.importorskip('madmom')
+
+from common.evaluation import evaluate, scores  # noqa: E402
+from common.inference import predict  # noqa: E402
+from common.model import create_model  # noqa: E402
+from common.pruning import filter_importance, prune_model, resize_kernel, score_model  # noqa: E402
+from common.runtime import NumpyTCN  # noqa: E402
+
+NUM_BINS = 81
+
+
+@pytest.fixture(scope='module', params=['same', 'causal'])
+def model(request):
+    return create_model((None, NUM_BINS, 1), num_filters=8, num_dilations=4, padding=request.param)
+
+
+@pytest.fixture(scope='module')
+def x():
+    return np.random.RandomState(0).randn(1, 400, NUM_BINS, 1).astype(np.float32)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'num_filters': 8}, {'kernel_size': 7}, {'kernel_size': 9}])
+def test_prune_model_unchanged(model, x, kwargs):
+    # keeping all filters (in a different order) or enlarging the kernels does not change the model's output
+    pruned = prune_model(model, 1.0, **kwargs)
+    for a, b in zip(model.predict(x, verbose=0), pruned.predict(x, verbose=0)):
+        assert np.allclose(a, b, atol=1e-5)
+
+
+@pytest.mark.parametrize('method', ['magnitude', 'activation'])
+def test_prune_model(model, x, method):
+    pruned = prune_model(model, 0.5, num_dilations=3, method=method, sequence=[(x,)], num_filters=5, kernel_size=3)
+    assert pruned.count_params() < model.count_params()
+    assert pruned.get_layer('conv_1_conv').get_config()['filters'] == 5
+    assert pruned.get_layer('tempo_dense').get_weights()[0].shape == (5, 300)
+    assert pruned.get_layer('tcn_dilation_4_dilated_conv_2').get_config()['kernel_size'] == (3,)
+    # the pruned model is a valid model, i.e. the runtime computes the same
+    for a, b in zip(pruned.predict(x, verbose=0), NumpyTCN.from_keras(pruned).predict(x)):
+        assert np.allclose(a, b, atol=1e-5)
+
+
+def test_filter_importance(model, x):
+    importance = filter_importance(model, 'activation', [(x,)])
+    assert len(importance['conv_1_conv']) == len(importance['conv_2_conv']) == len(importance['residual']) == 8
+    assert all(len(scores) == 8 for scores in importance['tcn_dilation_1'])
+
+
+@pytest.mark.parametrize('padding', ['same', 'causal'])
+def test_resize_kernel(padding):
+    kernel = np.arange(1, 6, dtype=np.float32)[:, np.newaxis, np.newaxis]
+    # taps with the same offsets are kept
+    expected = [2, 3, 4] if padding == 'same' else [3, 4, 5]
+    assert np.array_equal(resize_kernel(kernel, 3, 4, padding).ravel(), expected)
+    expected = [0, 1, 2, 3, 4, 5, 0] if padding == 'same' else [0, 0, 1, 2, 3, 4, 5]
+    assert np.array_equal(resize_kernel(kernel, 7, 4, padding).ravel(), expected)
+
+
+class Tracks(list):
+    # single tracks, the same interface as `DataSequence`
+    @property
+    def ids(self):
+        return ['track_%d' % i for i in range(len(self))]
+
+
+class Beats:
+    def __init__(self, beats):
+        self.times, self.positions = beats[:, 0], beats[:, 1]
+
+
+class Track:
+    def __init__(self, detections):
+        self.beats = Beats(detections['downbeats'])
+        self.tempo = detections['tempo'][0, 0]
+
+
+def test_score_model_causal():
+    model = create_model((None, NUM_BINS, 1), num_filters=8, num_dilations=4, padding='causal')
+    rng = np.random.RandomState(1)
+    model.set_weights([rng.uniform(-0.2, 0.2, w.shape).astype(w.dtype) for w in model.get_weights()])
+    x = rng.randn(2, 600, NUM_BINS, 1).astype(np.float32)
+    x[:, ::50] += 3
+    dataset = Tracks([(x[:1],), (x[1:, :450],)])
+    # annotations are the detections of the Keras model, i.e. its scores are perfect
+    _, detections = predict(model, dataset, num_workers=0)
+    tracks = {key: Track(detections[key]) for key in dataset.ids}
+    reference = scores(evaluate(detections, tracks))
+    assert reference['downbeats_fmeasure'] == reference['tempo_acc1'] == 1
+    # scored with the (causal) NumPy runtime, the same as with Keras; 'same' padding gives different activations
+    assert score_model(model, dataset, tracks) == pytest.approx(reference)
+    assert not np.allclose(NumpyTCN.from_keras(model, padding='same').predict(x)[0], model.predict(x, verbose=0)[0],
+                           atol=1e-3)
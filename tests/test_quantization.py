@@ -0,0 +1,109 @@
+"""Tests of the int8 quantization (`common.quantization`)."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+pytest.importorskip('madmom')
+
+from common.model import create_model  # noqa: E402
+from common.quantization import QuantizedTCN, quantization_report  # noqa: E402
+from common.runtime import NumpyTCN  # noqa: E402
+
+NUM_BINS = 81
+
+
+class RecordingQuantizedTCN(QuantizedTCN):
+    # record the int8 inputs of all layers
+    def __init__(self, quantized):
+        super().__init__(quantized.kernels, quantized.activations, **quantized.config)
+        self.inputs = {}
+
+    def _input(self, name, x):
+        self.inputs[name] = super()._input(name, x)
+        return self.inputs[name]
+
+
+class FakeQuantizedTCN(NumpyTCN):
+    # float reference: dequantized weights and the dequantized int8 inputs of the quantized model, otherwise the
+    # rounding of float32 (quantized model) and float64 (reference) may move an input to a different level
+    def __init__(self, quantized, inputs):
+        super().__init__({name: [q.astype(np.float64) * scale, bias]
+                          for name, (q, scale, bias) in quantized.kernels.items()}, **quantized.config)
+        self.activations = quantized.activations
+        self.inputs = inputs
+
+    def _input(self, name, x):
+        scale, zero_point = self.activations[name]
+        assert self.inputs[name].shape == x.shape
+        return (self.inputs[name].astype(np.float64) - zero_point) * np.float64(scale)
+
+
+@pytest.fixture(scope='module', params=['same', 'causal'])
+def model(request):
+    model = create_model((None, NUM_BINS, 1), num_filters=8, num_dilations=5, padding=request.param)
+    # fixed weights, i.e. the same quantization error in every run
+    rng = np.random.RandomState(0)
+    model.set_weights([rng.uniform(-0.2, 0.2, w.shape).astype(w.dtype) for w in model.get_weights()])
+    return NumpyTCN.from_keras(model)
+
+
+class Tracks(list):
+    # single tracks, the same interface as `DataSequence`
+    ids = ['track_%d' % i for i in range(4)]
+
+
+class Beats:
+    times = np.arange(0.5, 3, 0.5)
+    positions = np.arange(len(times)) % 4 + 1
+
+
+class Track:
+    beats = Beats()
+    tempo = 120.0
+
+
+@pytest.fixture(scope='module')
+def dataset():
+    rng = np.random.RandomState(0)
+    return Tracks((rng.randn(1, 300, NUM_BINS, 1).astype(np.float32),) for _ in range(4))
+
+
+def test_quantized_tcn(model, dataset):
+    quantized = QuantizedTCN.calibrate(model, dataset, seed=0)
+    # only the int8 kernels are kept
+    assert all(weights[0].dtype == np.int8 for weights in quantized.weights.values())
+    x = dataset[0][0]
+    recording = RecordingQuantizedTCN(quantized)
+    int8_acts = recording.predict(x)
+    for int8_act, reference, float_act in zip(int8_acts, FakeQuantizedTCN(quantized, recording.inputs).predict(x),
+                                              model.predict(x)):
+        # integer arithmetic equals the dequantized computation (up to float32 rounding) ...
+        assert np.allclose(int8_act, reference, atol=1e-5)
+        # ... and approximates the float model
+        assert np.allclose(int8_act, float_act, atol=0.1)
+
+
+def test_save_load(model, dataset, tmp_path):
+    quantized = QuantizedTCN.calibrate(model, dataset, seed=0)
+    path = str(tmp_path / 'model.npz')
+    quantized.save(path)
+    loaded = QuantizedTCN.load(path)
+    x = dataset[1][0]
+    for a, b in zip(quantized.predict(x), loaded.predict(x)):
+        assert np.array_equal(a, b)
+    # one byte per weight, a float32 scale and bias per output channel
+    num_weights = sum(kernel.size for kernel, _ in model.weights.values())
+    num_outputs = sum(len(bias) for _, bias in model.weights.values())
+    assert loaded.num_bytes == num_weights + 8 * num_outputs
+
+
+def test_quantization_report(model, dataset):
+    tracks = {key: Track() for key in dataset.ids}
+    quantized, report = quantization_report(model, dataset, tracks, seed=0)
+    assert isinstance(quantized, QuantizedTCN)
+    # the emulated int8 model is not timed, it is no inference path
+    for name in ('float', 'int8'):
+        assert set(report[name]) == {'num_bytes', 'beats_fmeasure', 'downbeats_fmeasure', 'bars_fmeasure',
+                                     'tempo_acc1', 'tempo_acc2'}
+    assert report['int8']['num_bytes'] == quantized.num_bytes < report['float']['num_bytes']
@@ -0,0 +1,41 @@
+"""Tests of the NumPy runtime (`common.runtime`) against the Keras model."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+
+from common.model import create_model  # noqa: E402
+from common.runtime import NumpyTCN, load_weights  # noqa: E402
+
+NUM_BINS = 81
+
+
+@pytest.fixture(scope='module', params=['same', 'causal'])
+def model(request):
+    # untrained (i.e. randomly initialised) model, the weights do not matter for the forward pass
+    return create_model((None, NUM_BINS, 1), num_filters=8, num_dilations=5, padding=request.param)
+
+
+@pytest.fixture(scope='module')
+def features():
+    rng = np.random.RandomState(0)
+    return rng.randn(2, 500, NUM_BINS, 1).astype(np.float32)
+
+
+def test_numpy_tcn(model, features):
+    runtime = NumpyTCN.from_keras(model)
+    # the padding is that of the model
+    assert runtime.padding == model.get_layer('tcn_dilation_1_dilated_conv_1').get_config()['padding']
+    for keras_act, numpy_act in zip(model.predict(features, verbose=0), runtime.predict(features)):
+        assert keras_act.shape == numpy_act.shape
+        assert np.allclose(keras_act, numpy_act, atol=1e-5)
+
+
+def test_load_weights(model, tmp_path):
+    path = str(tmp_path / 'model.h5')
+    model.save(path)
+    weights = load_weights(path)
+    for layer in model.layers:
+        for saved, weight in zip(weights.get(layer.name, []), layer.get_weights()):
+            assert np.array_equal(saved, weight)
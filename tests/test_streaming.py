@@ -0,0 +1,85 @@
+"""Tests of the streaming inference (`common.streaming`) against the offline pre-processing and model."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+pytest.importorskip('madmom')
+sf = pytest.importorskip('soundfile')
+
+from madmom.audio.signal import FramedSignalProcessor, SignalProcessor  # noqa: E402
+from madmom.audio.spectrogram import FilteredSpectrogramProcessor, LogarithmicSpectrogramProcessor  # noqa: E402
+from madmom.audio.stft import ShortTimeFourierTransformProcessor  # noqa: E402
+from madmom.processors import SequentialProcessor  # noqa: E402
+
+from common.data import cnn_pad  # noqa: E402
+from common.model import create_model  # noqa: E402
+from common.runtime import NumpyTCN  # noqa: E402
+from common.streaming import FFT_SIZE, FPS, NUM_BANDS, StreamingPreProcessor, StreamingTCN  # noqa: E402
+
+
+class PreProcessor(SequentialProcessor):
+    # pre-processor of the notebook
+    def __init__(self, frame_size=FFT_SIZE, num_bands=NUM_BANDS, log=np.log, add=1e-6, fps=FPS):
+        sig = SignalProcessor(num_channels=1, sample_rate=44100)
+        frames = FramedSignalProcessor(frame_size=frame_size, fps=fps)
+        stft = ShortTimeFourierTransformProcessor()
+        filt = FilteredSpectrogramProcessor(num_bands=num_bands)
+        spec = LogarithmicSpectrogramProcessor(log=log, add=add)
+        super(PreProcessor, self).__init__((sig, frames, stft, filt, spec, np.array))
+        self.fps = fps
+
+
+@pytest.fixture(scope='module')
+def audio(audio_file):
+    y, _ = sf.read(audio_file('easy_example'), dtype='float32')
+    return y[:5 * 44100]
+
+
+@pytest.fixture(scope='module')
+def spectrogram(audio):
+    return PreProcessor()(audio)
+
+
+def stream(processor, blocks):
+    processor.reset()
+    return np.concatenate([processor.process(block) for block in blocks] + [processor.flush()])
+
+
+@pytest.mark.parametrize('block_size', [441, 1000, 4096])
+def test_streaming_pre_processor(audio, spectrogram, block_size):
+    blocks = [audio[start:start + block_size] for start in range(0, len(audio), block_size)]
+    spec = stream(StreamingPreProcessor(), blocks)
+    assert spec.shape == spectrogram.shape
+    assert np.allclose(spec, spectrogram, atol=1e-4)
+
+
+def test_streaming_pre_processor_random_blocks(audio, spectrogram):
+    rng = np.random.RandomState(0)
+    splits = np.sort(rng.randint(0, len(audio), 200))
+    spec = stream(StreamingPreProcessor(), np.split(audio, splits))
+    assert np.allclose(spec, spectrogram, atol=1e-4)
+
+
+@pytest.fixture(scope='module')
+def causal_model():
+    return create_model((None, 81, 1), num_filters=8, num_dilations=5, padding='causal')
+
+
+@pytest.mark.parametrize('block_size', [1, 7, 100])
+def test_streaming_tcn(causal_model, spectrogram, block_size):
+    x = cnn_pad(spectrogram, 2)[np.newaxis, ..., np.newaxis]
+    beats, downbeats, tempo = causal_model.predict(x, verbose=0)
+    tcn = StreamingTCN(NumpyTCN.from_keras(causal_model))
+    frames = [spectrogram[start:start + block_size] for start in range(0, len(spectrogram), block_size)]
+    activations = stream(tcn, frames)
+    assert activations.shape == (len(spectrogram), 2)
+    assert np.allclose(activations[:, 0], beats[0, :, 0], atol=1e-5)
+    assert np.allclose(activations[:, 1], downbeats[0, :, 0], atol=1e-5)
+    assert np.allclose(tcn.tempo(), tempo[0], atol=1e-5)
+
+
+def test_streaming_tcn_same_padding():
+    model = create_model((None, 81, 1), num_filters=8, num_dilations=2)
+    with pytest.raises(ValueError):
+        StreamingTCN(NumpyTCN.from_keras(model))
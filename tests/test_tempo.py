@@ -0,0 +1,169 @@
+"""Tests of the tempo estimation (`common.tempo`) against the dense-grid versions of the notebook.
+
+Run as a script to benchmark the tempo estimation against the dense-grid
+versions, i.e. `python tests/test_tempo.py`.
+"""
+
+import time
+
+import numpy as np
+import pytest
+import scipy.interpolate
+import scipy.signal
+
+from common.tempo import (
+    GRID_RESOLUTION, MASK_VALUE, detect_tempo, infer_tempo, smooth, tempo_hypotheses_from_acf,
+    tempo_hypotheses_from_activations,
+)
+
+
+def infer_tempo_dense(beats, hist_smooth=15, fps=100, no_tempo=MASK_VALUE):
+    # reference implementation of the notebook (dense interpolation grid)
+    ibis = np.diff(beats) * fps
+    bins = np.bincount(np.round(ibis).astype(int))
+    if not bins.any():
+        return no_tempo
+    intervals = np.arange(len(bins))
+    if hist_smooth > 0:
+        bins = smooth(bins, hist_smooth)
+    interpolation_fn = scipy.interpolate.interp1d(intervals, bins, 'quadratic')
+    intervals = np.arange(intervals[0], intervals[-1], GRID_RESOLUTION)
+    with np.errstate(divide='ignore'):
+        tempi = 60.0 * fps / intervals
+    bins = interpolation_fn(intervals)
+    peaks = scipy.signal.argrelmax(bins, mode='wrap')[0]
+    if len(peaks) == 0:
+        return no_tempo
+    sorted_peaks = peaks[np.argsort(bins[peaks])[::-1]]
+    return tempi[sorted_peaks][0]
+
+
+def detect_tempo_dense(bins, hist_smooth=11, min_bpm=10):
+    # reference implementation of the notebook (dense interpolation grid)
+    min_bpm = int(np.floor(min_bpm))
+    tempi = np.arange(min_bpm, len(bins))
+    bins = bins[min_bpm:]
+    if hist_smooth > 0:
+        bins = smooth(bins, hist_smooth)
+    interpolation_fn = scipy.interpolate.interp1d(tempi, bins, 'quadratic')
+    tempi = np.arange(tempi[0], tempi[-1], GRID_RESOLUTION)
+    bins = interpolation_fn(tempi)
+    peaks = scipy.signal.argrelmax(bins, mode='wrap')[0]
+    if len(peaks) == 0:
+        return np.array([], ndmin=2)
+    sorted_peaks = peaks[np.argsort(bins[peaks])[::-1]]
+    strengths = bins[sorted_peaks]
+    strengths /= np.sum(strengths)
+    return np.array(list(zip(tempi[sorted_peaks], strengths)))[:2]
+
+
+def synthetic_inputs(num_tracks=50, seed=1234):
+    """Beat sequences (with tempo drift and timing noise) and tempo activations."""
+    rng = np.random.RandomState(seed)
+    beats, activations = [], []
+    for _ in range(num_tracks):
+        tempo = rng.uniform(60, 200)
+        ibis = 60.0 / tempo * (1 + np.cumsum(rng.normal(0, 0.002, 60))) + rng.normal(0, 0.01, 60)
+        beats.append(np.cumsum(np.abs(ibis)))
+        act = rng.dirichlet(np.ones(300) * 0.1)
+        act[int(tempo)] += 1.0
+        act[int(tempo / 2)] += 0.5
+        activations.append(act / act.sum())
+    return beats, activations
+
+
+BEATS, ACTIVATIONS = synthetic_inputs()
+
+
+@pytest.mark.parametrize('beats', BEATS)
+def test_infer_tempo(beats):
+    assert infer_tempo(beats) == pytest.approx(infer_tempo_dense(beats), abs=1e-9)
+
+
+def test_infer_tempo_no_beats():
+    assert infer_tempo(np.array([1.0])) == MASK_VALUE
+
+
+@pytest.mark.parametrize('activations', ACTIVATIONS)
+def test_detect_tempo(activations):
+    tempi = detect_tempo(activations)
+    dense = detect_tempo_dense(activations)
+    assert tempi.shape == dense.shape
+    assert np.allclose(tempi, dense, atol=1e-9)
+
+
+@pytest.mark.parametrize('activations', ACTIVATIONS[:10])
+def test_tempo_hypotheses_from_activations(activations):
+    hypotheses = tempo_hypotheses_from_activations(activations, k=5)
+    dense = detect_tempo_dense(activations)
+    # the two strongest hypotheses are the tempi detected by the notebook
+    assert np.allclose(hypotheses[:2], dense, atol=1e-9)
+    assert np.all(np.diff(hypotheses[:, 1]) <= 0)
+
+
+def test_tempo_hypotheses_no_peaks():
+    assert tempo_hypotheses_from_acf(np.linspace(1, 0, 384), fps=100).shape == (0, 2)
+
+
+def test_tempo_hypotheses_from_acf():
+    # impulse train with a period of 50 frames, i.e. 120 BPM
+    oenv = np.zeros(3000)
+    oenv[::50] = 1
+    acf = np.correlate(oenv, oenv, 'full')[len(oenv) - 1:][:384]
+    hypotheses = tempo_hypotheses_from_acf(acf / acf[0], fps=100, k=3, min_bpm=30.0, max_bpm=320.0)
+    assert hypotheses[0, 0] == pytest.approx(120.0, abs=0.1)
+    assert np.all((hypotheses[:, 0] >= 30.0) & (hypotheses[:, 0] <= 320.0))
+    assert np.all(np.diff(hypotheses[:, 1]) <= 0)
+
+
+def benchmark_tempo_detection(num_tracks=200, seed=1234, num_runs=3):
+    """Compare `infer_tempo` and `detect_tempo` with the dense-grid versions of the notebook.
+
+    Synthetic beat sequences (with tempo drift and timing noise) and tempo
+    activations are used as inputs.
+
+    Args:
+        num_tracks: number of synthetic inputs
+        seed: random seed of the inputs
+        num_runs: number of runs over all inputs, the fastest one is reported
+
+    Returns:
+        dict: time per call (in seconds) of both versions, the resulting
+            speedups (dense / fast) and the maximum absolute deviations of
+            the results
+    """
+    beats, activations = synthetic_inputs(num_tracks, seed)
+    results = {}
+    for name, fast, dense, inputs in (('infer_tempo', infer_tempo, infer_tempo_dense, beats),
+                                      ('detect_tempo', detect_tempo, detect_tempo_dense, activations)):
+        times = {}
+        outputs = {}
+        for version, func in (('fast', fast), ('dense', dense)):
+            best = np.inf
+            for _ in range(num_runs):
+                start = time.perf_counter()
+                outputs[version] = [func(x) for x in inputs]
+                best = min(best, time.perf_counter() - start)
+            times[version] = best / len(inputs)
+        results[name + '_time'] = times['fast']
+        results[name + '_dense_time'] = times['dense']
+        results[name + '_speedup'] = times['dense'] / times['fast']
+        results[name + '_max_deviation'] = max(float(np.max(np.abs(np.subtract(a, b))))
+                                               for a, b in zip(outputs['fast'], outputs['dense']))
+    return results
+
+
+def test_benchmark_tempo_detection():
+    results = benchmark_tempo_detection(num_tracks=10, num_runs=1)
+    for name in ('infer_tempo', 'detect_tempo'):
+        assert results[name + '_max_deviation'] < 1e-9
+        # both are several times faster, be generous to not depend on the load of the machine
+        assert results[name + '_speedup'] > 1
+
+
+if __name__ == '__main__':
+    results = benchmark_tempo_detection()
+    for name in ('infer_tempo', 'detect_tempo'):
+        print(f"{name}: {results[name + '_time'] * 1e3:.3f} ms per call, dense grid "
+              f"{results[name + '_dense_time'] * 1e3:.3f} ms per call ({results[name + '_speedup']:.1f}x), "
+              f"max. deviation {results[name + '_max_deviation']:.1e}")
@@ -0,0 +1,105 @@
+"""Tests of the data-parallel training (`common.training`) with spawned worker processes."""
+
+import functools
+import multiprocessing as mp
+
+import numpy as np
+import pytest
+
+keras = pytest.importorskip('keras')
+pytest.importorskip('tensorflow')
+pytest.importorskip('madmom')
+
+import keras.backend as K  # noqa: E402
+
+from common.data import FeatureStore  # noqa: E402
+from common.model import build_masked_loss, create_model  # noqa: E402
+from common.training import SharedMemoryAllReduce, StoreShards, train_data_parallel  # noqa: E402
+
+NUM_BINS = 81
+
+
+def _allreduce_worker(rank, allreduce, vectors, results):
+    # all operations of the all-reduce, in the same order in all workers
+    results.put((rank, {'mean': allreduce(rank, vectors[rank]),
+                        'partial': allreduce(rank, vectors[rank][:7]),
+                        'broadcast': allreduce.broadcast(rank, vectors[rank] if rank == 1 else None, root=1),
+                        'minimum': allreduce.minimum(rank, 3 - rank),
+                        'maximum': allreduce.maximum(rank, -0.5 * rank),
+                        'gather': allreduce.gather(rank, 2.5 * rank)}))
+
+
+@pytest.mark.parametrize('num_workers', [2, 3])
+def test_shared_memory_allreduce(num_workers):
+    ctx = mp.get_context('spawn')
+    size = 1001
+    vectors = np.random.RandomState(0).randn(num_workers, size).astype(np.float32)
+    allreduce = SharedMemoryAllReduce(num_workers, size, ctx, timeout=60)
+    results = ctx.Queue()
+    workers = [ctx.Process(target=_allreduce_worker, args=(rank, allreduce, vectors, results))
+               for rank in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        outputs = dict(results.get(timeout=120) for _ in range(num_workers))
+    finally:
+        for worker in workers:
+            worker.join()
+    assert all(worker.exitcode == 0 for worker in workers)
+    for output in outputs.values():
+        assert np.allclose(output['mean'], np.sum(vectors, axis=0) / num_workers, rtol=1e-6, atol=1e-7)
+        assert np.allclose(output['mean'], np.mean(vectors, axis=0), rtol=1e-6, atol=1e-7)
+        assert np.allclose(output['partial'], np.mean(vectors[:, :7], axis=0), rtol=1e-6, atol=1e-7)
+        assert np.array_equal(output['broadcast'], vectors[1])
+        assert output['minimum'] == 3 - (num_workers - 1)
+        assert output['maximum'] == 0.0
+        assert np.array_equal(output['gather'], 2.5 * np.arange(num_workers))
+
+
+def model_fn(num_bins=NUM_BINS):
+    # the notebook's model without dropout (i.e. deterministic); RAdam requires an old version of Keras
+    model = create_model((None, num_bins, 1), num_filters=8, num_dilations=3, dropout_rate=0.0)
+    # the same initial weights in every process (and run)
+    rng = np.random.RandomState(0)
+    model.set_weights([rng.uniform(-0.2, 0.2, w.shape).astype(w.dtype) for w in model.get_weights()])
+    optimizer = getattr(keras.optimizers, 'legacy', keras.optimizers).Adam(0.002, clipnorm=0.5)
+    return model, optimizer, [build_masked_loss(K.binary_crossentropy)] * 3
+
+
+@pytest.fixture(scope='module')
+def store(tmp_path_factory):
+    # tracks of equal length, i.e. the mean loss of the combined batch is the mean of the losses of the shards
+    rng = np.random.RandomState(1)
+    items = []
+    for i in range(8):
+        beats = np.arange(rng.randint(20, 40), 400, rng.randint(40, 60))
+        beat_targets = np.zeros(400, dtype=np.float32)
+        beat_targets[beats] = 1
+        items.append((f'track_{i}', {'x': rng.randn(400, NUM_BINS).astype(np.float32), 'beats': beat_targets,
+                                     'downbeats': np.full(400, -1, dtype=np.float32),
+                                     'tempo': np.eye(300, dtype=np.float32)[rng.randint(60, 200)],
+                                     'beat_times': beats / 100.0, 'downbeat_times': None}))
+    return FeatureStore.write(str(tmp_path_factory.mktemp('training') / 'store'), items, 100)
+
+
+def test_train_data_parallel(store):
+    # 2 workers with a batch of 1 track each vs. a single worker with batches of 2 tracks (in the same order)
+    parallel = train_data_parallel(model_fn, StoreShards(store.path, batch_size=1, shuffle=False), num_workers=2,
+                                   epochs=2, steps_per_epoch=3, num_threads=1, timeout=120)
+    single = train_data_parallel(model_fn, StoreShards(store.path, batch_size=2, shuffle=False), num_workers=1,
+                                 epochs=2, steps_per_epoch=3, num_threads=1, timeout=120)
+    assert parallel['steps_per_epoch'] == single['steps_per_epoch'] == 3
+    assert parallel['divergence'] == 0
+    assert np.allclose(parallel['history'], single['history'], rtol=1e-5)
+    initial, _, _ = model_fn()
+    for weights, reference, init in zip(parallel['weights'], single['weights'], initial.get_weights()):
+        # the weights were trained, i.e. changed
+        assert weights.shape == reference.shape == init.shape
+        assert np.allclose(weights, reference, rtol=1e-4, atol=1e-6)
+    assert any(not np.allclose(w, r) for w, r in zip(single['weights'], initial.get_weights()))
+
+
+def test_train_data_parallel_num_bins(store):
+    with pytest.raises(RuntimeError, match='model expects 100 bins'):
+        train_data_parallel(functools.partial(model_fn, 100), StoreShards(store.path), num_workers=2,
+                            steps_per_epoch=1, num_threads=1, timeout=120)